@@ -8,7 +8,7 @@ from dipy.utils.optpkg import optional_package
 import numpy as np
 from scipy.cluster import hierarchy
 
-from scilpy.image.labels import get_data_as_labels
+from scilpy.image.labels import LabelIndex, get_data_as_labels
 from scilpy.stats.matrix_stats import omega_sigma
 from scilpy.tractanalysis.reproducibility_measures import \
     approximate_surface_node
@@ -99,7 +99,8 @@ def apply_reordering(array, ordering):
 
 
 def evaluate_graph_measures(conn_matrix, len_matrix, avg_node_wise,
-                            small_world):
+                            small_world, nbr_processes=1,
+                            small_world_cache_dir=None):
     """
     toDo Finish docstring
 
@@ -112,6 +113,11 @@ def evaluate_graph_measures(conn_matrix, len_matrix, avg_node_wise,
     small_world: bool
         If true, compute measure related to small worldness (omega and sigma).
         This option is much slower.
+    nbr_processes: int
+        Number of processes used to generate the small world null models.
+    small_world_cache_dir: str, optional
+        Directory where to cache the measures of the small world null models.
+        See omega_sigma.
     """
     if not have_bct:
         raise RuntimeError("bct ist not installed. Please install to use "
@@ -174,7 +180,9 @@ def evaluate_graph_measures(conn_matrix, len_matrix, avg_node_wise,
             gtm_dict['edge_count'].insert(i, -1)
 
     if small_world:
-        gtm_dict['omega'], gtm_dict['sigma'] = omega_sigma(len_matrix)
+        gtm_dict['omega'], gtm_dict['sigma'] = omega_sigma(
+            len_matrix, nbr_processes=nbr_processes,
+            cache_dir=small_world_cache_dir)
 
     return gtm_dict
 
@@ -233,15 +241,16 @@ def normalize_matrix_from_parcel(matrix, atlas_img, labels_list,
     all_comb.extend(zip(pos_list, pos_list))
 
     # Prevent useless computations for approximate_surface_node()
+    label_index = LabelIndex(atlas_data)
     factor_list = []
     for label in labels_list:
         if parcel_from_volume:
-            factor_list.append(
-                np.count_nonzero(atlas_data == label) * voxels_vol)
+            factor_list.append(label_index.count(label)[0] * voxels_vol)
         else:
-            if np.count_nonzero(atlas_data == label):
+            label_occurences = label_index.get_indices(label)
+            if len(label_occurences):
                 roi = np.zeros(atlas_data.shape)
-                roi[atlas_data == label] = 1
+                roi.ravel()[label_occurences] = 1
                 factor_list.append(
                     approximate_surface_node(roi) * voxels_sur)
             else:
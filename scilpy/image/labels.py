@@ -48,6 +48,94 @@ def get_data_as_labels(in_img):
                       'image'.format(basename, curr_type))
 
 
+class LabelIndex(object):
+    """
+    Index of the voxels of a labels volume, grouped by label. The volume is
+    traversed once; the voxels, counts and statistics of any label (or of
+    all labels at once) are then obtained without comparing the whole volume
+    to each label.
+
+    Build it once and pass it to the functions of this module accepting a
+    label_index, to reuse it. It is not updated if the volume is modified.
+    """
+    def __init__(self, labels_volume):
+        """
+        Parameters
+        ----------
+        labels_volume: np.ndarray
+            The volume (as labels).
+        """
+        self.shape = labels_volume.shape
+        flat = np.asarray(labels_volume).ravel()
+
+        # Small non-negative integers (ex, uint16 from get_data_as_labels):
+        # counted directly. Else, sorted.
+        if (np.issubdtype(flat.dtype, np.integer) and flat.size > 0 and
+                flat.min() >= 0 and flat.max() <= np.iinfo(np.uint16).max):
+            counts = np.bincount(flat)
+            self.labels = np.flatnonzero(counts).astype(flat.dtype)
+            self.counts = counts[self.labels]
+            lookup = np.zeros(len(counts), dtype=np.intp)
+            lookup[self.labels] = np.arange(len(self.labels))
+            self.inverse = lookup[flat]
+        else:
+            self.labels, self.inverse, self.counts = np.unique(
+                flat, return_inverse=True, return_counts=True)
+            self.inverse = self.inverse.ravel()
+
+        self._order = None
+        self._bounds = None
+
+    def find(self, labels):
+        """
+        Position of the given labels in self.labels (-1 if not in the
+        volume).
+        """
+        labels = np.atleast_1d(labels)
+        if len(self.labels) == 0:
+            return np.full(len(labels), -1)
+        pos = np.minimum(np.searchsorted(self.labels, labels),
+                         len(self.labels) - 1)
+        return np.where(self.labels[pos] == labels, pos, -1)
+
+    def count(self, labels):
+        """ Number of voxels of each of the given labels. """
+        pos = self.find(labels)
+        return np.where(pos >= 0, self.counts[pos], 0)
+
+    def get_indices(self, label):
+        """ Flat indices (sorted) of the voxels of the given label. """
+        if self._order is None:
+            # Computed only when needed: this is the costly part. With
+            # 16-bits keys, numpy's stable sort is a radix sort.
+            keys = self.inverse
+            if len(self.labels) <= np.iinfo(np.uint16).max + 1:
+                keys = keys.astype(np.uint16)
+            self._order = np.argsort(keys, kind='stable')
+            self._bounds = np.concatenate(([0], np.cumsum(self.counts)))
+        pos = self.find(label)[0]
+        if pos < 0:
+            return np.zeros(0, dtype=np.intp)
+        return self._order[self._bounds[pos]:self._bounds[pos + 1]]
+
+    def get_mask(self, labels):
+        """ Boolean volume: True for the voxels of any of the given labels. """
+        is_selected = np.isin(self.labels, labels)
+        return is_selected[self.inverse].reshape(self.shape)
+
+    def sum(self, values):
+        """ Sum of the values (same shape as the volume), per label. """
+        return np.bincount(self.inverse, weights=np.ravel(values),
+                           minlength=len(self.labels))
+
+    def max(self, values):
+        """ Maximum of the values (same shape as the volume), per label. """
+        values = np.ravel(values)
+        maxima = np.full(len(self.labels), -np.inf)
+        np.maximum.at(maxima, self.inverse, values)
+        return maxima
+
+
 def get_binary_mask_from_labels(atlas, label_list):
     """
     Get a binary mask from labels.
@@ -60,12 +148,7 @@ def get_binary_mask_from_labels(atlas, label_list):
     label_list: list[int]
         The labels to get.
     """
-    mask = np.zeros(atlas.shape, dtype=np.uint16)
-    for label in label_list:
-        is_label = atlas == label
-        mask[is_label] = 1
-
-    return mask
+    return np.isin(atlas, label_list).astype(np.uint16)
 
 
 def get_labels_from_mask(mask_data, labels=None, background_label=0,
@@ -165,7 +248,7 @@ def get_lut_dir():
     return lut_dir
 
 
-def split_labels(labels_volume, label_indices):
+def split_labels(labels_volume, label_indices, label_index=None):
     """
     For each label in list, return a separate volume containing only that
     label.
@@ -176,26 +259,30 @@ def split_labels(labels_volume, label_indices):
         A 3D volume.
     label_indices: list or np.array
         The list of labels to extract.
+    label_index: LabelIndex, optional
+        The index of labels_volume, if already computed.
 
     Returns
     -------
     split_data: list
-        One 3D volume per label.
+        One 3D volume per label (empty if the label is not in the volume).
     """
+    if label_index is None:
+        label_index = LabelIndex(labels_volume)
+
     split_data = []
     for label in label_indices:
-        label_occurences = np.where(labels_volume == int(label))
-        if len(label_occurences) != 0:
-            split_label = np.zeros(labels_volume.shape, dtype=np.uint16)
-            split_label[label_occurences] = label
-            split_data.append(split_label)
-        else:
+        label_occurences = label_index.get_indices(int(label))
+        if len(label_occurences) == 0:
             logging.info("Label {} not present in the image.".format(label))
-            split_data.append(None)
+        split_label = np.zeros(labels_volume.shape, dtype=np.uint16)
+        split_label.ravel()[label_occurences] = label
+        split_data.append(split_label)
     return split_data
 
 
-def remove_labels(labels_volume, label_indices, background_id=0):
+def remove_labels(labels_volume, label_indices, background_id=0,
+                  label_index=None):
     """
     Remove given labels from the volume.
 
@@ -207,12 +294,18 @@ def remove_labels(labels_volume, label_indices, background_id=0):
         List of labels indices to remove.
     background_id: int
         Value used for removed labels
+    label_index: LabelIndex, optional
+        The index of labels_volume, if already computed. It is not valid
+        anymore after this function, as labels_volume is modified.
     """
-    for index in np.unique(label_indices):
-        mask = labels_volume == index
-        labels_volume[mask] = background_id
-        if np.count_nonzero(mask) == 0:
-            logging.warning("Label {} was not in the volume".format(index))
+    if label_index is None:
+        label_index = LabelIndex(labels_volume)
+
+    label_indices = np.unique(label_indices)
+    for index in label_indices[label_index.find(label_indices) < 0]:
+        logging.warning("Label {} was not in the volume".format(index))
+
+    labels_volume[label_index.get_mask(label_indices)] = background_id
     return labels_volume
 
 
@@ -300,25 +393,33 @@ def combine_labels(data_list, indices_per_input_volume, out_labels_choice,
     resulting_labels = (np.ones_like(data_list[0], dtype=np.uint16)
                         * background_id)
     for i in range(nb_volumes):
-        # Loop on ids for this volume.
+        # Output value of each label of this volume (the last one given, if
+        # an id is given more than once).
+        label_index = LabelIndex(data_list[i])
+        is_selected = np.zeros(len(label_index.labels), dtype=bool)
+        new_values = np.zeros(len(label_index.labels), dtype=np.uint16)
         for this_id in filtered_ids_per_vol[i]:
-            mask = data_list[i] == this_id
-            if np.count_nonzero(mask) == 0:
+            pos = label_index.find(this_id)[0]
+            if pos < 0:
                 logging.warning(
                     "Label {} was not in the volume".format(this_id))
-
-            if merge_groups:
-                resulting_labels[mask] = out_labels[i]
             else:
-                resulting_labels[mask] = out_labels[current_id]
+                is_selected[pos] = True
+                new_values[pos] = out_labels[i] if merge_groups else \
+                    out_labels[current_id]
+
+            if not merge_groups:
                 current_id += 1
 
+        mask = is_selected[label_index.inverse].reshape(resulting_labels.shape)
+        resulting_labels[mask] = new_values[label_index.inverse[mask.ravel()]]
+
     return resulting_labels
 
 
 def dilate_labels(data, vox_size, distance, nbr_processes,
                   labels_to_dilate=None, labels_not_to_dilate=None,
-                  labels_to_fill=None, mask=None):
+                  labels_to_fill=None, mask=None, method='kdtree'):
     """
     Parameters
     ----------
@@ -329,7 +430,7 @@ def dilate_labels(data, vox_size, distance, nbr_processes,
     distance: float
         Maximal distance to dilate (in mm).
     nbr_processes: int
-        Number of processes.
+        Number of processes. Only used with the kdtree method.
     labels_to_dilate: list, optional
         Label list to dilate. By default it dilates all labels not in
         labels_to_fill nor in labels_not_to_dilate.
@@ -340,9 +441,28 @@ def dilate_labels(data, vox_size, distance, nbr_processes,
         background value. Default: [0]
     mask: np.ndarray, optional
         Only dilate values inside the mask.
+    method: str, optional
+        Either 'kdtree' or 'edt'. With 'kdtree', a KDTree is built over all
+        labelled voxels and queried for each voxel to fill. With 'edt', the
+        nearest labelled voxels are found with an (anisotropic) euclidean
+        distance transform, restricted to the bounding box of the voxels to
+        fill. Both give the same nearest labels, except for voxels at equal
+        distance from two labels, where the chosen label may differ. 'edt'
+        is much faster and uses much less memory on large volumes.
+        Default: 'kdtree'.
+
+    Returns
+    -------
+    data: np.ndarray
+        The dilated labels.
     """
+    if method not in ['kdtree', 'edt']:
+        raise ValueError("Unknown method {}. Choose either 'kdtree' or "
+                         "'edt'.".format(method))
     if labels_to_fill is None:
         labels_to_fill = [0]
+    if labels_not_to_dilate is None:
+        labels_not_to_dilate = []
 
     img_shape = data.shape
 
@@ -350,17 +470,17 @@ def dilate_labels(data, vox_size, distance, nbr_processes,
     fill_and_not = np.intersect1d(labels_not_to_dilate, labels_to_fill)
     if len(fill_and_not) > 0:
         logging.error("Error, both in not_to_dilate and to_fill: {}".format(
-            np.asarray(labels_not_to_dilate)[fill_and_not]))
+            fill_and_not))
 
     # Create background mask
     is_background_mask = np.zeros(img_shape, dtype=bool)
     for i in labels_to_fill:
-        is_background_mask = np.logical_or(is_background_mask, data == i)
+        is_background_mask |= data == i
 
     # Create not_to_dilate mask (initialized to background)
     not_to_dilate = np.copy(is_background_mask)
     for i in labels_not_to_dilate:
-        not_to_dilate = np.logical_or(not_to_dilate, data == i)
+        not_to_dilate |= data == i
 
     # Add mask
     if mask is not None:
@@ -387,11 +507,18 @@ def dilate_labels(data, vox_size, distance, nbr_processes,
         # Create new label to dilate list
         new_label_mask = np.zeros_like(data, dtype=bool)
         for i in labels_to_dilate:
-            new_label_mask = np.logical_or(new_label_mask, data == i)
+            new_label_mask |= data == i
 
         # Combine both new_label_mask and not_to_dilate
         is_label_mask = np.logical_and(new_label_mask, ~not_to_dilate)
 
+    if not np.any(is_label_mask) or not np.any(to_dilate_mask):
+        return data
+
+    if method == 'edt':
+        return _dilate_labels_edt(data, vox_size, distance,
+                                  is_label_mask, to_dilate_mask)
+
     # Get the list of indices
     background_pos = np.argwhere(to_dilate_mask) * vox_size
     label_pos = np.argwhere(is_label_mask) * vox_size
@@ -415,7 +542,59 @@ def dilate_labels(data, vox_size, distance, nbr_processes,
     return data
 
 
-def get_stats_in_label(map_data, label_data, label_lut):
+def _dilate_labels_edt(data, vox_size, distance, is_label_mask,
+                       to_dilate_mask):
+    """
+    Fills the voxels of to_dilate_mask with the value of their nearest voxel
+    of is_label_mask, if closer than distance, using a euclidean distance
+    transform. See dilate_labels.
+    """
+    sampling = np.broadcast_to(np.asarray(vox_size, dtype=float).ravel(), 3)
+
+    # Labels further than distance from the voxels to fill are never used:
+    # working on the bounding box of the voxels to fill, padded by distance.
+    margin = np.floor(distance / sampling).astype(int)
+    box = []
+    for axis in range(3):
+        other_axes = tuple(i for i in range(3) if i != axis)
+        nonzero = np.flatnonzero(np.any(to_dilate_mask, axis=other_axes))
+        box.append(slice(max(nonzero[0] - margin[axis], 0),
+                         nonzero[-1] + margin[axis] + 1))
+    box = tuple(box)
+
+    label_mask = is_label_mask[box]
+    if not np.any(label_mask):
+        return data
+
+    # Nearest labelled voxel of each voxel of the box. The distances are
+    # computed here instead of by scipy, to save memory.
+    indices = ndi.distance_transform_edt(
+        ~label_mask, sampling=sampling, return_distances=False,
+        return_indices=True)
+    dist = np.zeros(label_mask.shape, dtype=float)
+    axis_dist = np.empty(label_mask.shape, dtype=float)
+    for axis, (axis_indices, axis_sampling) in enumerate(zip(indices,
+                                                             sampling)):
+        axis_pos = np.arange(label_mask.shape[axis]).reshape(
+            [-1 if i == axis else 1 for i in range(3)])
+        np.subtract(axis_indices, axis_pos, out=axis_dist)
+        axis_dist *= axis_sampling
+        axis_dist **= 2
+        dist += axis_dist
+    del axis_dist
+
+    # Same strict bound as the kdtree query.
+    to_fill = np.logical_and(to_dilate_mask[box], dist < distance ** 2)
+    del dist
+
+    data = np.copy(data)
+    box_data = data[box]
+    box_data[to_fill] = box_data[tuple(i[to_fill] for i in indices)]
+
+    return data
+
+
+def get_stats_in_label(map_data, label_data, label_lut, label_index=None):
     """
     Get statistics about a map for each label in an atlas.
 
@@ -427,6 +606,8 @@ def get_stats_in_label(map_data, label_data, label_lut):
         The loaded atlas.
     label_lut: dict
         The loaded label LUT (look-up table).
+    label_index: LabelIndex, optional
+        The index of label_data, if already computed.
 
     Returns
     -------
@@ -434,29 +615,39 @@ def get_stats_in_label(map_data, label_data, label_lut):
         A dict with one key per label name, and its values are the computed
         statistics.
     """
+    if label_index is None:
+        label_index = LabelIndex(label_data)
+
+    # Statistics of all labels at once. The std is computed on the non-zero
+    # values, around the mean, in a second pass.
+    map_data = np.ravel(map_data)
+    is_seed = map_data != 0
+    nb_seed_vx = np.bincount(label_index.inverse[is_seed],
+                             minlength=len(label_index.labels))
+    mean_seed = label_index.sum(map_data) / np.maximum(nb_seed_vx, 1)
+    max_seed = label_index.max(map_data)
+    sq_diff = np.bincount(
+        label_index.inverse[is_seed],
+        weights=abs(map_data[is_seed] -
+                    mean_seed[label_index.inverse[is_seed]]) ** 2,
+        minlength=len(label_index.labels))
+    std_seed = np.sqrt(sq_diff / np.maximum(nb_seed_vx, 1))
+
     (label_indices, label_names) = zip(*label_lut.items())
 
     out_dict = {}
     for label, name in zip(label_indices, label_names):
         label = int(label)
         if label != 0:
-            curr_data = (map_data[np.where(label_data == label)])
-            nb_vx_roi = np.count_nonzero(label_data == label)
-            nb_seed_vx = np.count_nonzero(curr_data)
-
-            if nb_seed_vx != 0:
-                mean_seed = np.sum(curr_data) / nb_seed_vx
-                max_seed = np.max(curr_data)
-                std_seed = np.sqrt(np.mean(abs(curr_data[curr_data != 0] -
-                                               mean_seed) ** 2))
-
+            pos = label_index.find(label)[0]
+            if pos >= 0 and nb_seed_vx[pos] != 0:
                 out_dict[name] = {'ROI-idx': label,
                                   'ROI-name': str(name),
-                                  'nb-vx-roi': int(nb_vx_roi),
-                                  'nb-vx-seed': int(nb_seed_vx),
-                                  'max': int(max_seed),
-                                  'mean': float(mean_seed),
-                                  'std': float(std_seed)}
+                                  'nb-vx-roi': int(label_index.counts[pos]),
+                                  'nb-vx-seed': int(nb_seed_vx[pos]),
+                                  'max': int(max_seed[pos]),
+                                  'mean': float(mean_seed[pos]),
+                                  'std': float(std_seed[pos])}
     return out_dict
 
 
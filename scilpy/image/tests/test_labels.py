@@ -9,9 +9,10 @@ import numpy as np
 from numpy.testing import assert_equal
 import pytest
 
-from scilpy.image.labels import (combine_labels, dilate_labels,
+from scilpy.image.labels import (LabelIndex, combine_labels, dilate_labels,
                                  get_data_as_labels, get_labels_from_mask,
-                                 get_lut_dir, remove_labels, split_labels)
+                                 get_lut_dir, get_stats_in_label,
+                                 remove_labels, split_labels)
 from scilpy.tests.arrays import ref_in_labels, ref_out_labels
 
 
@@ -78,31 +79,63 @@ def test_combine_labels_group_in_m():
 
 
 def test_dilate_labels_with_mask():
-    in_labels = deepcopy(ref_in_labels)
     in_mask = deepcopy(ref_in_labels)
     in_mask[in_mask > 0] = 1
-    out_labels = dilate_labels(in_labels, 1, 2, 1,
-                               labels_to_dilate=[1, 6],
-                               labels_not_to_dilate=[3, 4],
-                               labels_to_fill=[0, 2, 5],
-                               mask=in_mask)
 
     exp_labels = deepcopy(ref_in_labels)
     exp_labels[exp_labels == 2] = 1
     exp_labels[exp_labels == 5] = 6
 
-    assert_equal(out_labels, exp_labels)
+    for method in ['kdtree', 'edt']:
+        in_labels = deepcopy(ref_in_labels)
+        out_labels = dilate_labels(in_labels, 1, 2, 1,
+                                   labels_to_dilate=[1, 6],
+                                   labels_not_to_dilate=[3, 4],
+                                   labels_to_fill=[0, 2, 5],
+                                   mask=in_mask, method=method)
+        assert_equal(out_labels, exp_labels)
 
 
 def test_dilate_labels_without_mask():
-    in_labels = deepcopy(ref_in_labels)
-    out_labels = dilate_labels(in_labels, 1, 2, 1,
-                               labels_to_dilate=[1, 6],
-                               labels_not_to_dilate=[3, 4, 5],
-                               labels_to_fill=[0], mask=None)
-
-    for i, val in enumerate([544, 156, 36, 36, 36, 36, 156]):
-        assert len(out_labels[out_labels == i]) == val
+    for method in ['kdtree', 'edt']:
+        in_labels = deepcopy(ref_in_labels)
+        out_labels = dilate_labels(in_labels, 1, 2, 1,
+                                   labels_to_dilate=[1, 6],
+                                   labels_not_to_dilate=[3, 4, 5],
+                                   labels_to_fill=[0], mask=None,
+                                   method=method)
+
+        for i, val in enumerate([544, 156, 36, 36, 36, 36, 156]):
+            assert len(out_labels[out_labels == i]) == val
+
+
+def test_dilate_labels_edt():
+    # Anisotropic voxels. Labels are distinct blobs, far enough from each
+    # other to avoid voxels at equal distance from two labels.
+    data = np.zeros((20, 15, 10), dtype=np.uint16)
+    data[2:4, 2:4, 2:4] = 1
+    data[12:15, 10:12, 6:8] = 2
+    data[3, 12, 7] = 3
+    data[15:17, 2:3, 2:3] = 4
+    mask = np.ones(data.shape, dtype=bool)
+    mask[:, :, 0] = False
+    vox_size = np.array([[1., 0.8, 1.5]])
+    in_labels = np.copy(data)
+
+    for distance in [1.5, 3., 6.]:
+        expected = dilate_labels(data, vox_size, distance, 1,
+                                 labels_not_to_dilate=[4], mask=mask)
+        out_labels = dilate_labels(data, vox_size, distance, 1,
+                                   labels_not_to_dilate=[4], mask=mask,
+                                   method='edt')
+        assert_equal(out_labels, expected)
+        assert np.all(out_labels[:, :, 0] == data[:, :, 0])
+        assert np.sum(out_labels == 4) == 2
+    # The input is not modified.
+    assert_equal(data, in_labels)
+
+    with pytest.raises(ValueError):
+        dilate_labels(data, vox_size, 2, 1, method='unknown')
 
 
 def test_get_data_as_labels_int():
@@ -207,6 +240,35 @@ def test_split_labels():
     assert_equal(np.unique(out_labels[1]), [0])
 
 
+def test_label_index():
+    label_index = LabelIndex(ref_in_labels)
+    assert_equal(label_index.labels, np.arange(7))
+    assert_equal(label_index.count([0, 3, 9]), [784, 36, 0])
+    assert_equal(label_index.get_indices(3),
+                 np.flatnonzero(ref_in_labels == 3))
+    assert len(label_index.get_indices(9)) == 0
+    assert_equal(label_index.get_mask([2, 3]), np.isin(ref_in_labels, [2, 3]))
+
+    # Labels that can't be counted directly.
+    label_index = LabelIndex(ref_in_labels.astype(float) - 1)
+    assert_equal(label_index.labels, np.arange(7) - 1)
+    assert_equal(label_index.get_indices(2),
+                 np.flatnonzero(ref_in_labels == 3))
+
+
 def test_stats_in_labels():
-    # toDO. Will need to create a fake LUT.
-    pass
+    map_data = np.arange(1000, dtype=float).reshape((10, 10, 10))
+    map_data[2:8, 2:8, 2] = 0  # Label 1: no seed.
+    map_data[2:4, 2:8, 3] = 0  # Label 2: half seeds.
+    label_lut = {'0': 'background', '1': 'roi_1', '2': 'roi_2',
+                 '9': 'absent'}
+
+    out_dict = get_stats_in_label(map_data, ref_in_labels, label_lut)
+    assert list(out_dict.keys()) == ['roi_2']
+
+    values = map_data[4:8, 2:8, 3].ravel()
+    assert out_dict['roi_2']['nb-vx-roi'] == 36
+    assert out_dict['roi_2']['nb-vx-seed'] == 24
+    assert out_dict['roi_2']['max'] == int(np.max(values))
+    assert np.isclose(out_dict['roi_2']['mean'], np.mean(values))
+    assert np.isclose(out_dict['roi_2']['std'], np.std(values))
@@ -32,7 +32,8 @@ from scilpy.image.volume_math import (_validate_imgs_type,
                                       concatenate, gaussian_blur,
                                       dilation, erosion,
                                       closing, opening,
-                                      neighborhood_correlation)
+                                      neighborhood_correlation,
+                                      neighborhood_correlation_)
 
 
 EPSILON = np.finfo(float).eps
@@ -564,6 +565,27 @@ def test_neighborhood_correlation():
         "Expected a 0 correlation everywhere, got {}".format(output)
 
 
+def test_neighborhood_correlation_radius_and_chunks():
+    rng = np.random.default_rng(0)
+    data = [rng.random((6, 7, 8)) for _ in range(3)]
+    output = neighborhood_correlation_(data, patch_radius=2)
+
+    # Compared with the correlation of the zero-padded 5x5x5 patches.
+    patches = [_get_neighbors(d, radius=2) for d in data]
+    for voxel in [(0, 0, 0), (2, 3, 4), (5, 1, 7)]:
+        expected = np.mean([np.corrcoef(patches[i][voxel].ravel(),
+                                        patches[j][voxel].ravel())[0, 1]
+                            for i, j in [(0, 1), (0, 2), (1, 2)]])
+        assert np.isclose(output[voxel], expected, atol=1e-6)
+
+    # Processing by slabs gives the same result.
+    imgs = [nib.Nifti1Image(d, np.eye(4)) for d in data]
+    for chunk_size in [1, 4]:
+        chunked = neighborhood_correlation_(imgs, patch_radius=2,
+                                            chunk_size=chunk_size)
+        assert_allclose(chunked, output, atol=1e-6)
+
+
 def test_dilation():
     img_data = np.array([0, 1]).astype(float)
     affine = np.eye(4)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import nibabel as nib
+import numpy as np
+from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
+
+from scilpy.image.volume_space_management import (DataVolume,
+                                                  FibertubeDataVolume,
+                                                  FTODFDataVolume)
+
+
+def _get_points(rng, dim, voxres, nb_points=200):
+    # Including points out of bound, on all sides.
+    return (rng.random((nb_points, 3)) * (np.asarray(dim) + 4) - 2) * voxres
+
+
+def test_get_values_at_coordinates():
+    rng = np.random.default_rng(0)
+    voxres = np.array([2., 1., 0.5])
+
+    for data in [rng.random((4, 5, 6)), rng.random((4, 5, 6, 3))]:
+        for interpolation in ['nearest', 'trilinear']:
+            volume = DataVolume(data, voxres, interpolation)
+            for origin in [Origin('center'), Origin('corner')]:
+                points = _get_points(rng, data.shape[:3], voxres)
+                for space, scale in [(Space.VOXMM, 1), (Space.VOX, voxres)]:
+                    values = volume.get_values_at_coordinates(
+                        points / scale, space, origin)
+                    expected = [volume.get_value_at_coordinate(
+                        *(p / scale), space, origin) for p in points]
+                    assert np.allclose(values, expected)
+
+
+def _get_fibertubes():
+    centerlines = [np.array([[1., 1., 1.], [5., 5., 5.], [9., 9., 9.]]),
+                   np.array([[1., 9., 5.], [5., 5., 5.], [9., 1., 5.]]),
+                   np.array([[5., 1., 2.], [5., 9., 2.]])]
+    reference = StatefulTractogram(
+        centerlines, nib.Nifti1Image(np.zeros((10, 10, 10)), np.eye(4)),
+        space=Space.VOXMM, origin=Origin('center'))
+    return centerlines, np.array([0.5, 0.4, 0.8]), reference
+
+
+def test_fibertube_get_values_at_coordinates():
+    centerlines, diameters, reference = _get_fibertubes()
+    # Random points and points close to the fibertubes.
+    rng = np.random.default_rng(0)
+    points = np.concatenate((_get_points(rng, (10, 10, 10), 1, 12),
+                             np.concatenate(centerlines) +
+                             rng.normal(scale=0.3, size=(8, 3))))
+
+    # Same seed: random numbers are drawn in the same order.
+    volume = FibertubeDataVolume(centerlines, diameters, reference, 1.,
+                                 np.random.default_rng(1))
+    values = volume.get_values_at_coordinates(points, Space.VOXMM,
+                                              Origin('center'))
+    volume = FibertubeDataVolume(centerlines, diameters, reference, 1.,
+                                 np.random.default_rng(1))
+    for (dirs, vols), p in zip(values, points):
+        expected_dirs, expected_vols = volume.get_value_at_coordinate(
+            *p, Space.VOXMM, Origin('center'))
+        assert np.allclose(np.reshape(dirs, (-1, 3)),
+                           np.reshape(expected_dirs, (-1, 3)))
+        assert np.allclose(vols, expected_vols)
+
+    volume = FTODFDataVolume(centerlines, diameters, reference, 1.,
+                             np.random.default_rng(1), 'descoteaux07', 4)
+    values = volume.get_values_at_coordinates(points, Space.VOX,
+                                              Origin('center'))
+    assert values.shape == (20, 15)
+    volume = FTODFDataVolume(centerlines, diameters, reference, 1.,
+                             np.random.default_rng(1), 'descoteaux07', 4)
+    expected = [volume.get_value_at_coordinate(*p, Space.VOX,
+                                               Origin('center'))
+                for p in points]
+    assert np.allclose(values, expected)
@@ -21,7 +21,8 @@ import numpy as np
 from numpy.lib import stride_tricks
 from scipy.ndimage import (binary_closing, binary_dilation,
                            binary_erosion, binary_opening,
-                           gaussian_filter)
+                           gaussian_filter, maximum_filter, minimum_filter,
+                           uniform_filter)
 from skimage.filters import threshold_otsu
 
 from scilpy.utils import is_float
@@ -695,44 +696,107 @@ def concatenate(input_list, ref_img):
     return np.rollaxis(np.stack(input_data), axis=0, start=4)
 
 
-def _corrcoef_no_nan(data):
+def _get_correlation_slab(img, start, end):
     """
-    Correlation between two small data arrays, but with our management of NaNs.
+    Loads slices [start:end] (on the first axis) of an image or an array, as
+    float64.
+    """
+    if isinstance(img, nib.Nifti1Image):
+        data = np.asarray(img.dataobj[start:end], dtype=np.float32)
+    else:
+        data = img[start:end]
+    return np.asarray(data, dtype=float)
+
+
+def _get_local_moments(data, patch_radius):
+    """
+    Local statistics of each voxel's neighborhood, used for the correlation.
     See explanation in neighborhood_correlation docstring.
 
     Parameters
     ----------
-    data: np.array of shape (patch_size**3 * 2, )
-        The concatenated, flattened, vectors:
-        [data1_flattened, data2_flattened]
-    """
-    a, b = np.split(data, 2)
+    data: np.ndarray of shape (X, Y, Z)
+        The data, as float64.
+    patch_radius: int
+        Neighborhoods are cubes of size 2 * patch_radius + 1. Data is
+        zero-padded.
+
+    Returns
+    -------
+    mean, std: np.ndarray of shape (X, Y, Z)
+        The mean and standard deviation of each neighborhood.
+    is_background: np.ndarray of shape (X, Y, Z)
+        Whether each neighborhood only contains zeros.
+    is_uniform: np.ndarray of shape (X, Y, Z)
+        Whether each neighborhood has a standard deviation < 1e-6.
+    """
+    size = 2 * patch_radius + 1
     eps = 1e-6
 
+    # Separable box filters: sums over the neighborhoods, in O(1) per voxel
+    # whatever the radius.
+    mean = uniform_filter(data, size, mode='constant')
+    var = uniform_filter(data ** 2, size, mode='constant') - mean ** 2
+    std = np.sqrt(np.maximum(var, 0))
+
+    # Comparing with half of a voxel, to be robust to rounding errors.
+    is_background = uniform_filter((data != 0).astype(float), size,
+                                   mode='constant') < 0.5 / size ** 3
+
+    # var can suffer from rounding errors for large values. A neighborhood
+    # with a range of 0 is uniform for sure.
+    is_uniform = np.logical_or(
+        std < eps,
+        maximum_filter(data, size, mode='constant') ==
+        minimum_filter(data, size, mode='constant'))
+
+    return mean, std, is_background, is_uniform
+
+
+def _local_correlation(data_1, moments_1, data_2, moments_2, patch_radius):
+    """
+    Correlation between the neighborhoods of each voxel of two data arrays,
+    with our management of NaNs. See explanation in neighborhood_correlation
+    docstring.
+
+    Parameters
+    ----------
+    data_1, data_2: np.ndarray of shape (X, Y, Z)
+        The data, as float64.
+    moments_1, moments_2: tuple
+        The output of _get_local_moments for each data.
+    patch_radius: int
+        Neighborhoods are cubes of size 2 * patch_radius + 1.
+
+    Returns
+    -------
+    corr: np.ndarray of shape (X, Y, Z)
+        The correlation map.
+    """
+    size = 2 * patch_radius + 1
+    mean_1, std_1, is_background_1, is_uniform_1 = moments_1
+    mean_2, std_2, is_background_2, is_uniform_2 = moments_2
+
+    cov = uniform_filter(data_1 * data_2, size, mode='constant')
+    cov -= mean_1 * mean_2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.clip(cov / (std_1 * std_2), -1, 1)
+
     # If, in at least one patch, all values are the same, we get NaN.
     # Ex: compare a patch of ones with a patch of twos:
     # >> np.corrcoef(np.ones(27), 2*np.ones(27))
     # We chose to return:
     # - 0 if at least one neighborhood was entirely containing background
-    #  (note that here, we will never have both backgrounds because of the
-    #  indices in the function call, but it is still covered)
+    #  (also if the sum of both neighborhoods is 0).
     # - 1 if the voxel's neighborhoods are uniform in both images (ex, uniform
     #  gray matter in both images).
     # - 0 if the voxel's neighborhoods is uniform in one image, but not the
     # other (ex, uniform gray matter in a, noisy gray matter in b).
-    is_background_a = not np.any(a)
-    is_background_b = not np.any(b)
-    if is_background_a or is_background_b:
-        return 0.0
-    if np.std(a) < eps and np.std(b) < eps:
-        # Both uniform and non-background
-        return 1.0
-    elif np.std(a) < eps or np.std(b) < eps:
-        # Only one is uniform
-        return 0.0
-
-    # If we reach here, corrcoef should not return a NaN
-    corr = np.corrcoef(a, b, dtype=np.float32)[0, 1]
+    corr[np.logical_or(is_uniform_1, is_uniform_2)] = 0
+    corr[np.logical_and(is_uniform_1, is_uniform_2)] = 1
+    is_sum_zero = np.abs(mean_1 + mean_2) * size ** 3 <= 1e-6
+    corr[is_background_1 | is_background_2 | is_sum_zero] = 0
+
     return corr
 
 
@@ -766,63 +830,51 @@ def neighborhood_correlation(input_list, ref_img):
     return neighborhood_correlation_(input_list)
 
 
-def neighborhood_correlation_(input_list):
+def neighborhood_correlation_(input_list, patch_radius=1, chunk_size=None):
     """
     Same as above (neighborhood_correlation) but without the verifications
     required for scil_volume_math.py.
 
     input_list can be a list of images or a list of arrays.
+
+    Local means, variances and covariances are computed with separable box
+    filters, so larger neighborhoods (patch_radius) are as fast as 3x3x3.
+    With many input images, use chunk_size to process the volume by slabs
+    of chunk_size slices (on the first axis): only these slices of all
+    images are loaded at once.
     """
     data_shape = input_list[0].shape
     combs = list(combinations(range(len(input_list)), r=2))
-    all_corr = np.zeros(data_shape + (len(combs),), dtype=np.float32)
-
-    patch_radius = 1  # Using a 3x3x3 neighborhood. Slow enough as it is.
-    patch_size = 2 * patch_radius + 1
-    np.random.seed(0)
-
-    # For each pair of input images:
-    # Possibly loads images twice. Other option is to load all images in
-    # memory at once.
-    for i, comb in enumerate(combs):
-        logging.debug("Computing correlation map for one pair of input "
-                      "images.")
-        img_1 = input_list[comb[0]]
-        img_2 = input_list[comb[1]]
-
-        if isinstance(img_1, nib.Nifti1Image):
-            data_1 = img_1.get_fdata(dtype=np.float32)
-        else:
-            data_1 = img_1
-        if isinstance(img_2, nib.Nifti1Image):
-            data_2 = img_2.get_fdata(dtype=np.float32)
-        else:
-            data_2 = img_2
-
-        patches_1 = _get_neighbors(data_1, patch_radius)
-        patches_2 = _get_neighbors(data_2, patch_radius)
-
-        patches_shape = patches_1.shape
-        nb_patches = np.prod(patches_shape[0:3])
-
-        patches_1 = patches_1.reshape((nb_patches, patch_size ** 3))
-        patches_2 = patches_2.reshape((nb_patches, patch_size ** 3))
-        patches = np.concatenate((patches_1, patches_2), axis=-1)
-
-        # Removing union of background from data. Already managed in the
-        # _corrcoef_no_nan method, but accelerating the process
-        non_zeros_patches = np.sum(patches, axis=-1)
-        non_zeros_ids = np.where(np.abs(non_zeros_patches) > 1e-6)[0]
-
-        results = np.zeros((len(patches)), dtype=np.float32)
-
-        tmp = np.apply_along_axis(
-            _corrcoef_no_nan, axis=1, arr=patches[non_zeros_ids, :])
-        results[non_zeros_ids] = tmp
-
-        all_corr[..., i] = results.reshape(patches_shape[0:3])
-
-    return np.mean(all_corr, axis=-1)
+    if chunk_size is None:
+        chunk_size = data_shape[0]
+
+    mean_corr = np.zeros(data_shape, dtype=np.float32)
+    for start in range(0, data_shape[0], chunk_size):
+        end = min(start + chunk_size, data_shape[0])
+
+        # Slabs are padded with the neighboring slices; zero-padding on the
+        # borders of the image.
+        padded_start = max(start - patch_radius, 0)
+        padded_end = min(end + patch_radius, data_shape[0])
+        crop = slice(start - padded_start, end - padded_start)
+
+        all_data = [_get_correlation_slab(img, padded_start, padded_end)
+                    for img in input_list]
+        all_moments = [_get_local_moments(data, patch_radius)
+                       for data in all_data]
+
+        # For each pair of input images:
+        sum_corr = np.zeros((end - start,) + data_shape[1:])
+        for i, j in combs:
+            logging.debug("Computing correlation map for one pair of input "
+                          "images.")
+            sum_corr += _local_correlation(all_data[i], all_moments[i],
+                                           all_data[j], all_moments[j],
+                                           patch_radius)[crop]
+
+        mean_corr[start:end] = sum_corr / len(combs)
+
+    return mean_corr
 
 
 def dilation(input_list, ref_img):
@@ -105,6 +105,104 @@ class DataVolume(object):
             raise NotImplementedError("We have not prepared the DataVolume to "
                                       "work in RASMM space yet.")
 
+    def get_values_at_coordinates(self, points, space, origin):
+        """
+        Get the voxel values at N coordinates in the dataset. Vectorized
+        equivalent of get_value_at_coordinate.
+
+        If the coordinates are out of bound, the nearest voxel value is taken.
+
+        Parameters
+        ----------
+        points: ndarray (N, 3)
+            Voxel coordinates.
+        space: dipy Space
+            'vox' or 'voxmm'.
+        origin: dipy Origin
+            'corner' or 'center'.
+
+        Return
+        ------
+        values: ndarray (N, self.dim[-1]) or (N, )
+            The values evaluated at each point. If the last dimension is of
+            length 1, returns one scalar value per point.
+        """
+        points = np.array(points, dtype=np.float64).reshape((-1, 3))
+        if space == Space.VOX:
+            return self._vox_to_values(points, origin)
+        elif space == Space.VOXMM:
+            return self._vox_to_values(points / np.asarray(self.voxres[:3]),
+                                       origin)
+        else:
+            raise NotImplementedError("We have not prepared the DataVolume to "
+                                      "work in RASMM space yet.")
+
+    def are_coordinates_in_bound(self, points, space, origin):
+        """
+        Test if N coordinates are in dataset range. Vectorized equivalent of
+        is_coordinate_in_bound.
+
+        Parameters
+        ----------
+        points: ndarray (N, 3)
+            Voxel coordinates.
+        space: dipy Space
+            'vox' or 'voxmm'.
+        origin: dipy Origin
+            'corner' or 'center'.
+
+        Return
+        ------
+        out: ndarray (N, ) of bools
+            True for each point in dataset range, False otherwise.
+        """
+        points = np.array(points, dtype=np.float64).reshape((-1, 3))
+        if space == Space.VOX:
+            return self._are_vox_in_bound(points, origin)
+        elif space == Space.VOXMM:
+            return self._are_vox_in_bound(
+                points / np.asarray(self.voxres[:3]), origin)
+        else:
+            raise NotImplementedError("We have not prepared the DataVolume to "
+                                      "work in RASMM space yet.")
+
+    def get_interpolation_neighbours(self, points, space, origin):
+        """
+        Get, for N coordinates, the voxels used to interpolate the data and
+        their interpolation weights. With the nearest interpolation, this is
+        the closest voxel (weight 1). With trilinear interpolation, these are
+        the 8 surrounding voxels.
+
+        If the coordinates are out of bound, they are clipped to the border,
+        as in get_values_at_coordinates.
+
+        Parameters
+        ----------
+        points: ndarray (N, 3)
+            Voxel coordinates.
+        space: dipy Space
+            'vox' or 'voxmm'.
+        origin: dipy Origin
+            'corner' or 'center'.
+
+        Return
+        ------
+        idx: ndarray (N, M, 3)
+            Indices of the voxels used for each point. M = 1 for the nearest
+            interpolation, M = 8 for trilinear interpolation.
+        weights: ndarray (N, M)
+            Interpolation weight of each voxel.
+        """
+        points = np.array(points, dtype=np.float64).reshape((-1, 3))
+        if space == Space.VOX:
+            return self._vox_to_neighbours(points, origin)
+        elif space == Space.VOXMM:
+            return self._vox_to_neighbours(
+                points / np.asarray(self.voxres[:3]), origin)
+        else:
+            raise NotImplementedError("We have not prepared the DataVolume to "
+                                      "work in RASMM space yet.")
+
     def is_idx_in_bound(self, i, j, k):
         """
         Test if voxel is in dataset range.
@@ -269,6 +367,109 @@ class DataVolume(object):
             raise Exception("No interpolation method was given, cannot run "
                             "this method..")
 
+    def _vox_to_values(self, points, origin):
+        """
+        Vectorized equivalent of _vox_to_value, for points (N, 3) in voxel
+        space. Gives the same values as dipy's nearestneighbor_interpolate and
+        trilinear_interpolate4d (same operations, in the same order), but for
+        all points at once.
+        """
+        idx, weights = self._vox_to_neighbours(points, origin)
+
+        if self.interpolation == 'nearest':
+            result = self.data[idx[:, 0, 0], idx[:, 0, 1], idx[:, 0, 2]]
+        else:
+            result = np.zeros((len(points), self.data.shape[-1]))
+            for c in range(idx.shape[1]):
+                result += weights[:, c, None] * self.data[idx[:, c, 0],
+                                                          idx[:, c, 1],
+                                                          idx[:, c, 2]]
+
+        if result.shape[-1] == 1:
+            return result[:, 0]
+        return result
+
+    def _vox_to_neighbours(self, points, origin):
+        """
+        Get the voxels used to interpolate the data at points (N, 3) in voxel
+        space, and their interpolation weights. Points out of bound are
+        clipped, as in _clip_vox_to_bound.
+
+        Return
+        ------
+        idx: ndarray (N, M, 3)
+            Indices of the voxels used for each point. M = 1 for the nearest
+            interpolation, M = 8 for trilinear interpolation.
+        weights: ndarray (N, M)
+            Interpolation weight of each voxel.
+        """
+        if self.interpolation is None:
+            raise Exception("No interpolation method was given, cannot run "
+                            "this method..")
+
+        # Checking if out of bound.
+        points = self._clip_vox_to_bounds(points, origin)
+
+        # Dipy works with origin center.
+        if origin == Origin('corner'):
+            points = points - 0.5
+
+        if self.interpolation == 'nearest':
+            idx = np.round(points).astype(int)[:, None, :]
+            return idx, np.ones((len(points), 1))
+
+        # Trilinear. Neighbours are clipped to the volume at the borders.
+        flr = np.floor(points)
+        rem = points - flr
+        flr = flr.astype(int)
+        dim = np.asarray(self.dim[0:3])
+        index = (np.maximum(flr, 0), np.minimum(flr + 1, dim - 1))
+        weight = (1 - rem, rem)
+        idx = np.zeros((len(points), 8, 3), dtype=int)
+        weights = np.zeros((len(points), 8))
+        c = 0
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    idx[:, c] = np.stack((index[i][:, 0], index[j][:, 1],
+                                          index[k][:, 2]), axis=1)
+                    weights[:, c] = (weight[i][:, 0] * weight[j][:, 1] *
+                                     weight[k][:, 2])
+                    c += 1
+        return idx, weights
+
+    def _clip_vox_to_bounds(self, points, origin):
+        """
+        Vectorized equivalent of _clip_vox_to_bound, for points (N, 3) in
+        voxel space. Only the points out of bound are clipped.
+        """
+        out = ~self._are_vox_in_bound(points, origin)
+        if np.any(out):
+            eps = float(1e-8)  # Epsilon to exclude upper borders
+            if origin == Origin('corner'):
+                low = 0
+            elif origin == Origin('center'):
+                low = -0.5
+            else:
+                raise ValueError("Origin should be 'center' or 'corner'.")
+            high = np.asarray(self.dim[0:3]) + low - eps
+            points = points.copy()
+            points[out] = np.maximum(low, np.minimum(high, points[out]))
+        return points
+
+    def _are_vox_in_bound(self, points, origin):
+        """
+        Vectorized equivalent of _is_vox_in_bound, for points (N, 3) in voxel
+        space.
+        """
+        if origin == Origin('corner'):
+            idx = np.floor(points)
+        elif origin == Origin('center'):
+            idx = np.floor(points + 0.5)
+        else:
+            raise ValueError("Origin must be 'center' or 'corner'.")
+        return np.all((idx >= 0) & (idx < np.asarray(self.dim[0:3])), axis=1)
+
     def _is_vox_in_bound(self, x, y, z, origin):
         """
         Test if voxel is in dataset range.
@@ -367,7 +568,7 @@ class DataVolume(object):
         value: bool
             True if position is in dataset range and false otherwise.
         """
-        return self.is_idx_in_bound(*self.voxmm_to_idx(x, y, z, origin))
+        return self.is_idx_in_bound(*self.vox_to_idx(x, y, z, origin))
 
 
 class FibertubeDataVolume(DataVolume):
@@ -446,6 +647,32 @@ class FibertubeDataVolume(DataVolume):
             raise NotImplementedError("We have not prepared the DataVolume "
                                       "to work in RASMM space yet.")
 
+    def get_values_at_coordinates(self, points, space, origin):
+        """
+        Vectorized equivalent of get_value_at_coordinate: the close-by
+        segments of all points are found with a single query of the tree.
+
+        Return
+        ------
+        values: list
+            The (directions, volumes) at each point.
+        """
+        FibertubeDataVolume._validate_origin(origin)
+        points = np.array(points, dtype=np.float64).reshape((-1, 3))
+
+        if space == Space.VOX:
+            return self._voxmm_to_values(
+                points * np.asarray(self.voxres[:3]), origin)
+        elif space == Space.VOXMM:
+            return self._voxmm_to_values(points, origin)
+        else:
+            raise NotImplementedError("We have not prepared the DataVolume "
+                                      "to work in RASMM space yet.")
+
+    def get_interpolation_neighbours(self, points, space, origin):
+        raise NotImplementedError("The FibertubeDataVolume is not "
+                                  "interpolated from voxels.")
+
     def is_idx_in_bound(self, i, j, k):
         return super().is_idx_in_bound(i, j, k)
 
@@ -453,6 +680,10 @@ class FibertubeDataVolume(DataVolume):
         FibertubeDataVolume._validate_origin(origin)
         return super().is_coordinate_in_bound(x, y, z, space, origin)
 
+    def are_coordinates_in_bound(self, points, space, origin):
+        FibertubeDataVolume._validate_origin(origin)
+        return super().are_coordinates_in_bound(points, space, origin)
+
     @staticmethod
     def vox_to_idx(x, y, z, origin):
         FibertubeDataVolume._validate_origin(origin)
@@ -507,6 +738,25 @@ class FibertubeDataVolume(DataVolume):
                                        self.data, self.diameters,
                                        self.random_generator)
 
+    def _voxmm_to_values(self, points, origin):
+        """
+        Vectorized equivalent of _voxmm_to_value, for points (N, 3) in mm.
+        """
+        voxres = np.asarray(self.voxres[:3])
+        points = self._clip_vox_to_bounds(points / voxres, origin) * voxres
+
+        all_neighbors = self.tree.query_radius(
+            points,
+            self.blur_radius + self.max_seg_length / 2 + self.max_diameter)
+
+        # Points are processed in order: the random generator is used in the
+        # same way as with successive calls to _voxmm_to_value.
+        return [self.extract_directions(pos, neighbors, self.blur_radius,
+                                        self.segments_indices,
+                                        self.data, self.diameters,
+                                        self.random_generator)
+                for pos, neighbors in zip(points, all_neighbors)]
+
     def get_absolute_direction(self, x, y, z):
         pos = np.array([x, y, z], np.float64)
 
@@ -626,7 +876,18 @@ class FTODFDataVolume(FibertubeDataVolume):
 
     def _voxmm_to_value(self, x, y, z, origin):
         directions, volumes = super()._voxmm_to_value(x, y, z, origin)
+        return self._sf_to_sh(self._directions_to_sf(directions, volumes))
 
+    def _voxmm_to_values(self, points, origin):
+        sf = np.zeros((len(points), len(self.sphere.vertices)))
+        for i, (directions, volumes) in enumerate(
+                super()._voxmm_to_values(points, origin)):
+            sf[i] = self._directions_to_sf(directions, volumes)
+
+        # All points are converted to SH at once.
+        return self._sf_to_sh(sf)
+
+    def _directions_to_sf(self, directions, volumes):
         sf = np.zeros(len(self.sphere.vertices))
 
         if len(directions) != 0:
@@ -640,6 +901,9 @@ class FTODFDataVolume(FibertubeDataVolume):
                 if sf[sph_id] < volumes[dir_id]:
                     sf[sph_id] = volumes[dir_id]
 
+        return sf
+
+    def _sf_to_sh(self, sf):
         return sf_to_sh(sf, self.sphere, sh_order_max=self.sh_order,
                         basis_type=self.sh_basis, full_basis=self.full_basis,
                         smooth=self.smooth, legacy=self.is_legacy)
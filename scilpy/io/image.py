@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from dipy.io.utils import is_header_compatible
+import gzip
 import logging
 import nibabel as nib
 import numpy as np
 import os
+import shutil
 
 from scilpy.utils import is_float
 
@@ -107,3 +109,72 @@ def get_data_as_mask(mask_img, dtype=np.uint8):
                       '--data_type uint8 -f'.format(basename, curr_type))
 
     return data
+
+
+def create_nifti_memmap(filename, shape, dtype, affine):
+    """
+    Create an uncompressed NIfTI file on disk, filled with zeros, and return
+    a writable memmap on its data. This allows writing volumes that do not
+    fit in memory, part by part.
+
+    Parameters
+    ----------
+    filename: str
+        Output filename. Must be an uncompressed NIfTI (.nii).
+    shape: tuple
+        Shape of the data.
+    dtype: str or np.dtype
+        Data type of the data.
+    affine: np.ndarray (4, 4)
+        Affine of the image.
+
+    Return
+    ------
+    data: np.memmap
+        Writable data of the file. Call data.flush() (or delete it) once
+        done writing.
+    """
+    if not filename.endswith('.nii'):
+        raise ValueError('Can only create memmaps for uncompressed NIfTI '
+                         'files (.nii). Got {}.'.format(filename))
+
+    # Same header as nib.Nifti1Image(data, affine) would create.
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code='unknown')
+    header.set_sform(affine, code='aligned')
+    header.set_xyzt_units('mm')
+
+    # Header (348 bytes) and empty extension flag (4 bytes).
+    offset = 352
+    header.set_data_offset(offset)
+
+    dtype = header.get_data_dtype()
+    nb_bytes = int(np.prod(shape)) * dtype.itemsize
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.truncate(offset + nb_bytes)
+
+    # NIfTI data is stored in Fortran order.
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=offset,
+                     shape=tuple(shape), order='F')
+
+
+def gzip_nifti(in_filename, out_filename):
+    """
+    Compress a .nii file into a .nii.gz file, without loading it in memory.
+    The input file is removed.
+
+    Parameters
+    ----------
+    in_filename: str
+        Input .nii file.
+    out_filename: str
+        Output .nii.gz file.
+    """
+    with open(in_filename, 'rb') as f_in, \
+            gzip.open(out_filename, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(in_filename)
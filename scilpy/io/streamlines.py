@@ -8,6 +8,7 @@ import tempfile
 from dipy.io.streamline import load_tractogram
 from dipy.io.streamline import save_tractogram as _save_tractogram
 from dipy.io.utils import is_header_compatible
+from dipy.tracking.streamlinespeed import set_number_of_points
 import nibabel as nib
 from nibabel.streamlines.array_sequence import ArraySequence
 import numpy as np
@@ -302,6 +303,72 @@ def streamlines_to_memmap(input_streamlines,
     return tmp_dir, (data_filename, offsets_filename, lengths_filename)
 
 
+def resampled_streamlines_to_memmap(input_streamlines, filename,
+                                    nb_points=12, strs_dtype='float16',
+                                    chunk_size=100000):
+    """
+    Function to resample all streamlines to the same number of points and
+    save them on disk, as an array of shape (nb_streamlines, nb_points, 3).
+    Contrary to streamlines_to_memmap, any subset of streamlines can then be
+    read with simple indexing, without reconstructing them one by one.
+
+    Parameters
+    ----------
+    input_streamlines : ArraySequence
+        All streamlines of the tractogram.
+    filename : str
+        Filename of the memmap.
+    nb_points : int
+        Number of points of the resampled streamlines.
+    strs_dtype : str
+        Data type of the memmap.
+    chunk_size : int
+        Number of streamlines resampled at once.
+
+    Returns
+    -------
+    shape : tuple
+        Shape of the memmap, needed to read it
+        (see resampled_streamlines_from_memmap).
+    """
+    shape = (len(input_streamlines), nb_points, 3)
+    data = np.memmap(filename, dtype=strs_dtype, mode='w+', shape=shape)
+    for start in range(0, len(input_streamlines), chunk_size):
+        chunk = input_streamlines[start:start + chunk_size]
+        data[start:start + len(chunk)] = set_number_of_points(
+            [np.asarray(s, dtype=np.float32) for s in chunk], nb_points)
+    data.flush()
+    del data
+
+    return shape
+
+
+def resampled_streamlines_from_memmap(filename, shape, indices=None,
+                                      strs_dtype='float16'):
+    """
+    Function to read resampled streamlines saved with
+    resampled_streamlines_to_memmap.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the memmap.
+    shape : tuple
+        Shape of the memmap (nb_streamlines, nb_points, 3).
+    indices : list
+        List of int representing the indices to read.
+
+    Returns
+    -------
+    streamlines : np.ndarray
+        Array of shape (len(indices), nb_points, 3), as float32.
+    """
+    data = np.memmap(filename, dtype=strs_dtype, mode='r', shape=shape)
+    if indices is None:
+        return np.asarray(data, dtype=np.float32)
+    return np.asarray(data[np.asarray(indices)], dtype=np.float32)
+
+
 def reconstruct_streamlines_from_memmap(memmap_filenames, indices=None,
                                         strs_dtype='float32'):
     """
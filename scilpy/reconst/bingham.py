@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import itertools
 import multiprocessing
 
 from math import cos, radians
@@ -10,6 +9,7 @@ import numpy as np
 from dipy.direction import peak_directions
 from dipy.reconst.shm import sh_to_sf_matrix
 from scilpy.reconst.utils import get_sh_order_and_fullness
+from scilpy.utils.parallel import parallel_map_on_rows
 
 
 # Constants
@@ -181,46 +181,26 @@ def bingham_fit_sh(sh, max_lobes=5, abs_th=0.,
         or nbr_processes > multiprocessing.cpu_count() \
         else nbr_processes
 
-    if mask is not None:
-        sh = sh[mask]
-    else:
-        sh = sh.reshape((-1, shape[-1]))
-
-    sh = np.array_split(sh, nbr_processes)
-    pool = multiprocessing.Pool(nbr_processes)
-    out = pool.map(_bingham_fit_sh_chunk, zip(sh, itertools.repeat(B_mat),
-                                              itertools.repeat(sphere),
-                                              itertools.repeat(abs_th),
-                                              itertools.repeat(min_sep_angle),
-                                              itertools.repeat(rel_th),
-                                              itertools.repeat(max_lobes),
-                                              itertools.repeat(max_fit_angle)))
-    pool.close()
-    pool.join()
-
-    out = np.concatenate(out, axis=0)
-    if mask is not None:
-        bingham = np.zeros(shape[:3] + (max_lobes, NB_PARAMS))
-        bingham[mask] = out
-        return bingham
-
-    out = out.reshape(shape[:3] + (max_lobes, NB_PARAMS))
-    return out
-
-
-def _bingham_fit_sh_chunk(args):
+    if mask is None:
+        mask = np.ones(shape[:3], dtype=bool)
+
+    bingham = np.zeros(shape[:3] + (max_lobes, NB_PARAMS))
+    with parallel_map_on_rows(
+            _bingham_fit_sh_chunk, [sh], [((max_lobes, NB_PARAMS), float)],
+            nbr_processes=nbr_processes,
+            func_args=(B_mat, sphere, abs_th, min_sep_angle, rel_th,
+                       max_lobes, max_fit_angle),
+            mask=mask) as ((out,), _):
+        bingham[mask] = out.array
+
+    return bingham
+
+
+def _bingham_fit_sh_chunk(sh_chunk, B_mat, sphere, abs_th, min_sep_angle,
+                          rel_th, max_lobes, max_angle):
     """
     Fit Bingham functions on a (N, ncoeffs) chunk taken from a SH field.
     """
-    sh_chunk = args[0]
-    B_mat = args[1]
-    sphere = args[2]
-    abs_th = args[3]
-    min_sep_angle = args[4]
-    rel_th = args[5]
-    max_lobes = args[6]
-    max_angle = args[7]
-
     out = np.zeros((len(sh_chunk), max_lobes, NB_PARAMS))
     for i, sh in enumerate(sh_chunk):
         odf = sh.dot(B_mat)
@@ -232,7 +212,7 @@ def _bingham_fit_sh_chunk(args):
             for ll in range(min(len(lobes), max_lobes)):
                 lobe = lobes[ll]
                 out[i, ll, :] = lobe.get_flatten()
-    return out
+    return (out,)
 
 
 def _bingham_fit_multi_peaks(odf, sphere, max_angle,
@@ -387,40 +367,25 @@ def compute_fiber_density(bingham, m=50, mask=None, nbr_processes=None):
         or nbr_processes > multiprocessing.cpu_count() \
         else nbr_processes
 
-    if mask is not None:
-        bingham = bingham[mask]
-
-    bingham = bingham.reshape((-1, np.prod(shape[-2:])))
-    bingham = np.array_split(bingham, nbr_processes)
-    pool = multiprocessing.Pool(nbr_processes)
-    res = pool.map(_compute_fiber_density_chunk,
-                   zip(bingham,
-                       itertools.repeat(coords),
-                       itertools.repeat(dphi),
-                       itertools.repeat(dtheta)))
-    pool.close()
-    pool.join()
-
-    res = np.concatenate(res, axis=0)
-    nbr_lobes = shape[-2]
+    if mask is None:
+        mask = np.ones(shape[:3], dtype=bool)
 
-    if mask is not None:
-        fd = np.zeros(shape[:3] + (nbr_lobes,))
-        fd[mask] = res
-        return fd
+    nbr_lobes = shape[-2]
+    fd = np.zeros(shape[:3] + (nbr_lobes,))
+    with parallel_map_on_rows(
+            _compute_fiber_density_chunk,
+            [bingham.reshape(shape[:3] + (-1,))], [((nbr_lobes,), float)],
+            nbr_processes=nbr_processes, func_args=(coords, dphi, dtheta),
+            mask=mask) as ((res,), _):
+        fd[mask] = res.array
 
-    res = np.reshape(np.array(res), shape[:3] + (nbr_lobes,))
-    return res
+    return fd
 
 
-def _compute_fiber_density_chunk(args):
+def _compute_fiber_density_chunk(binghams_chunk, coords, dphi, dtheta):
     """
     Compute fiber density for a chunk taken from a Bingham volume.
     """
-    binghams_chunk = args[0]
-    coords = args[1]
-    dphi = args[2]
-    dtheta = args[3]
     theta = coords[1]
     u = np.array([np.cos(coords[0]) * np.sin(coords[1]),
                   np.sin(coords[0]) * np.sin(coords[1]),
@@ -435,7 +400,7 @@ def _compute_fiber_density_chunk(args):
             if lobe.f0 > 0:
                 fd = np.sum(lobe.evaluate(u) * np.sin(theta) * dtheta * dphi)
                 out[i, lobe_i] = fd
-    return out
+    return (out,)
 
 
 def compute_fiber_spread(binghams, fd):
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
-import itertools
+import copy
 import logging
-import multiprocessing
+import numbers
 import numpy as np
 
 from dipy.data import get_sphere
@@ -10,6 +10,7 @@ from dipy.reconst.multi_voxel import MultiVoxelFit
 from dipy.reconst.shm import sh_to_sf_matrix
 
 from scilpy.reconst.utils import find_order_from_nb_coeff
+from scilpy.utils.parallel import parallel_map_on_rows
 
 from dipy.utils.optpkg import optional_package
 cvx, have_cvxpy, _ = optional_package("cvxpy")
@@ -125,33 +126,117 @@ def get_ventricles_max_fodf(data, fa, md, zoom, sh_basis,
     return sum_of_max / count, mask
 
 
-def _fit_from_model_parallel(args):
-    (model, data, chunk_id) = args
-    sub_fit_array = _fit_from_model_loop(data, model)
+def _fit_voxel(model, voxel_data):
+    """
+    Fits the model on one voxel. If the solver fails, returns a fit with NaN
+    coefficients.
+    """
+    try:
+        return model.fit(voxel_data)
+    except cvx.error.SolverError:
+        coeff = np.full((len(model.n)), np.NaN)
+        return MSDeconvFit(model, coeff, None)
+
+
+def _get_fit_layout(fit, model):
+    """
+    Splits the state (__dict__) of a fit in its numeric attributes, which
+    can be written in shared memory, and its other attributes (ex, the model
+    itself), which should be the same for all voxels.
+
+    Returns
+    -------
+    attributes: list of str
+        Names of the numeric attributes.
+    shapes: list of tuple
+        Their shape.
+    dtypes: list of np.dtype
+        Their dtype.
+    others: dict
+        The other attributes, except the model.
+    model_keys: list of str
+        Names of the attributes that are the model.
+    """
+    attributes, shapes, dtypes = [], [], []
+    others = {}
+    model_keys = []
+    for key, value in vars(fit).items():
+        if value is model:
+            model_keys.append(key)
+        elif isinstance(value, (np.ndarray, numbers.Number)):
+            attributes.append(key)
+            shapes.append(np.shape(value))
+            dtypes.append(np.asarray(value).dtype)
+        else:
+            others[key] = value
+    return attributes, shapes, dtypes, others, model_keys
+
 
-    return chunk_id, sub_fit_array
+def _has_fit_layout(fit, model, fit_type, attributes, shapes, dtypes, others,
+                    model_keys):
+    """
+    Whether a fit can be rebuilt from its numeric attributes and the other
+    attributes of the first fit (see _get_fit_layout).
+    """
+    state = vars(fit)
+    if type(fit) is not fit_type or \
+            len(state) != len(attributes) + len(others) + len(model_keys):
+        return False
+    for key in model_keys:
+        if state.get(key, None) is not model:
+            return False
+    for key, shape, dtype in zip(attributes, shapes, dtypes):
+        if key not in state or np.shape(state[key]) != shape or \
+                not np.can_cast(np.asarray(state[key]).dtype, dtype):
+            return False
+    for key, value in others.items():
+        if key not in state:
+            return False
+        if state[key] is not value:
+            try:
+                if type(state[key]) is not type(value) or \
+                        not np.array_equal(state[key], value):
+                    return False
+            except (TypeError, ValueError):
+                return False
+    return True
 
 
-def _fit_from_model_loop(data, model):
+def _fit_from_model_loop(data, model, fit_type, attributes, shapes, dtypes,
+                         others, model_keys):
     """
-    Loops on 2D data and fits each voxel separately.
+    Loops on 2D data and fits each voxel separately. The numeric attributes
+    of the fits are written in arrays. Fits that can not be rebuilt from them
+    (see _has_fit_layout) are returned as is.
     See fit_from_model for more information.
     """
     # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
-    tmp_fit_array = np.zeros((data.shape[0],), dtype='object')
+    states = [np.zeros((data.shape[0],) + shape, dtype=dtype)
+              for shape, dtype in zip(shapes, dtypes)]
+    is_fitted = np.zeros((data.shape[0],), dtype=bool)
+    other_fits = []
     for i in range(data.shape[0]):
         if data[i].any():
-            try:
-                tmp_fit_array[i] = model.fit(data[i])
-            except cvx.error.SolverError:
-                coeff = np.full((len(model.n)), np.NaN)
-                tmp_fit_array[i] = MSDeconvFit(model, coeff, None)
-    return tmp_fit_array
+            fit = _fit_voxel(model, data[i])
+            if _has_fit_layout(fit, model, fit_type, attributes, shapes,
+                               dtypes, others, model_keys):
+                is_fitted[i] = True
+                for attribute, state in zip(attributes, states):
+                    state[i] = vars(fit)[attribute]
+            else:
+                other_fits.append((i, fit))
+    return (*states, is_fitted, data.shape[0], other_fits)
 
 
 def fit_from_model(model, data, mask=None, nbr_processes=None):
     """Fit the model to data. Can use parallel processing.
 
+    The fits are objects: they are not sent back from the processes. Each
+    process writes the numeric attributes of its fits (ex, their
+    coefficients) in shared memory, and the fits are rebuilt here, sharing
+    their other attributes (ex, the model) with the first fit. Only the fits
+    whose attributes do not follow the first fit are sent back as is.
+
     Parameters
     ----------
     model : a model instance
@@ -181,44 +266,135 @@ def fit_from_model(model, data, mask=None, nbr_processes=None):
         mask_any = np.sum(data, axis=3).astype(bool)
         mask *= mask_any
 
-    nbr_processes = multiprocessing.cpu_count() \
-        if nbr_processes is None or nbr_processes <= 0 \
-        else nbr_processes
-
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels. Then separate it in chunks of len(nbr_processes).
-    data = data[mask].reshape((np.count_nonzero(mask), data_shape[3]))
-
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        tmp_fit_array = _fit_from_model_loop(data, model)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        chunks = np.array_split(data, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_fit_from_model_parallel,
-                           zip(itertools.repeat(model),
-                               chunks,
-                               np.arange(len(chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunks together.
-        chunk_len = np.cumsum([0] + [len(c) for c in chunks])
-        tmp_fit_array = np.zeros((np.count_nonzero(mask)), dtype='object')
-        for i, fit in results:
-            tmp_fit_array[chunk_len[i]:chunk_len[i+1]] = fit
+    fit_array = np.zeros(data_shape[0:3], dtype='object')
+    if not mask.any():
+        return MultiVoxelFit(model, fit_array, mask)
+
+    # Fitting a first voxel to know the attributes of the fits.
+    first_fit = _fit_voxel(model,
+                           data[np.unravel_index(np.argmax(mask), mask.shape)])
+    layout = _get_fit_layout(first_fit, model)
+    attributes, shapes, dtypes, others, model_keys = layout
+
+    # The voxels of the mask are processed like a list of 1D time series.
+    tmp_fit_array = np.zeros((np.count_nonzero(mask),), dtype='object')
+    with parallel_map_on_rows(
+            _fit_from_model_loop, [data],
+            [(shape, dtype) for shape, dtype in zip(shapes, dtypes)] +
+            [((), bool)],
+            nbr_processes=nbr_processes,
+            func_args=(model, type(first_fit)) + layout,
+            mask=mask) as (outputs, extras):
+        # The fits keep views on a local copy of the attributes.
+        states = [output.array.copy() for output in outputs[:-1]]
+        is_fitted = outputs[-1].array.copy()
+
+    for i in np.flatnonzero(is_fitted):
+        fit = copy.copy(first_fit)
+        for attribute, state in zip(attributes, states):
+            vars(fit)[attribute] = state[i]
+        tmp_fit_array[i] = fit
+
+    # Fits sent back from the processes hold a copy of the model.
+    start = 0
+    for nb_rows, other_fits in extras:
+        for i, fit in other_fits:
+            for key in model_keys:
+                if type(vars(fit).get(key, None)) is type(model):
+                    vars(fit)[key] = model
+            tmp_fit_array[start + i] = fit
+        start += nb_rows
 
     # Bring back to the original shape
-    fit_array = np.zeros(data_shape[0:3], dtype='object')
     fit_array[mask] = tmp_fit_array
     fit_array = MultiVoxelFit(model, fit_array, mask)
 
     return fit_array
 
 
+def _fit_coeffs_from_model_loop(data, model, attributes, shapes, dtype):
+    """
+    Loops on 2D data, fits each voxel separately and only keeps the given
+    attributes of the fits. See fit_coeffs_from_model for more information.
+    """
+    # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
+    coeffs = [np.zeros((data.shape[0],) + shape, dtype=dtype)
+              for shape in shapes]
+    for i in range(data.shape[0]):
+        if data[i].any():
+            fit = _fit_voxel(model, data[i])
+            for attribute, coeff in zip(attributes, coeffs):
+                coeff[i] = getattr(fit, attribute)
+    return tuple(coeffs)
+
+
+def fit_coeffs_from_model(model, data, attributes=('shm_coeff',), mask=None,
+                          nbr_processes=None, dtype=np.float32):
+    """Fit the model to data, keeping only numeric attributes of the fits
+    (ex, their SH coefficients). Can use parallel processing.
+
+    Contrary to fit_from_model, no fit object is kept per voxel: each process
+    writes the attributes of its fits directly in the output arrays, which
+    saves a lot of memory on large masks.
+
+    Parameters
+    ----------
+    model : a model instance
+        It will be used to fit the data.
+        e.g: An instance of
+        dipy.reconst.csdeconv.ConstrainedSphericalDeconvModel.
+    data : np.ndarray (4d)
+        Diffusion data.
+    attributes : list of str, optional
+        Attributes of the fits to keep. They must be numeric arrays of the
+        same shape for all voxels. Ex: 'shm_coeff', or 'all_shm_coeff' and
+        'volume_fractions' for dipy's MultiShellDeconvModel.
+    mask : np.ndarray, optional
+        If `mask` is provided, only the data inside the mask will be
+        used for computations.
+    nbr_processes : int, optional
+        The number of subprocesses to use.
+        Default: multiprocessing.cpu_count()
+    dtype : np.dtype, optional
+        Datatype of the outputs. Default: float32.
+
+    Returns
+    -------
+    coeffs : list of np.ndarray
+        One array of shape (x, y, z, ...) per attribute. Voxels outside the
+        mask are 0. Voxels that could not be solved are NaN (see
+        verify_failed_voxels_shm_coeff).
+    """
+    data_shape = data.shape
+    if mask is None:
+        mask = np.sum(data, axis=3).astype(bool)
+    else:
+        mask = np.logical_and(mask, np.sum(data, axis=3).astype(bool))
+
+    # Fitting a first voxel to know the shape of the attributes.
+    shapes = [()] * len(attributes)
+    if mask.any():
+        fit = _fit_voxel(model,
+                         data[np.unravel_index(np.argmax(mask), mask.shape)])
+        shapes = [np.shape(getattr(fit, attribute))
+                  for attribute in attributes]
+
+    # The voxels of the mask are processed like a list of 1D time series, and
+    # brought back to the original shape.
+    coeffs = [np.zeros(data_shape[0:3] + shape, dtype=dtype)
+              for shape in shapes]
+    with parallel_map_on_rows(
+            _fit_coeffs_from_model_loop, [data],
+            [(shape, dtype) for shape in shapes],
+            nbr_processes=nbr_processes,
+            func_args=(model, attributes, shapes, dtype),
+            mask=mask) as (tmp_coeffs, _):
+        for coeff, tmp_coeff in zip(coeffs, tmp_coeffs):
+            coeff[mask] = tmp_coeff.array
+
+    return coeffs
+
+
 def verify_failed_voxels_shm_coeff(shm_coeff):
     """
     Verifies if there are any NaN in the final coefficients, and if so raises
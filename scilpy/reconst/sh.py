@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
-import itertools
 import logging
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
+
 import numpy as np
 
 from dipy.core.sphere import Sphere
@@ -15,6 +18,8 @@ from scilpy.gradients.bvec_bval_tools import (identify_shells,
                                               normalize_bvecs,
                                               DEFAULT_B0_THRESHOLD)
 from scilpy.dwi.operations import compute_dwi_attenuation
+from scilpy.io.image import create_nifti_memmap, gzip_nifti
+from scilpy.utils.parallel import parallel_map_on_rows
 
 
 def verify_data_vs_sh_order(data, sh_order):
@@ -181,16 +186,69 @@ def compute_rish(sh, mask=None, full_basis=False):
     return rish, orders
 
 
-def _peaks_from_sh_parallel(args):
-    (shm_coeff, B, sphere, relative_peak_threshold,
-     absolute_threshold, min_separation_angle,
-     npeaks, normalize_peaks, chunk_id, is_symmetric) = args
+# Maximal number of values in the intermediate arrays of the blocked matrix
+# products (ex: 2**16 voxels with 64 output values per voxel).
+BLOCK_NB_VALUES = 2 ** 22
+
+
+def _get_block_size(nb_values_per_voxel):
+    """
+    Number of voxels to process at once so that a block holds at most
+    BLOCK_NB_VALUES values.
+    """
+    return max(1, BLOCK_NB_VALUES // nb_values_per_voxel)
+
+
+def _apply_matrix_by_blocks(data, mask, matrix, dtype, block_size=None,
+                            nbr_processes=1):
+    """
+    Computes np.dot(data[mask], matrix) by blocks of voxels, directly in an
+    output volume. Voxels outside the mask are set to 0.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        4D data, of shape (X, Y, Z, N).
+    mask : np.ndarray
+        3D boolean mask, of shape (X, Y, Z).
+    matrix : np.ndarray
+        Matrix of shape (N, M).
+    dtype : str or np.dtype
+        Datatype of the output array.
+    block_size : int, optional
+        Number of voxels per block. Default: see _get_block_size.
+    nbr_processes : int, optional
+        Number of threads computing the blocks. The blocks write to disjoint
+        voxels of the output and np.dot releases the GIL, so nothing is
+        copied between workers. Default: 1.
+
+    Returns
+    -------
+    out : np.ndarray
+        Output volume of shape (X, Y, Z, M).
+    """
+    if block_size is None:
+        block_size = _get_block_size(matrix.shape[1])
+
+    out = np.zeros(data.shape[:3] + (matrix.shape[1],), dtype=dtype)
+    flat_data = data.reshape((-1, data.shape[3]))
+    flat_out = out.reshape((-1, matrix.shape[1]))
+
+    voxels = np.flatnonzero(mask)
+    blocks = [voxels[start:start + block_size]
+              for start in range(0, len(voxels), block_size)]
+
+    def _apply_block(block):
+        flat_out[block] = np.dot(flat_data[block], matrix)
 
-    peak_dirs, peak_values, peak_indices = _peaks_from_sh_loop(
-        shm_coeff, B, sphere, relative_peak_threshold,
-        absolute_threshold, min_separation_angle, npeaks,
-        normalize_peaks, is_symmetric)
-    return chunk_id, peak_dirs, peak_values, peak_indices
+    if nbr_processes is None or nbr_processes <= 1 or len(blocks) <= 1:
+        for block in blocks:
+            _apply_block(block)
+    else:
+        with ThreadPool(min(nbr_processes, len(blocks))) as pool:
+            pool.map(_apply_block, blocks)
+
+    return out
 
 
 def _peaks_from_sh_loop(shm_coeff, B, sphere, relative_peak_threshold,
@@ -207,12 +265,17 @@ def _peaks_from_sh_loop(shm_coeff, B, sphere, relative_peak_threshold,
     peak_indices = np.zeros((data_shape, npeaks), dtype='int')
     peak_indices.fill(-1)
 
-    for idx in range(len(shm_coeff)):
-        if shm_coeff[idx].any():
-            odf = np.dot(shm_coeff[idx], B)
-            odf[odf < absolute_threshold] = 0.
+    block_size = _get_block_size(B.shape[1])
+    for start in range(0, len(shm_coeff), block_size):
+        # The ODFs of a whole block are evaluated in one matrix product.
+        odfs = np.dot(shm_coeff[start:start + block_size], B)
+        odfs[odfs < absolute_threshold] = 0.
+
+        for idx in range(start, start + len(odfs)):
+            if not shm_coeff[idx].any():
+                continue
 
-            dirs, peaks, ind = peak_directions(odf, sphere,
+            dirs, peaks, ind = peak_directions(odfs[idx - start], sphere,
                                                relative_peak_threshold=relative_peak_threshold,
                                                min_separation_angle=min_separation_angle,
                                                is_symmetric=is_symmetric)
@@ -297,74 +360,27 @@ def peaks_from_sh(shm_coeff, sphere, mask=None, relative_peak_threshold=0.5,
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
 
-    nbr_processes = multiprocessing.cpu_count() if nbr_processes is None \
-        or nbr_processes <= 0 else nbr_processes
-
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        (tmp_peak_dirs_array, tmp_peak_values_array,
-         tmp_peak_indices_array) = _peaks_from_sh_loop(
-            shm_coeff, B, sphere, relative_peak_threshold,
-            absolute_threshold, min_separation_angle, npeaks,
-            normalize_peaks, is_symmetric)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        chunks = np.array_split(shm_coeff, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_peaks_from_sh_parallel,
-                           zip(chunks,
-                               itertools.repeat(B),
-                               itertools.repeat(sphere),
-                               itertools.repeat(relative_peak_threshold),
-                               itertools.repeat(absolute_threshold),
-                               itertools.repeat(min_separation_angle),
-                               itertools.repeat(npeaks),
-                               itertools.repeat(normalize_peaks),
-                               np.arange(len(chunks)),
-                               itertools.repeat(is_symmetric)))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together..
-        chunk_len = np.cumsum([0] + [len(c) for c in chunks])
-
-        # tmp arrays are necessary to avoid inserting data in returned variable
-        # rather than the original array
-        tmp_peak_dirs_array = np.zeros((np.count_nonzero(mask), npeaks, 3))
-        tmp_peak_values_array = np.zeros((np.count_nonzero(mask), npeaks))
-        tmp_peak_indices_array = np.zeros((np.count_nonzero(mask), npeaks))
-        for i, peak_dirs, peak_values, peak_indices in results:
-            tmp_peak_dirs_array[chunk_len[i]:chunk_len[i+1], :, :] = peak_dirs
-            tmp_peak_values_array[chunk_len[i]:chunk_len[i+1], :] = peak_values
-            tmp_peak_indices_array[chunk_len[i]:chunk_len[i+1], :] = peak_indices
-
-    # Bring back to the original shape
+    # The voxels of the mask are processed like a list of 1D time series, and
+    # brought back to the original shape.
     peak_dirs_array = np.zeros(data_shape[0:3] + (npeaks, 3))
     peak_values_array = np.zeros(data_shape[0:3] + (npeaks,))
     peak_indices_array = np.zeros(data_shape[0:3] + (npeaks,))
-    peak_dirs_array[mask] = tmp_peak_dirs_array
-    peak_values_array[mask] = tmp_peak_values_array
-    peak_indices_array[mask] = tmp_peak_indices_array
+    with parallel_map_on_rows(
+            _peaks_from_sh_loop, [shm_coeff],
+            [((npeaks, 3), float), ((npeaks,), float), ((npeaks,), int)],
+            nbr_processes=nbr_processes,
+            func_args=(B, sphere, relative_peak_threshold,
+                       absolute_threshold, min_separation_angle, npeaks,
+                       normalize_peaks, is_symmetric),
+            mask=mask) as ((tmp_peak_dirs_array, tmp_peak_values_array,
+                            tmp_peak_indices_array), _):
+        peak_dirs_array[mask] = tmp_peak_dirs_array.array
+        peak_values_array[mask] = tmp_peak_values_array.array
+        peak_indices_array[mask] = tmp_peak_indices_array.array
 
     return peak_dirs_array, peak_values_array, peak_indices_array
 
 
-def _maps_from_sh_parallel(args):
-    (shm_coeff, peak_values, peak_indices, B, sphere,
-     gfa_thr, chunk_id) = args
-
-    res = _maps_from_sh_loop(shm_coeff, peak_values, peak_indices, B,
-                             sphere, gfa_thr)
-    return chunk_id, *res
-
-
 def _maps_from_sh_loop(shm_coeff, peak_values, peak_indices, B, sphere,
                        gfa_thr):
     """
@@ -399,7 +415,7 @@ def _maps_from_sh_loop(shm_coeff, peak_values, peak_indices, B, sphere,
                 nufo_map[idx] = np.sum(peak_indices[idx] > -1)
                 afd_max[idx] = peak_values[idx].max()
                 afd_sum[idx] = np.sqrt(np.dot(shm_coeff[idx], shm_coeff[idx]))
-                qa_map = peak_values[idx] - odf.min()
+                qa_map[idx] = peak_values[idx] - odf.min()
                 global_max = max(global_max, peak_values[idx][0])
 
     return (nufo_map, afd_max, afd_sum, rgb_map,
@@ -448,83 +464,32 @@ def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
 
-    nbr_processes = multiprocessing.cpu_count() \
-        if nbr_processes is None or nbr_processes < 0 \
-        else nbr_processes
-
     npeaks = peak_values.shape[3]
 
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-    peak_values = peak_values[mask].reshape((np.count_nonzero(mask), npeaks))
-    peak_indices = peak_indices[mask].reshape((np.count_nonzero(mask), npeaks))
-
-    if nbr_processes == 1:
-        (tmp_nufo_map_array, tmp_afd_max_array, tmp_afd_sum_array,
-         tmp_rgb_map_array, tmp_gfa_map_array, tmp_qa_map_array,
-         all_time_max_odf, all_time_global_max) = _maps_from_sh_loop(
-            shm_coeff, peak_values, peak_indices,
-            B, sphere, gfa_thr)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        shm_coeff_chunks = np.array_split(shm_coeff, nbr_processes)
-        peak_values_chunks = np.array_split(peak_values, nbr_processes)
-        peak_indices_chunks = np.array_split(peak_indices, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_maps_from_sh_parallel,
-                           zip(shm_coeff_chunks,
-                               peak_values_chunks,
-                               peak_indices_chunks,
-                               itertools.repeat(B),
-                               itertools.repeat(sphere),
-                               itertools.repeat(gfa_thr),
-                               np.arange(len(shm_coeff_chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together.
-        chunk_len = np.cumsum([0] + [len(c) for c in shm_coeff_chunks])
-
-        # tmp arrays are necessary to avoid inserting data in returned variable
-        # rather than the original array
-        tmp_nufo_map_array = np.zeros((np.count_nonzero(mask)))
-        tmp_afd_max_array = np.zeros((np.count_nonzero(mask)))
-        tmp_afd_sum_array = np.zeros((np.count_nonzero(mask)))
-        tmp_rgb_map_array = np.zeros((np.count_nonzero(mask), 3))
-        tmp_gfa_map_array = np.zeros((np.count_nonzero(mask)))
-        tmp_qa_map_array = np.zeros((np.count_nonzero(mask), npeaks))
-
-        all_time_max_odf = -np.inf
-        all_time_global_max = -np.inf
-        for (i, nufo_map, afd_max, afd_sum, rgb_map,
-             gfa_map, qa_map, max_odf, global_max) in results:
-            all_time_max_odf = max(all_time_global_max, max_odf)
-            all_time_global_max = max(all_time_global_max, global_max)
-
-            tmp_nufo_map_array[chunk_len[i]:chunk_len[i+1]] = nufo_map
-            tmp_afd_max_array[chunk_len[i]:chunk_len[i+1]] = afd_max
-            tmp_afd_sum_array[chunk_len[i]:chunk_len[i+1]] = afd_sum
-            tmp_rgb_map_array[chunk_len[i]:chunk_len[i+1], :] = rgb_map
-            tmp_gfa_map_array[chunk_len[i]:chunk_len[i+1]] = gfa_map
-            tmp_qa_map_array[chunk_len[i]:chunk_len[i+1], :] = qa_map
-
-    # Bring back to the original shape
+    # The voxels of the mask are processed like a list of 1D time series, and
+    # brought back to the original shape.
     nufo_map_array = np.zeros(data_shape[0:3])
     afd_max_array = np.zeros(data_shape[0:3])
     afd_sum_array = np.zeros(data_shape[0:3])
     rgb_map_array = np.zeros(data_shape[0:3] + (3,))
     gfa_map_array = np.zeros(data_shape[0:3])
     qa_map_array = np.zeros(data_shape[0:3] + (npeaks,))
-
-    nufo_map_array[mask] = tmp_nufo_map_array
-    afd_max_array[mask] = tmp_afd_max_array
-    afd_sum_array[mask] = tmp_afd_sum_array
-    rgb_map_array[mask] = tmp_rgb_map_array
-    gfa_map_array[mask] = tmp_gfa_map_array
-    qa_map_array[mask] = tmp_qa_map_array
+    with parallel_map_on_rows(
+            _maps_from_sh_loop, [shm_coeff, peak_values, peak_indices],
+            [((), float), ((), float), ((), float), ((3,), float),
+             ((), float), ((npeaks,), float)],
+            nbr_processes=nbr_processes, func_args=(B, sphere, gfa_thr),
+            mask=mask) as ((tmp_nufo_map_array, tmp_afd_max_array,
+                            tmp_afd_sum_array, tmp_rgb_map_array,
+                            tmp_gfa_map_array, tmp_qa_map_array), maxima):
+        nufo_map_array[mask] = tmp_nufo_map_array.array
+        afd_max_array[mask] = tmp_afd_max_array.array
+        afd_sum_array[mask] = tmp_afd_sum_array.array
+        rgb_map_array[mask] = tmp_rgb_map_array.array
+        gfa_map_array[mask] = tmp_gfa_map_array.array
+        qa_map_array[mask] = tmp_qa_map_array.array
+    all_time_max_odf = max(max_odf for max_odf, _ in maxima)
+    all_time_global_max = max(global_max for _, global_max in maxima)
 
     rgb_map_array /= all_time_max_odf
     rgb_map_array *= 255
@@ -539,30 +504,10 @@ def maps_from_sh(shm_coeff, peak_values, peak_indices, sphere,
             rgb_map_array, gfa_map_array, qa_map_array)
 
 
-def _convert_sh_basis_parallel(args):
-    (sh, B_in, invB_out, chunk_id) = args
-    sh = _convert_sh_basis_loop(sh, B_in, invB_out)
-
-    return chunk_id, sh
-
-
-def _convert_sh_basis_loop(sh, B_in, invB_out):
-    """
-    Loops on 2D (ravelled) data and fits each voxel separately.
-    For a more complete description of parameters, see convert_sh_basis.
-    """
-    # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
-    for idx in range(sh.shape[0]):
-        if sh[idx].any():
-            sf = np.dot(sh[idx], B_in)
-            sh[idx] = np.dot(sf, invB_out)
-    return sh
-
-
 def convert_sh_basis(shm_coeff, sphere, mask=None,
                      input_basis='descoteaux07', output_basis='tournier07',
                      is_input_legacy=True, is_output_legacy=False,
-                     nbr_processes=None):
+                     nbr_processes=None, dtype=None):
     """Converts spherical harmonic coefficients between two bases
 
     Parameters
@@ -593,8 +538,10 @@ def convert_sh_basis(shm_coeff, sphere, mask=None,
         ``descoteaux07`` implementations.
         Default: False
     nbr_processes: int, optional
-        The number of subprocesses to use.
-        Default: multiprocessing.cpu_count()
+        The number of threads computing the blocks of voxels. If None, all
+        available cores are used. Default: None
+    dtype : str or np.dtype, optional
+        Datatype of the output array. Default: float64.
 
     Returns
     -------
@@ -612,67 +559,18 @@ def convert_sh_basis(shm_coeff, sphere, mask=None,
     _, invB_out = sh_to_sf_matrix(sphere, sh_order, output_basis,
                                   legacy=is_output_legacy)
 
-    data_shape = shm_coeff.shape
+    # Going to the SF and back to the SH is a single linear operation.
+    conversion_matrix = np.dot(B_in, invB_out)
+
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
+    if dtype is None:
+        dtype = np.float64
+    if nbr_processes is None:
+        nbr_processes = multiprocessing.cpu_count()
 
-    nbr_processes = multiprocessing.cpu_count() \
-        if nbr_processes is None or nbr_processes < 0 else nbr_processes
-
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
-
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        tmp_shm_coeff_array = _convert_sh_basis_loop(shm_coeff, B_in, invB_out)
-    else:
-        # Separate the data in chunks of len(nbr_processes).
-        shm_coeff_chunks = np.array_split(shm_coeff, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_convert_sh_basis_parallel,
-                           zip(shm_coeff_chunks,
-                               itertools.repeat(B_in),
-                               itertools.repeat(invB_out),
-                               np.arange(len(shm_coeff_chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together.
-        chunk_len = np.cumsum([0] + [len(c) for c in shm_coeff_chunks])
-        tmp_shm_coeff_array = np.zeros((np.count_nonzero(mask), data_shape[3]))
-        for i, new_shm_coeff in results:
-            tmp_shm_coeff_array[chunk_len[i]:chunk_len[i+1], :] = new_shm_coeff
-
-    # Bring back to the original shape
-    shm_coeff_array = np.zeros(data_shape)
-    shm_coeff_array[mask] = tmp_shm_coeff_array
-
-    return shm_coeff_array
-
-
-def _convert_sh_to_sf_parallel(args):
-    (sh, B_in, new_output_dim, chunk_id) = args
-    sf = _convert_sh_to_sf_loop(sh, new_output_dim, B_in)
-    return chunk_id, sf
-
-
-def _convert_sh_to_sf_loop(sh, new_output_dim, B_in):
-    """
-    Loops on 2D data and fits each voxel separately.
-    See convert_sh_to_sf for more information.
-    """
-    # Data: Ravelled 4D data. Shape [N, X] where N is the number of voxels.
-    sf = np.zeros((sh.shape[0], new_output_dim), dtype=np.float32)
-
-    for idx in range(sh.shape[0]):
-        if sh[idx].any():
-            sf[idx] = np.dot(sh[idx], B_in)
-
-    return sf
+    return _apply_matrix_by_blocks(shm_coeff, mask, conversion_matrix, dtype,
+                                   nbr_processes=nbr_processes)
 
 
 def convert_sh_to_sf(shm_coeff, sphere, mask=None, dtype="float32",
@@ -703,8 +601,8 @@ def convert_sh_to_sf(shm_coeff, sphere, mask=None, dtype="float32",
     is_input_legacy : bool, optional
         Whether the input basis is in its legacy form.
     nbr_processes: int, optional
-        The number of subprocesses to use.
-        Default: multiprocessing.cpu_count()
+        The number of threads computing the blocks of voxels. If None, all
+        available cores are used. Default: all available cores.
 
     Returns
     -------
@@ -721,44 +619,107 @@ def convert_sh_to_sf(shm_coeff, sphere, mask=None, dtype="float32",
                               legacy=is_input_legacy)
     B_in = B_in.astype(dtype)
 
-    data_shape = shm_coeff.shape
     if mask is None:
         mask = np.sum(shm_coeff, axis=3).astype(bool)
 
-    output_dim = len(sphere.vertices)
-    new_shape = data_shape[:3] + (output_dim,)
+    if nbr_processes is None:
+        nbr_processes = multiprocessing.cpu_count()
+
+    return _apply_matrix_by_blocks(shm_coeff, mask, B_in, dtype,
+                                   nbr_processes=nbr_processes)
+
+
+def convert_sh_to_sf_out_of_core(sh_img, out_filename, sphere, mask=None,
+                                 dtype="float32",
+                                 input_basis='descoteaux07',
+                                 input_full_basis=False, is_input_legacy=True,
+                                 b0_img=None, b0_scaling=False,
+                                 block_size=2 ** 16):
+    """Converts spherical harmonic coefficients to an SF sphere, slab by
+    slab, directly to a file. The input is read through the image's array
+    proxy and the output is written in a memmap, so that the memory used is
+    bounded by the block size, not by the volume's size.
+
+    Parameters
+    ----------
+    sh_img : nib.Nifti1Image
+        Spherical harmonic coefficients image. Its data is not loaded.
+    out_filename : str
+        Output SF filename (.nii or .nii.gz). With .nii.gz, the volume is
+        first written uncompressed in the same directory, then compressed.
+    sphere : Sphere
+        The Sphere providing discrete directions for evaluation.
+    mask : np.ndarray, optional
+        If `mask` is provided, only the data inside the mask will be
+        used for computations. Default: voxels with non-zero SH.
+    dtype : str
+        Datatype to use for computation and output array.
+        Either `float32` or `float64`. Default: `float32`
+    input_basis : str, optional
+        Type of spherical harmonic basis used for the SH. Either
+        `descoteaux07` or `tournier07`.
+        Default: `descoteaux07`
+    input_full_basis : bool, optional
+        If True, use a full SH basis (even and odd orders) for the input SH
+        coefficients.
+    is_input_legacy : bool, optional
+        Whether the input basis is in its legacy form.
+    b0_img : nib.Nifti1Image, optional
+        b0 image(s) to concatenate before the SF, as in a DWI volume.
+    b0_scaling : bool, optional
+        If True, the SF are clipped between 0 and 1 and scaled by the mean b0
+        (b0_img must be given).
+    block_size : int, optional
+        Maximal number of voxels processed at once. Slabs hold at least one
+        slice (along the last spatial axis).
+    """
+    assert dtype in ["float32", "float64"], "Only `float32` and `float64` " \
+                                            "should be used."
+    if b0_scaling and b0_img is None:
+        raise ValueError("b0_img is required to scale the SF by the b0.")
+
+    data_shape = sh_img.shape
+    sh_order = order_from_ncoef(data_shape[-1], full_basis=input_full_basis)
+    B_in, _ = sh_to_sf_matrix(sphere, sh_order, basis_type=input_basis,
+                              full_basis=input_full_basis,
+                              legacy=is_input_legacy)
+    B_in = B_in.astype(dtype)
 
-    # Ravel the first 3 dimensions while keeping the 4th intact, like a list of
-    # 1D time series voxels.
-    shm_coeff = shm_coeff[mask].reshape(
-        (np.count_nonzero(mask), data_shape[3]))
+    nb_b0 = 0
+    if b0_img is not None:
+        nb_b0 = 1 if len(b0_img.shape) == 3 else b0_img.shape[3]
+    output_dim = nb_b0 + len(sphere.vertices)
 
-    # Separating the case nbr_processes=1 to help get good coverage metrics
-    # (codecov does not deal well with multiprocessing)
-    if nbr_processes == 1:
-        tmp_sf_array = _convert_sh_to_sf_loop(shm_coeff, output_dim, B_in)
+    if out_filename.endswith('.gz'):
+        fd, tmp_filename = tempfile.mkstemp(
+            suffix='.nii', dir=os.path.dirname(os.path.abspath(out_filename)))
+        os.close(fd)
     else:
-        # Separate the data in chunks of len(nbr_processes).
-        shm_coeff_chunks = np.array_split(shm_coeff, nbr_processes)
-
-        pool = multiprocessing.Pool(nbr_processes)
-        results = pool.map(_convert_sh_to_sf_parallel,
-                           zip(shm_coeff_chunks,
-                               itertools.repeat(B_in),
-                               itertools.repeat(output_dim),
-                               np.arange(len(shm_coeff_chunks))))
-        pool.close()
-        pool.join()
-
-        # Re-assemble the chunk together.
-        chunk_len = np.cumsum([0] + [len(c) for c in shm_coeff_chunks])
-        tmp_sf_array = np.zeros((np.count_nonzero(mask), new_shape[3]),
-                                dtype=dtype)
-        for i, new_sf in results:
-            tmp_sf_array[chunk_len[i]:chunk_len[i + 1], :] = new_sf
-
-    # Bring back to the original shape
-    sf_array = np.zeros(new_shape, dtype=dtype)
-    sf_array[mask] = tmp_sf_array
-
-    return sf_array
+        tmp_filename = out_filename
+    sf = create_nifti_memmap(tmp_filename, data_shape[:3] + (output_dim,),
+                             dtype, sh_img.affine)
+
+    slab_thickness = max(1, block_size // (data_shape[0] * data_shape[1]))
+    for z in range(0, data_shape[2], slab_thickness):
+        z_slab = slice(z, z + slab_thickness)
+        sh = np.asarray(sh_img.dataobj[:, :, z_slab], dtype=dtype)
+        if mask is None:
+            slab_mask = np.sum(sh, axis=3).astype(bool)
+        else:
+            slab_mask = mask[:, :, z_slab].astype(bool)
+
+        slab_sf = _apply_matrix_by_blocks(sh, slab_mask, B_in, dtype)
+        if b0_img is not None:
+            b0 = np.asarray(b0_img.dataobj[:, :, z_slab], dtype=dtype)
+            b0 = b0.reshape(b0.shape[:3] + (nb_b0,))
+            if b0_scaling:
+                # Clip SF signal between 0. and 1., then scale using mean b0
+                np.clip(slab_sf, 0., 1., out=slab_sf)
+                slab_sf *= np.mean(b0, axis=-1, keepdims=True)
+            sf[:, :, z_slab, :nb_b0] = b0
+        sf[:, :, z_slab, nb_b0:] = slab_sf
+
+    sf.flush()
+    del sf
+    if tmp_filename != out_filename:
+        gzip_nifti(tmp_filename, out_filename)
@@ -3,7 +3,8 @@ import numpy as np
 from dipy.data import get_sphere
 from dipy.reconst.shm import sh_to_sf_matrix
 
-from scilpy.reconst.fodf import get_ventricles_max_fodf
+from scilpy.reconst.fodf import (fit_coeffs_from_model, fit_from_model,
+                                 get_ventricles_max_fodf)
 from scilpy.reconst.utils import find_order_from_nb_coeff
 from scilpy.tests.arrays import fodf_3x3_order8_descoteaux07
 
@@ -38,9 +39,79 @@ def test_get_ventricles_max_fodf():
     assert mean == np.mean([np.max(sf1), np.max(sf2)])
 
 
+class _FakeFit(object):
+    def __init__(self, data):
+        self.shm_coeff = 2 * data[:2]
+        self.volume_fractions = np.sum(data)
+
+
+class _FakeModel(object):
+    def fit(self, data):
+        return _FakeFit(data)
+
+
+class _FakeFitWithLabel(_FakeFit):
+    def __init__(self, model, data):
+        super().__init__(data)
+        self.model = model
+        # Not numeric, and not the same for all voxels.
+        self.label = 'high' if data[0] > 60 else 'low'
+
+
+class _FakeModelWithLabel(object):
+    def fit(self, data):
+        return _FakeFitWithLabel(self, data)
+
+
 def test_fit_from_model():
-    # toDO
-    pass
+    data = np.arange(2 * 3 * 4 * 5, dtype=float).reshape((2, 3, 4, 5))
+    data[0, 0, 0] = 0
+
+    # First voxel has only zeros: it is not fitted.
+    mask = np.ones((2, 3, 4), dtype=bool)
+    mask[0, 0, 0] = False
+
+    for nbr_processes in [1, 2]:
+        fit = fit_from_model(_FakeModel(), data, nbr_processes=nbr_processes)
+        assert np.array_equal(fit.mask, mask)
+        assert fit.fit_array[0, 0, 0] == 0
+        for index in zip(*np.nonzero(mask)):
+            assert isinstance(fit.fit_array[index], _FakeFit)
+            assert np.allclose(fit.fit_array[index].shm_coeff,
+                               2 * data[index][:2])
+            assert fit.fit_array[index].volume_fractions == \
+                np.sum(data[index])
+
+        # Fits with other attributes than the first fit are kept as is.
+        model = _FakeModelWithLabel()
+        fit = fit_from_model(model, data, nbr_processes=nbr_processes)
+        for index in zip(*np.nonzero(mask)):
+            voxel_fit = fit.fit_array[index]
+            assert voxel_fit.model is model
+            assert voxel_fit.label == ('high' if data[index][0] > 60
+                                       else 'low')
+            assert np.allclose(voxel_fit.shm_coeff, 2 * data[index][:2])
+
+
+def test_fit_coeffs_from_model():
+    data = np.arange(2 * 3 * 4 * 5, dtype=float).reshape((2, 3, 4, 5))
+    data[0, 0, 0] = 0
+    mask = np.ones((2, 3, 4), dtype=bool)
+    mask[0, 0, 1] = False
+
+    shm_coeff, vf = fit_coeffs_from_model(
+        _FakeModel(), data, attributes=['shm_coeff', 'volume_fractions'],
+        mask=mask, nbr_processes=1)
+
+    assert shm_coeff.shape == (2, 3, 4, 2)
+    assert shm_coeff.dtype == np.float32
+    assert vf.shape == (2, 3, 4)
+
+    # First voxel has only zeros: it is not fitted.
+    mask[0, 0, 0] = False
+    assert np.allclose(shm_coeff[mask], 2 * data[mask][:, :2])
+    assert np.allclose(vf[mask], np.sum(data[mask], axis=1))
+    assert np.count_nonzero(shm_coeff[~mask]) == 0
 
 
 def test_verify_failed_voxels_shm_coeff():
@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+import numpy as np
+from dipy.data import get_sphere
+from dipy.reconst.shm import sh_to_sf_matrix
+
+from scilpy.reconst.sh import (_apply_matrix_by_blocks, convert_sh_basis,
+                               convert_sh_to_sf)
+from scilpy.tests.arrays import fodf_3x3_order8_descoteaux07
 
 
 def test_verify_data_vs_sh_order():
@@ -27,10 +34,71 @@ def test_maps_from_sh():
 
 
 def test_convert_sh_basis():
-    # toDO
-    pass
+    sphere = get_sphere(name='repulsion724')
+    sh = fodf_3x3_order8_descoteaux07
+    mask = np.ones(sh.shape[:3], dtype=bool)
+    mask[0, 0, 0] = False
+
+    new_sh = convert_sh_basis(sh, sphere, mask=mask,
+                              input_basis='descoteaux07',
+                              output_basis='tournier07',
+                              is_input_legacy=True, is_output_legacy=False)
+    assert new_sh.dtype == np.float64
+    assert np.count_nonzero(new_sh[0, 0, 0]) == 0
+
+    # The output stays float64 by default, whatever the input dtype.
+    new_sh_32 = convert_sh_basis(sh.astype(np.float32), sphere, mask=mask,
+                                 input_basis='descoteaux07',
+                                 output_basis='tournier07',
+                                 is_input_legacy=True,
+                                 is_output_legacy=False, nbr_processes=2)
+    assert new_sh_32.dtype == np.float64
+    assert np.allclose(new_sh_32, new_sh, atol=1e-5)
+
+    # Expected: same as going to the SF and back, voxel by voxel.
+    B_in, _ = sh_to_sf_matrix(sphere, sh_order_max=6,
+                              basis_type='descoteaux07', legacy=True)
+    _, invB_out = sh_to_sf_matrix(sphere, sh_order_max=6,
+                                  basis_type='tournier07', legacy=False)
+    expected = np.dot(np.dot(sh[1, 1, 0], B_in), invB_out)
+    assert np.allclose(new_sh[1, 1, 0], expected)
+
+    # Going back to the input basis.
+    back_sh = convert_sh_basis(new_sh, sphere, mask=mask,
+                               input_basis='tournier07',
+                               output_basis='descoteaux07',
+                               is_input_legacy=False, is_output_legacy=True,
+                               dtype=np.float32)
+    assert back_sh.dtype == np.float32
+    assert np.allclose(back_sh[mask], sh[mask], atol=1e-5)
 
 
 def test_convert_sh_to_sf():
-    # toDO
-    pass
+    sphere = get_sphere(name='repulsion100')
+    sh = fodf_3x3_order8_descoteaux07
+
+    sf = convert_sh_to_sf(sh, sphere, input_basis='descoteaux07',
+                          is_input_legacy=True, dtype='float64')
+    assert sf.shape == sh.shape[:3] + (100,)
+    assert sf.dtype == np.float64
+
+    B, _ = sh_to_sf_matrix(sphere, sh_order_max=6,
+                           basis_type='descoteaux07', legacy=True)
+    assert np.allclose(sf[1, 1, 0], np.dot(sh[1, 1, 0], B))
+
+
+def test_apply_matrix_by_blocks():
+    sh = fodf_3x3_order8_descoteaux07
+    mask = np.ones(sh.shape[:3], dtype=bool)
+    mask[2, 1, 0] = False
+    matrix = np.random.RandomState(0).rand(sh.shape[-1], 10)
+
+    expected = np.zeros(sh.shape[:3] + (10,))
+    expected[mask] = np.dot(sh[mask], matrix)
+
+    # Many small blocks, computed by one or several threads.
+    for nbr_processes in [1, 3]:
+        out = _apply_matrix_by_blocks(sh, mask, matrix, np.float64,
+                                      block_size=2,
+                                      nbr_processes=nbr_processes)
+        assert np.allclose(out, expected)
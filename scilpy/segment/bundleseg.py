@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import gc
+import hashlib
 import logging
+import os
+import tempfile
 from time import time
 import warnings
 
@@ -11,16 +14,191 @@ from dipy.segment.fss import FastStreamlineSearch, nearest_from_matrix_col
 from dipy.segment.clustering import qbx_and_merge
 from dipy.tracking.distances import bundles_distances_mdf
 from dipy.tracking.streamline import (select_random_set_of_streamlines,
+                                      set_number_of_points,
                                       transform_streamlines)
+import nibabel as nib
 from nibabel.streamlines.array_sequence import ArraySequence
 import numpy as np
 from scipy.sparse import vstack
+from scipy.spatial import cKDTree
 
-from scilpy.io.streamlines import reconstruct_streamlines_from_memmap
+from scilpy.io.streamlines import (reconstruct_streamlines_from_memmap,
+                                   resampled_streamlines_from_memmap)
 from scilpy.utils import get_duration
 
 logger = logging.getLogger('BundleSeg')
 
+# Number of streamlines whose candidate pairs are searched at once in
+# find_nearest_mdf, and maximal number of (streamline, reference streamline)
+# pairs compared at once.
+MDF_CHUNK_SIZE = 1000
+MDF_PAIRS_CHUNK_SIZE = 100000
+
+
+def cluster_model_bundle(model_streamlines, model_clust_thr, rng=None):
+    """
+    Compute QBx on the model bundle.
+
+    Parameters
+    ----------
+    model_streamlines : list or ArraySequence
+        Model bundle.
+    model_clust_thr : float
+        Distance threshold (mm) for model clustering (QBx).
+    rng : RandomState
+        If None then RandomState is initialized internally.
+
+    Returns
+    -------
+    model_centroids : ArraySequence
+        Centroids of the clusters (float16).
+    """
+    thresholds = [30, 20, 15, model_clust_thr]
+    model_cluster_map = qbx_and_merge(model_streamlines, thresholds,
+                                      nb_pts=12,
+                                      rng=rng,
+                                      verbose=False)
+
+    model_centroids = ArraySequence(model_cluster_map.centroids)
+    model_centroids._data = model_centroids._data.astype(np.float16)
+    return model_centroids
+
+
+def get_model_cache_filename(cache_dir, model_filepath):
+    """
+    Filename of the cached model, keyed by the hash of the model file.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache.
+    model_filepath : str
+        Path to the model bundle file.
+
+    Returns
+    -------
+    cache_filename : str
+    """
+    file_hash = hashlib.sha256()
+    with open(model_filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            file_hash.update(chunk)
+    return os.path.join(cache_dir, '{}.npz'.format(file_hash.hexdigest()))
+
+
+def load_model_bundle(model_filepath, cache_dir=None):
+    """
+    Load a model bundle, at full resolution, in the model space. If a cache
+    directory is given, the parsed streamlines are read from the cache when
+    available, else added to the cache, so that other runs (other subjects)
+    do not have to parse the model file again.
+
+    Only the parsing is cached: the resampling and the clustering of the
+    model (QBx) are not invariant to the transformation to the subject space,
+    so they are computed after it (see BundleSeg.recognize).
+
+    Parameters
+    ----------
+    model_filepath : str
+        Path to the model bundle file.
+    cache_dir : str, optional
+        Directory of the cache. If None, no cache is used.
+
+    Returns
+    -------
+    model_streamlines : ArraySequence
+        Model bundle.
+    """
+    if cache_dir is None:
+        return nib.streamlines.load(model_filepath).streamlines
+
+    cache_filename = get_model_cache_filename(cache_dir, model_filepath)
+    if os.path.isfile(cache_filename):
+        model_streamlines = ArraySequence()
+        with np.load(cache_filename) as cache:
+            model_streamlines._data = cache['data']
+            model_streamlines._offsets = cache['offsets']
+            model_streamlines._lengths = cache['lengths']
+        return model_streamlines
+
+    model_streamlines = nib.streamlines.load(model_filepath).streamlines
+
+    # Writing in a temporary file first: other processes may be reading or
+    # writing the same model.
+    fd, tmp_filename = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+    os.close(fd)
+    np.savez(tmp_filename,
+             data=model_streamlines._data,
+             offsets=model_streamlines._offsets,
+             lengths=model_streamlines._lengths)
+    os.replace(tmp_filename, cache_filename)
+
+    return model_streamlines
+
+
+def find_nearest_mdf(streamlines, ref_streamlines, radius):
+    """
+    For each streamline, find the minimal MDF distance (minimum average
+    direct-flip distance) to the reference streamlines, if below the radius.
+
+    The mean of the points of a streamline does not change when flipping it,
+    and the distance between the means of two streamlines is smaller than
+    their MDF distance. Only pairs with means closer than the radius are thus
+    compared, in a vectorized way. The candidate pairs are searched by chunks
+    of MDF_CHUNK_SIZE streamlines, so that they are never all in memory.
+
+    Parameters
+    ----------
+    streamlines : np.ndarray
+        Streamlines resampled to the same number of points, of shape
+        (N, nb_points, 3).
+    ref_streamlines : np.ndarray
+        Reference streamlines, of shape (M, nb_points, 3).
+    radius : float
+        Maximal MDF distance (mm).
+
+    Returns
+    -------
+    indices : np.ndarray
+        Indices of the streamlines with at least one reference streamline
+        within the radius.
+    distances : np.ndarray
+        Their minimal MDF distance.
+    """
+    if len(streamlines) == 0 or len(ref_streamlines) == 0:
+        return np.array([], dtype=np.uint32), np.array([], dtype=np.float32)
+
+    means = np.mean(streamlines, axis=1)
+    ref_tree = cKDTree(np.mean(ref_streamlines, axis=1))
+
+    distances = np.full(len(streamlines), np.inf, dtype=np.float32)
+    for start in range(0, len(streamlines), MDF_CHUNK_SIZE):
+        neighbors = ref_tree.query_ball_point(
+            means[start:start + MDF_CHUNK_SIZE], radius)
+        nb_neighbors = [len(n) for n in neighbors]
+        if sum(nb_neighbors) == 0:
+            continue
+
+        chunk_ids = np.repeat(np.arange(start, start + len(neighbors)),
+                              nb_neighbors)
+        chunk_ref_ids = np.concatenate(neighbors).astype(np.intp)
+        del neighbors
+
+        for pair_start in range(0, len(chunk_ids), MDF_PAIRS_CHUNK_SIZE):
+            ids = chunk_ids[pair_start:pair_start + MDF_PAIRS_CHUNK_SIZE]
+            ref_ids = chunk_ref_ids[pair_start:
+                                    pair_start + MDF_PAIRS_CHUNK_SIZE]
+            direct = np.mean(np.linalg.norm(
+                streamlines[ids] - ref_streamlines[ref_ids], axis=-1),
+                axis=-1)
+            flipped = np.mean(np.linalg.norm(
+                streamlines[ids] - ref_streamlines[ref_ids, ::-1], axis=-1),
+                axis=-1)
+            np.minimum.at(distances, ids, np.minimum(direct, flipped))
+
+    indices = np.where(distances <= radius)[0].astype(np.uint32)
+    return indices, distances[indices]
+
 
 class BundleSeg(object):
     """
@@ -39,7 +217,8 @@ class BundleSeg(object):
     """
 
     def __init__(self, memmap_filenames, transformation,
-                 clusters_indices, wb_centroids, rng=None):
+                 clusters_indices, wb_centroids, rng=None,
+                 wb_index=None):
         """
         Parameters
         ----------
@@ -55,8 +234,14 @@ class BundleSeg(object):
             from qbx.
         rng : RandomState
             If None then RandomState is initialized internally.
+        wb_index : tuple, optional
+            Filename and shape of the whole-brain streamlines, resampled to
+            12 points (see resampled_streamlines_to_memmap). If given, the
+            pruning of every bundle reads its neighbors from it instead of
+            reconstructing and resampling them.
         """
         self.memmap_filenames = memmap_filenames
+        self.wb_index = wb_index
         self.transformation = transformation
         self.wb_clusters_indices = clusters_indices
         self.wb_centroids = wb_centroids
@@ -130,15 +315,9 @@ class BundleSeg(object):
         model_clust_thr, float, distance in mm for clustering.
         identifier, str, name of the bundle for logger.
         """
-        thresholds = [30, 20, 15, model_clust_thr]
-        model_cluster_map = qbx_and_merge(self.model_streamlines, thresholds,
-                                          nb_pts=12,
-                                          rng=self.rng,
-                                          verbose=False)
-
-        self.model_centroids = ArraySequence(model_cluster_map.centroids)
-        self.model_centroids._data = self.model_centroids._data.astype(
-            np.float16)
+        self.model_centroids = cluster_model_bundle(self.model_streamlines,
+                                                    model_clust_thr,
+                                                    rng=self.rng)
 
         len_centroids = len(self.model_centroids)
         if len_centroids > 1000:
@@ -267,6 +446,9 @@ class BundleSeg(object):
         pruning_thr: float, distance in
             thresholds = [32, 16, 24, neighbors_cluster_thr]
         """
+        if self.wb_index is not None:
+            return self._prune_far_from_model_with_index(pruning_thr)
+
         # Neighbors can be refined since the search space is smaller
         t0 = time()
         neighb_streamlines = reconstruct_streamlines_from_memmap(
@@ -319,6 +501,36 @@ class BundleSeg(object):
         else:
             return [], []
 
+    def _prune_far_from_model_with_index(self, pruning_thr=10):
+        """
+        Same as prune_far_from_model, but the neighbors are read, already
+        resampled, from the whole-brain index.
+        """
+        t0 = time()
+        if len(self.neighb_indices) <= 1:
+            return [], []
+
+        neighb_streamlines = resampled_streamlines_from_memmap(
+            *self.wb_index, indices=self.neighb_indices)
+        nb_points = neighb_streamlines.shape[1]
+        model_streamlines = np.asarray(set_number_of_points(
+            [np.asarray(s, dtype=np.float32) for s in self.model_streamlines],
+            nb_points))
+
+        non_zero_ids, scores = find_nearest_mdf(neighb_streamlines,
+                                                model_streamlines,
+                                                pruning_thr)
+        logger.debug(f'Index search of {len(neighb_streamlines)} neighbors '
+                     f'took {get_duration(t0)} sec.')
+
+        if len(non_zero_ids) != 0:
+            final_pruned_indices = self.neighb_indices[non_zero_ids].astype(
+                np.uint32)
+            final_pruned_scores = scores.astype(np.float16)
+            return final_pruned_indices, final_pruned_scores
+        else:
+            return [], []
+
     def cleanup(self):
         for indices in [self.neighb_indices, self.wb_clusters_indices]:
             if indices is not None:
@@ -13,6 +13,19 @@ from scipy.ndimage import (map_coordinates, generate_binary_structure,
 import numpy as np
 
 from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
+from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
+from scilpy.utils.parallel import (SharedArray, get_nbr_processes, get_pool,
+                                   imap_bounded)
+
+# Number of streamlines traversed at once in filter_grid_rois.
+CHUNK_SIZE = 100000
+
+# Maximal number of chunks of streamlines in flight per process in
+# filter_grid_rois.
+NB_CHUNKS_PER_PROCESS = 2
+
+# Number of ROIs evaluated together in filter_grid_rois (one bit each).
+_NB_BITS = 64
 
 
 def streamlines_in_mask(sft, target_mask, all_in=False):
@@ -52,6 +65,54 @@ def streamlines_in_mask(sft, target_mask, all_in=False):
         return np.where(streamlines_case == [0, 1][True])[0].tolist()
 
 
+def _get_streamlines_endpoints(streamlines):
+    """
+    Get the first and last points of all streamlines at once, from the
+    offsets and lengths of the ArraySequence.
+
+    Parameters
+    ----------
+    streamlines: ArraySequence
+        The streamlines.
+
+    Returns
+    -------
+    first_points: np.ndarray of shape (N, 3)
+    last_points: np.ndarray of shape (N, 3)
+    """
+    if len(streamlines) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3))
+
+    offsets = np.asarray(streamlines._offsets, dtype=np.int64)
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    return (streamlines._data[offsets],
+            streamlines._data[offsets + lengths - 1])
+
+
+def _points_in_grid_mask(mask, points):
+    """
+    Values of the mask (nearest voxel) at the given points, in vox/corner
+    space.
+    """
+    voxels = np.asarray(points, dtype=np.int16).transpose(1, 0)
+    return map_coordinates(mask, voxels, order=0, mode='nearest') != 0
+
+
+def _combine_endpoints(in_roi_1, in_roi_2, filter_type):
+    """
+    Indices of the streamlines respecting the endpoint filter type, from
+    booleans telling if their first (in_roi_1) and last (in_roi_2) points
+    are in the ROI.
+    """
+    # Both endpoints need to be in the mask (AND)
+    if filter_type == 'both_ends':
+        return np.where(np.logical_and(in_roi_1, in_roi_2))[0]
+    # Only one endpoint needs to be in the mask (OR)
+    elif filter_type == 'either_end':
+        return np.where(np.logical_or(in_roi_1, in_roi_2))[0]
+    raise ValueError("Unknown filter type {}".format(filter_type))
+
+
 def filter_grid_roi_both(sft, mask_1, mask_2):
     """ Filters streamlines with one end in a mask and the other in
     another mask.
@@ -73,19 +134,14 @@ def filter_grid_roi_both(sft, mask_1, mask_2):
     """
     sft.to_vox()
     sft.to_corner()
-    streamline_vox = sft.streamlines
     # For endpoint filtering, we need to keep 2 separately
-    # Could be faster for either end, but the code look cleaner like this
-    voxel_beg = np.asarray([s[0] for s in streamline_vox],
-                           dtype=np.int16).transpose(1, 0)
-    voxel_end = np.asarray([s[-1] for s in streamline_vox],
-                           dtype=np.int16).transpose(1, 0)
+    points_beg, points_end = _get_streamlines_endpoints(sft.streamlines)
 
-    map1_beg = map_coordinates(mask_1, voxel_beg, order=0, mode='nearest')
-    map2_beg = map_coordinates(mask_2, voxel_beg, order=0, mode='nearest')
+    map1_beg = _points_in_grid_mask(mask_1, points_beg)
+    map2_beg = _points_in_grid_mask(mask_2, points_beg)
 
-    map1_end = map_coordinates(mask_1, voxel_end, order=0, mode='nearest')
-    map2_end = map_coordinates(mask_2, voxel_end, order=0, mode='nearest')
+    map1_end = _points_in_grid_mask(mask_1, points_end)
+    map2_end = _points_in_grid_mask(mask_2, points_end)
     line_based_indices = np.logical_or(
         np.logical_and(map1_beg, map2_end), np.logical_and(map1_end, map2_beg))
 
@@ -140,10 +196,10 @@ def filter_grid_roi(sft, mask, filter_type, is_exclude, filter_distance=0,
     if len(sft.streamlines) == 0:
         if return_sft:
             if return_rejected_sft:
-                return np.array([]), sft, sft
-            return np.array([]), sft
+                return np.array([], dtype=np.int32), sft, sft
+            return np.array([], dtype=np.int32), sft
         else:
-            return np.array([])
+            return np.array([], dtype=np.int32)
 
     if filter_distance != 0:
         bin_struct = generate_binary_structure(3, 2)
@@ -157,27 +213,11 @@ def filter_grid_roi(sft, mask, filter_type, is_exclude, filter_distance=0,
     else:
         sft.to_vox()
         sft.to_corner()
-        streamline_vox = sft.streamlines
         # For endpoint filtering, we need to keep 2 separately
-        # Could be faster for either end, but the code look cleaner like this
-        line_based_indices_1 = []
-        line_based_indices_2 = []
-        for i, line_vox in enumerate(streamline_vox):
-            voxel_1 = line_vox[0].astype(np.int16)[:, None]
-            voxel_2 = line_vox[-1].astype(np.int16)[:, None]
-            if map_coordinates(mask, voxel_1, order=0, mode='nearest'):
-                line_based_indices_1.append(i)
-            if map_coordinates(mask, voxel_2, order=0, mode='nearest'):
-                line_based_indices_2.append(i)
-
-        # Both endpoints need to be in the mask (AND)
-        if filter_type == 'both_ends':
-            line_based_indices = np.intersect1d(line_based_indices_1,
-                                                line_based_indices_2)
-        # Only one endpoint need to be in the mask (OR)
-        elif filter_type == 'either_end':
-            line_based_indices = np.union1d(line_based_indices_1,
-                                            line_based_indices_2)
+        points_1, points_2 = _get_streamlines_endpoints(sft.streamlines)
+        line_based_indices = _combine_endpoints(
+            _points_in_grid_mask(mask, points_1),
+            _points_in_grid_mask(mask, points_2), filter_type)
 
     line_based_indices = np.asarray(line_based_indices, dtype=np.int32)
     outliers_indices = np.setdiff1d(range(len(sft)),
@@ -199,6 +239,168 @@ def filter_grid_roi(sft, mask, filter_type, is_exclude, filter_distance=0,
     return line_based_indices
 
 
+def _get_streamlines_roi_bits(streamlines, bits):
+    """
+    Traverse the voxels of the streamlines once and gather the bits of a
+    volume where bit k is set in the voxels of the k-th ROI.
+
+    Parameters
+    ----------
+    streamlines: ArraySequence
+        Streamlines, in vox/corner space.
+    bits: np.ndarray
+        Volume of type uint64.
+
+    Returns
+    -------
+    any_bits, all_bits, first_bits, last_bits: np.ndarray
+        For each streamline, bitwise OR and AND over the traversed voxels,
+        and bits at the first and last points.
+    """
+    nb_streamlines = len(streamlines)
+    if nb_streamlines == 0:
+        empty = np.zeros(0, dtype=bits.dtype)
+        return empty, empty, empty, empty
+
+    # The traversal needs float32 points.
+    if streamlines._data.dtype != np.float32:
+        streamlines = streamlines.copy()
+        streamlines._data = streamlines._data.astype(np.float32)
+
+    indices = streamlines_to_voxel_coordinates(streamlines)
+    voxels = np.asarray(indices._data, dtype=np.intp).reshape((-1, 3))
+    lengths = np.asarray(indices._lengths)
+    offsets = np.asarray(indices._offsets)
+
+    # Voxels outside the volume are in no ROI.
+    in_volume = np.all(voxels < bits.shape, axis=1)
+    voxel_bits = np.zeros(max(len(voxels), 1), dtype=bits.dtype)
+    voxel_bits[:len(voxels)][in_volume] = bits[tuple(voxels[in_volume].T)]
+
+    # Streamlines without points are in no ROI.
+    offsets = np.minimum(offsets, len(voxel_bits) - 1)
+    any_bits = np.bitwise_or.reduceat(voxel_bits, offsets)
+    all_bits = np.bitwise_and.reduceat(voxel_bits, offsets)
+    any_bits[lengths == 0] = 0
+    all_bits[lengths == 0] = 0
+
+    # Endpoints, as in filter_grid_roi
+    endpoints_bits = []
+    for points in _get_streamlines_endpoints(streamlines):
+        points = np.clip(np.asarray(points, dtype=np.int16), 0,
+                         np.asarray(bits.shape) - 1)
+        endpoints_bits.append(bits[tuple(points.T)])
+
+    return any_bits, all_bits, endpoints_bits[0], endpoints_bits[1]
+
+
+def _get_streamlines_roi_bits_parallel(args):
+    streamlines, bits_descriptor = args
+    shm, bits = SharedArray.attach(bits_descriptor)
+    try:
+        return _get_streamlines_roi_bits(streamlines, bits)
+    finally:
+        del bits
+        shm.close()
+
+
+def filter_grid_rois(sft, masks, filter_types, is_excludes,
+                     filter_distances=None, nbr_processes=1):
+    """
+    Evaluate many ROI criteria at once. Contrary to calling filter_grid_roi
+    for each ROI, the voxels traversed by each streamline are computed only
+    once, and all ROIs are tested simultaneously (as bits of a single
+    volume).
+
+    Parameters
+    ----------
+    sft : StatefulTractogram
+        Tractogram containing the streamlines to segment.
+    masks : list of numpy.ndarray
+        Binary masks, one per criterion.
+    filter_types: list of str
+        For each mask, one of 'any', 'all', 'either_end', 'both_ends'.
+    is_excludes: list of bool
+        For each mask, if the ROI is an AND (false) or a NOT (true).
+    filter_distances: list of int, optional
+        For each mask, the number of passes for dilation. Default: 0.
+    nbr_processes: int
+        Number of processes. Streamlines are processed by chunks of
+        CHUNK_SIZE.
+
+    Returns
+    -------
+    selected: np.ndarray of shape (nb_streamlines, nb_masks)
+        For each criterion, True for the streamlines respecting it (i.e.
+        kept by filter_grid_roi).
+    """
+    if filter_distances is None:
+        filter_distances = [0] * len(masks)
+
+    sft.to_vox()
+    sft.to_corner()
+    _, dim, _, _ = sft.space_attributes
+    streamlines = sft.streamlines
+    nb_streamlines = len(streamlines)
+    nbr_processes = get_nbr_processes(nbr_processes)
+
+    selected = np.zeros((nb_streamlines, len(masks)), dtype=bool)
+    for start in range(0, len(masks), _NB_BITS):
+        group = range(start, min(start + _NB_BITS, len(masks)))
+
+        bits = np.zeros(dim, dtype=np.uint64)
+        for k, i in enumerate(group):
+            mask = np.asarray(masks[i]) != 0
+            if filter_distances[i] != 0:
+                bin_struct = generate_binary_structure(3, 2)
+                mask = binary_dilation(mask, bin_struct,
+                                       iterations=filter_distances[i])
+            bits[mask] |= np.uint64(1) << np.uint64(k)
+
+        # Chunks are copies: streamlines_to_voxel_coordinates expects
+        # compact data (and slices would pickle the whole data). They are
+        # only made as the processes are ready for them.
+        chunks = range(0, nb_streamlines, CHUNK_SIZE)
+        if nbr_processes == 1 or len(chunks) <= 1:
+            results = [_get_streamlines_roi_bits(
+                streamlines[i:i + CHUNK_SIZE].copy(), bits) for i in chunks]
+        else:
+            shared_bits = SharedArray(bits.shape, bits.dtype, bits)
+            try:
+                tasks = ((streamlines[i:i + CHUNK_SIZE].copy(),
+                          shared_bits.descriptor) for i in chunks)
+                results = list(imap_bounded(
+                    get_pool(nbr_processes),
+                    _get_streamlines_roi_bits_parallel, tasks,
+                    NB_CHUNKS_PER_PROCESS * nbr_processes))
+            finally:
+                shared_bits.release()
+
+        if len(results) == 0:
+            continue
+        any_bits, all_bits, first_bits, last_bits = \
+            [np.concatenate(r) for r in zip(*results)]
+
+        for k, i in enumerate(group):
+            bit = np.uint64(1) << np.uint64(k)
+            if filter_types[i] == 'any':
+                is_selected = (any_bits & bit) != 0
+            elif filter_types[i] == 'all':
+                is_selected = (all_bits & bit) != 0
+            else:
+                is_selected = np.zeros(nb_streamlines, dtype=bool)
+                is_selected[_combine_endpoints((first_bits & bit) != 0,
+                                               (last_bits & bit) != 0,
+                                               filter_types[i])] = True
+
+            # If the 'exclude' option is used, the selection is inverted
+            if is_excludes[i]:
+                is_selected = ~is_selected
+            selected[:, i] = is_selected
+
+    return selected
+
+
 def pre_filtering_for_geometrical_shape(sft, size, center, filter_type,
                                         is_in_vox):
     """
@@ -277,7 +479,7 @@ def filter_ellipsoid(sft, ellipsoid_radius, ellipsoid_center,
         Filtered sft
     """
     if len(sft.streamlines) == 0:
-        return np.array([]), sft
+        return np.array([], dtype=np.int32), sft
 
     pre_filtered_indices, pre_filtered_sft = \
         pre_filtering_for_geometrical_shape(sft, ellipsoid_radius,
@@ -293,8 +495,6 @@ def filter_ellipsoid(sft, ellipsoid_radius, ellipsoid_center,
                                                    ellipsoid_center),
                                       dtype=float)
     selected_by_ellipsoid = []
-    line_based_indices_1 = []
-    line_based_indices_2 = []
     # This is still point based (but resampled), I had a ton of problems trying
     # to use something with intersection, but even if I could do it :
     # The result won't be identical to MI-Brain since I am not using the
@@ -303,8 +503,8 @@ def filter_ellipsoid(sft, ellipsoid_radius, ellipsoid_center,
     ellipsoid_radius = np.asarray(ellipsoid_radius, dtype=float)
     ellipsoid_center = np.asarray(ellipsoid_center, dtype=float)
 
-    for i, line in enumerate(pre_filtered_streamlines):
-        if filter_type in ['any', 'all']:
+    if filter_type in ['any', 'all']:
+        for i, line in enumerate(pre_filtered_streamlines):
             # Resample to 1/10 of the voxel size
             nb_points = max(int(length(line) / np.average(res) * 10), 2)
             line = set_number_of_points(line, nb_points)
@@ -319,27 +519,18 @@ def filter_ellipsoid(sft, ellipsoid_radius, ellipsoid_center,
                     and len(np.argwhere(points_in_ellipsoid <= 1)) == len(line):
                 # If all points were in the ellipsoid
                 selected_by_ellipsoid.append(pre_filtered_indices[i])
-
-        else:
-            points_in_ellipsoid = np.sum(
-                ((line[0] - ellipsoid_center) / ellipsoid_radius) ** 2)
-
-            if points_in_ellipsoid <= 1.0:
-                line_based_indices_1.append(pre_filtered_indices[i])
-
-            points_in_ellipsoid = np.sum(
-                ((line[-1] - ellipsoid_center) / ellipsoid_radius) ** 2)
-            if points_in_ellipsoid <= 1.0:
-                line_based_indices_2.append(pre_filtered_indices[i])
-
-    # Both endpoints need to be in the mask (AND)
-    if filter_type == 'both_ends':
-        selected_by_ellipsoid = np.intersect1d(line_based_indices_1,
-                                               line_based_indices_2)
-    # Only one endpoint needs to be in the mask (OR)
-    elif filter_type == 'either_end':
-        selected_by_ellipsoid = np.union1d(line_based_indices_1,
-                                           line_based_indices_2)
+    else:
+        # All endpoints at once
+        points_1, points_2 = _get_streamlines_endpoints(
+            pre_filtered_streamlines)
+        in_ellipsoid_1 = np.sum(
+            ((points_1 - ellipsoid_center) / ellipsoid_radius) ** 2,
+            axis=1) <= 1.0
+        in_ellipsoid_2 = np.sum(
+            ((points_2 - ellipsoid_center) / ellipsoid_radius) ** 2,
+            axis=1) <= 1.0
+        selected_by_ellipsoid = pre_filtered_indices[
+            _combine_endpoints(in_ellipsoid_1, in_ellipsoid_2, filter_type)]
 
     # If the 'exclude' option is used, the selection is inverted
     if is_exclude:
@@ -385,7 +576,7 @@ def filter_cuboid(sft, cuboid_radius, cuboid_center,
         Filtered sft
     """
     if len(sft.streamlines) == 0:
-        return np.array([]), sft
+        return np.array([], dtype=np.int32), sft
 
     pre_filtered_indices, pre_filtered_sft = \
         pre_filtering_for_geometrical_shape(sft, cuboid_radius,
@@ -397,14 +588,12 @@ def filter_cuboid(sft, cuboid_radius, cuboid_center,
     _, _, res, _ = sft.space_attributes
 
     selected_by_cuboid = []
-    line_based_indices_1 = []
-    line_based_indices_2 = []
     # Also here I am not using a mathematical intersection and
     # I am not using vtkPolyData like in MI-Brain, so not exactly the same
     cuboid_radius = np.asarray(cuboid_radius, dtype=float)
     cuboid_center = np.asarray(cuboid_center, dtype=float)
-    for i, line in enumerate(pre_filtered_streamlines):
-        if filter_type in ['any', 'all']:
+    if filter_type in ['any', 'all']:
+        for i, line in enumerate(pre_filtered_streamlines):
             # Resample to 1/10 of the voxel size
             nb_points = max(int(length(line) / np.average(res) * 10), 2)
             line = set_number_of_points(line, nb_points)
@@ -419,28 +608,16 @@ def filter_cuboid(sft, cuboid_radius, cuboid_center,
                     and len(np.argwhere(points_in_cuboid == 3)) == len(line):
                 # If all points were in the cuboid in x/y/z
                 selected_by_cuboid.append(pre_filtered_indices[i])
-        else:
-            # Faster to do it twice than trying to do in using an array of 2
-            points_in_cuboid = np.abs(line[0] - cuboid_center) / cuboid_radius
-            points_in_cuboid = np.sum(np.where(points_in_cuboid <= 1, 1, 0))
-
-            if points_in_cuboid == 3:
-                line_based_indices_1.append(pre_filtered_indices[i])
-
-            points_in_cuboid = np.abs(line[-1] - cuboid_center) / cuboid_radius
-            points_in_cuboid = np.sum(np.where(points_in_cuboid <= 1, 1, 0))
-
-            if points_in_cuboid == 3:
-                line_based_indices_2.append(pre_filtered_indices[i])
-
-    # Both endpoints need to be in the mask (AND)
-    if filter_type == 'both_ends':
-        selected_by_cuboid = np.intersect1d(line_based_indices_1,
-                                            line_based_indices_2)
-    # Only one endpoint need to be in the mask (OR)
-    elif filter_type == 'either_end':
-        selected_by_cuboid = np.union1d(line_based_indices_1,
-                                        line_based_indices_2)
+    else:
+        # All endpoints at once
+        points_1, points_2 = _get_streamlines_endpoints(
+            pre_filtered_streamlines)
+        in_cuboid_1 = np.all(
+            np.abs(points_1 - cuboid_center) / cuboid_radius <= 1, axis=1)
+        in_cuboid_2 = np.all(
+            np.abs(points_2 - cuboid_center) / cuboid_radius <= 1, axis=1)
+        selected_by_cuboid = pre_filtered_indices[
+            _combine_endpoints(in_cuboid_1, in_cuboid_2, filter_type)]
 
     # If the 'exclude' option is used, the selection is inverted
     if is_exclude:
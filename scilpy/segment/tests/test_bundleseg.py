@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+
+import nibabel as nib
+from nibabel.streamlines import Tractogram
+import numpy as np
+
+from scilpy.segment import bundleseg
+from scilpy.segment.bundleseg import (find_nearest_mdf,
+                                      get_model_cache_filename,
+                                      load_model_bundle)
+
+
+def test_find_nearest_mdf():
+    rng = np.random.RandomState(1234)
+    streamlines = rng.rand(50, 12, 3) * 20
+    ref_streamlines = rng.rand(10, 12, 3) * 20
+
+    # One flipped copy, slightly shifted
+    streamlines[7] = ref_streamlines[3, ::-1] + 0.1
+
+    indices, distances = find_nearest_mdf(streamlines, ref_streamlines, 6)
+
+    # Brute force
+    direct = np.mean(np.linalg.norm(
+        streamlines[:, None] - ref_streamlines[None], axis=-1), axis=-1)
+    flipped = np.mean(np.linalg.norm(
+        streamlines[:, None] - ref_streamlines[None, :, ::-1], axis=-1),
+        axis=-1)
+    mdf = np.min(np.minimum(direct, flipped), axis=1)
+
+    assert np.array_equal(indices, np.where(mdf <= 6)[0])
+    assert np.allclose(distances, mdf[mdf <= 6])
+    assert np.isclose(distances[list(indices).index(7)], np.sqrt(0.03))
+
+
+def test_load_model_bundle(tmp_path):
+    rng = np.random.RandomState(1234)
+    streamlines = [np.cumsum(rng.rand(n, 3), axis=0).astype(np.float32)
+                   for n in [5, 30, 17]]
+    model_filepath = str(tmp_path / 'model.trk')
+    nib.streamlines.save(Tractogram(streamlines, affine_to_rasmm=np.eye(4)),
+                         model_filepath)
+    cache_dir = str(tmp_path / 'cache')
+    os.mkdir(cache_dir)
+
+    # The model is not resampled.
+    uncached = load_model_bundle(model_filepath)
+    assert np.array_equal(uncached._lengths, [5, 30, 17])
+
+    # Cache miss, then cache hit: what recognition receives is identical to
+    # the uncached model.
+    for _ in range(2):
+        cached = load_model_bundle(model_filepath, cache_dir=cache_dir)
+        assert os.path.isfile(get_model_cache_filename(cache_dir,
+                                                       model_filepath))
+        assert np.array_equal(cached._offsets, uncached._offsets)
+        assert np.array_equal(cached._lengths, uncached._lengths)
+        assert np.array_equal(cached.get_data(), uncached.get_data())
+
+
+def test_find_nearest_mdf_chunks(monkeypatch):
+    rng = np.random.RandomState(1234)
+    streamlines = rng.rand(50, 12, 3) * 20
+    ref_streamlines = rng.rand(10, 12, 3) * 20
+    expected = find_nearest_mdf(streamlines, ref_streamlines, 8)
+
+    # Many chunks of streamlines and of pairs: same result.
+    monkeypatch.setattr(bundleseg, 'MDF_CHUNK_SIZE', 7)
+    monkeypatch.setattr(bundleseg, 'MDF_PAIRS_CHUNK_SIZE', 5)
+    indices, distances = find_nearest_mdf(streamlines, ref_streamlines, 8)
+    assert np.array_equal(indices, expected[0])
+    assert np.allclose(distances, expected[1])
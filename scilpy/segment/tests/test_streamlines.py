@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
+import nibabel as nib
+import numpy as np
+
+from scilpy.segment import streamlines as segment_streamlines
+from scilpy.segment.streamlines import (filter_cuboid, filter_ellipsoid,
+                                        filter_grid_roi, filter_grid_rois)
+
+
+def _get_sft():
+    streamlines = [np.array([[1.5, 1.5, 1.5], [5.5, 5.5, 5.5]]),
+                   np.array([[5.5, 5.5, 5.5], [1.5, 1.5, 1.5],
+                             [8.5, 8.5, 8.5]]),
+                   np.array([[1.5, 1.5, 1.5], [5.5, 1.5, 1.5],
+                             [1.5, 1.5, 1.5]]),
+                   np.array([[8.5, 8.5, 8.5], [1.5, 1.5, 1.5],
+                             [8.5, 8.5, 8.5]])]
+    reference = nib.Nifti1Image(np.zeros((10, 10, 10), dtype=np.uint8),
+                                np.eye(4))
+    return StatefulTractogram(streamlines, reference, Space.VOX,
+                              origin=Origin('corner'))
+
+
+def test_filter_grid_roi_endpoints():
+    mask = np.zeros((10, 10, 10), dtype=np.uint8)
+    mask[1, 1, 1] = 1
+
+    ids = filter_grid_roi(_get_sft(), mask, 'either_end', False)
+    assert np.array_equal(ids, [0, 2])
+
+    ids = filter_grid_roi(_get_sft(), mask, 'both_ends', False)
+    assert np.array_equal(ids, [2])
+
+    ids = filter_grid_roi(_get_sft(), mask, 'either_end', True)
+    assert np.array_equal(ids, [1, 3])
+
+    ids = filter_grid_roi(_get_sft(), mask, 'any', False)
+    assert np.array_equal(ids, [0, 1, 2, 3])
+
+
+def test_filter_grid_rois():
+    mask_1 = np.zeros((10, 10, 10), dtype=np.uint8)
+    mask_1[1, 1, 1] = 1
+    mask_2 = np.zeros((10, 10, 10), dtype=np.uint8)
+    mask_2[0:7, 0:7, 0:7] = 1
+    masks = [mask_1, mask_1, mask_2, mask_2, mask_1]
+    modes = ['either_end', 'both_ends', 'all', 'any', 'any']
+    is_excludes = [False, False, False, True, False]
+    distances = [0, 0, 0, 0, 1]
+
+    selected = filter_grid_rois(_get_sft(), masks, modes, is_excludes,
+                                distances)
+    assert selected.shape == (4, 5)
+    for i in range(5):
+        ids = filter_grid_roi(_get_sft(), masks[i], modes[i],
+                              is_excludes[i], distances[i])
+        assert np.array_equal(np.where(selected[:, i])[0], ids)
+    assert np.array_equal(np.where(selected[:, 2])[0], [0, 2])
+
+
+def test_filter_grid_rois_parallel(monkeypatch):
+    mask = np.zeros((10, 10, 10), dtype=np.uint8)
+    mask[0:7, 0:7, 0:7] = 1
+    masks = [mask, mask]
+    modes = ['all', 'either_end']
+    is_excludes = [False, True]
+
+    expected = filter_grid_rois(_get_sft(), masks, modes, is_excludes)
+
+    # One streamline per chunk: the chunks are fed to the pool lazily.
+    monkeypatch.setattr(segment_streamlines, 'CHUNK_SIZE', 1)
+    selected = filter_grid_rois(_get_sft(), masks, modes, is_excludes,
+                                nbr_processes=2)
+    assert np.array_equal(selected, expected)
+
+
+def test_filter_empty_sft():
+    sft = _get_sft()[[]]
+    selected = np.zeros((len(sft), 3), dtype=bool)
+
+    ids = filter_grid_roi(sft, np.ones((10, 10, 10), dtype=np.uint8),
+                          'any', False)
+    selected[ids, 0] = True
+    ids, _ = filter_ellipsoid(sft, [2, 2, 2], [5, 5, 5], 'any', False)
+    selected[ids, 1] = True
+    ids, _ = filter_cuboid(sft, [2, 2, 2], [5, 5, 5], 'any', False)
+    selected[ids, 2] = True
+    assert not np.any(selected)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+
+from dipy.segment.clustering import qbx_and_merge
+from dipy.tracking.streamline import transform_streamlines
+import nibabel as nib
+from nibabel.streamlines import ArraySequence, Tractogram
+import numpy as np
+
+from scilpy.io.streamlines import streamlines_to_memmap
+from scilpy.segment.bundleseg import BundleSeg
+from scilpy.segment.voting_scheme import (MCT, accumulate_votes,
+                                          single_recognize)
+
+
+def _get_bundle(rng, offset, nb_streamlines):
+    t = np.linspace(0, 60, 40)[:, None]
+    return [(np.hstack([t, 5 * np.sin(t / 10), 0 * t]) + offset +
+             rng.randn(40, 3)).astype(np.float32)
+            for _ in range(nb_streamlines)]
+
+
+def test_accumulate_votes():
+    all_recognized = [(0, np.array([1, 3]), np.array([0.5, 1.0])),
+                      (2, np.array([3]), np.array([0.2])),
+                      (0, np.array([3, 4]), np.array([0.5, 0.4])),
+                      (1, np.array([], dtype=int), np.array([])),
+                      (1, None, None)]
+
+    votes, scores = accumulate_votes(iter(all_recognized), 3, 6)
+
+    assert np.array_equal(votes.toarray(), [[0, 1, 0, 2, 1, 0],
+                                            [0, 0, 0, 0, 0, 0],
+                                            [0, 0, 0, 1, 0, 0]])
+    assert np.allclose(scores.toarray(), [[0, 0.5, 0, 1.5, 0.4, 0],
+                                          [0, 0, 0, 0, 0, 0],
+                                          [0, 0, 0, 0.2, 0, 0]])
+
+
+def test_single_recognize_model_cache(tmp_path):
+    rng = np.random.RandomState(0)
+    wb_streamlines = ArraySequence(_get_bundle(rng, [0, 0, 0], 100) +
+                                   _get_bundle(rng, [0, 40, 0], 100))
+    model_filepath = str(tmp_path / 'bundle_1.trk')
+    nib.streamlines.save(Tractogram(_get_bundle(rng, [0, 0, 0], 30),
+                                    affine_to_rasmm=np.eye(4)),
+                         model_filepath)
+    cache_dir = str(tmp_path / 'cache')
+    os.mkdir(cache_dir)
+
+    cluster_map = qbx_and_merge(wb_streamlines, [45, 35, 25, 8], nb_pts=12,
+                                rng=np.random.RandomState(0), verbose=False)
+    clusters_indices = ArraySequence([c.indices
+                                      for c in cluster_map.clusters])
+    clusters_indices._data = clusters_indices._data.astype(np.uint32)
+    tmp_dir, memmap_filenames = streamlines_to_memmap(wb_streamlines,
+                                                      'float16')
+
+    # Sheared and anisotropic: resampling does not commute with it.
+    transformation = np.array([[1.05, 0.02, 0, 1],
+                               [0, 0.97, 0.03, -2],
+                               [0.01, 0, 1.02, 0.5],
+                               [0, 0, 0, 1]])
+
+    def _get_bsg():
+        return BundleSeg(memmap_filenames, transformation, clusters_indices,
+                         ArraySequence(cluster_map.centroids),
+                         rng=np.random.RandomState(0))
+
+    # Baseline: full-resolution model transformed, then recognized.
+    np.random.seed(0)
+    model_bundle = transform_streamlines(
+        nib.streamlines.load(model_filepath).streamlines, transformation)
+    expected_indices, expected_scores = _get_bsg().recognize(
+        model_bundle, model_clust_thr=MCT, pruning_thr=8)
+    assert len(expected_indices) > 0
+
+    # Without cache, cache miss, then cache hit.
+    for cache in [None, cache_dir, cache_dir]:
+        bundle_id, indices, scores = single_recognize(
+            (_get_bsg(), model_filepath, 8, ['bundle_1.trk'], [0], cache))
+        assert bundle_id == 0
+        assert np.array_equal(indices, expected_indices)
+        assert np.array_equal(scores, expected_scores)
+    assert len(os.listdir(cache_dir)) == 1
@@ -17,10 +17,11 @@ from dipy.tracking.streamline import transform_streamlines
 import nibabel as nib
 from nibabel.streamlines.array_sequence import ArraySequence
 import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
 
 from scilpy.io.streamlines import streamlines_to_memmap, \
-    reconstruct_streamlines_from_memmap
-from scilpy.segment.bundleseg import BundleSeg
+    reconstruct_streamlines_from_memmap, resampled_streamlines_to_memmap
+from scilpy.segment.bundleseg import BundleSeg, load_model_bundle
 from scilpy.utils import get_duration
 
 logger = logging.getLogger('BundleSeg')
@@ -32,10 +33,15 @@ MCT, TCT = 4, 12
 # TCT means Tractogram Clustering Threshold (mm)
 # MCT means Model Clustering Threshold (mm)
 
+# Number of (bundle, streamline) votes kept in coordinates format before
+# being added to the sparse vote and score matrices.
+NB_PENDING_VOTES = 2 ** 22
+
 
 class VotingScheme(object):
     def __init__(self, config, atlas_directory, transformation,
-                 output_directory, minimal_vote_ratio=0.5):
+                 output_directory, minimal_vote_ratio=0.5,
+                 model_cache_dir=None, use_wb_index=False):
         """
         Parameters
         ----------
@@ -54,9 +60,19 @@ class VotingScheme(object):
         multi_parameters : int
             Number of runs BundleSeg will performed.
             Enough parameter choices must be provided.
+        model_cache_dir : str, optional
+            Directory where the parsed models are cached (see
+            bundleseg.load_model_bundle). Can be shared across subjects.
+            If None, models are loaded at each run.
+        use_wb_index : bool
+            If True, the whole-brain tractogram is resampled once (12 points)
+            and saved on disk, and the final pruning of every bundle reads
+            its neighbors from it (see BundleSeg).
         """
         self.config = config
         self.minimal_vote_ratio = minimal_vote_ratio
+        self.model_cache_dir = model_cache_dir
+        self.use_wb_index = use_wb_index
 
         # Scripts parameters
         if isinstance(atlas_directory, list):
@@ -111,12 +127,35 @@ class VotingScheme(object):
 
         return model_bundles_dict, bundle_names, bundle_counts
 
+    @staticmethod
+    def _get_sparse_row(matrix, row):
+        """
+        Column indices (sorted) and values of the non-zero elements of a row
+        of a csr_matrix, without converting to dense.
+        """
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        return matrix.indices[start:end], matrix.data[start:end]
+
+    def _get_sparse_values(self, matrix, row, columns):
+        """
+        Values of a csr_matrix at the given columns of a row (0 if absent).
+        """
+        row_columns, row_values = self._get_sparse_row(matrix, row)
+        values = np.zeros(len(columns), dtype=matrix.dtype)
+        if len(row_columns) == 0:
+            return values
+
+        pos = np.searchsorted(row_columns, columns)
+        pos = np.minimum(pos, len(row_columns) - 1)
+        found = row_columns[pos] == columns
+        values[found] = row_values[pos[found]]
+        return values
+
     def _find_max_in_sparse_matrix(self, bundle_id, min_vote,
                                    bundles_wise_vote):
         """
-        Will find the maximum values of a specific row (bundle_id), make
-        sure they are the maximum values across bundles (argmax) and above the
-        min_vote threshold. Return the indices respecting all three conditions.
+        Will find the values of a specific row (bundle_id) that are above the
+        min_vote threshold. Return the indices respecting this condition.
 
         Parameters
         ----------
@@ -131,16 +170,17 @@ class VotingScheme(object):
         -------
         streamlines_ids : numpy.ndarray
             Indices of the streamlines that are above the min_vote
-            threshold and are the maximum values across bundles.
+            threshold, sorted.
         """
         if min_vote == 0:
             streamlines_ids = np.asarray([], dtype=np.uint32)
             return streamlines_ids
 
-        streamlines_ids = np.argwhere(bundles_wise_vote[bundle_id] >= min_vote)
-        streamlines_ids = np.asarray(streamlines_ids, dtype=np.uint32)
+        streamlines_ids, votes = self._get_sparse_row(bundles_wise_vote,
+                                                      bundle_id)
+        streamlines_ids = streamlines_ids[votes >= min_vote]
 
-        return np.squeeze(streamlines_ids)
+        return np.sort(streamlines_ids).astype(np.uint32)
 
     def _save_recognized_bundles(self, memmap_filenames, reference,
                                  bundle_names,
@@ -158,10 +198,11 @@ class VotingScheme(object):
         bundle_names : list
             Bundle names as defined in the configuration file.
             Will save the bundle using that filename and the extension.
-        bundles_wise_vote : lil_matrix
-            Array of vote of shape (nbr_bundles x nbr_streamlines).
-        bundles_wise_score : lil_matrix
-            Array of score of shape (nbr_bundles x nbr_streamlines).
+        bundles_wise_vote : scipy.sparse.csr_matrix
+            Sparse matrix of votes of shape (nbr_bundles x nbr_streamlines).
+        bundles_wise_score : scipy.sparse.csr_matrix
+            Sparse matrix of the sum of scores of shape
+            (nbr_bundles x nbr_streamlines).
         minimum_vote : np.ndarray
             Value for the vote ratio for a streamline to be considered.
             (0 < minimal_vote < 1)
@@ -174,8 +215,6 @@ class VotingScheme(object):
                 bundle_id,
                 minimum_vote[bundle_id],
                 bundles_wise_vote)
-            if streamlines_id.ndim == 0:
-                continue
 
             logger.info(f'{bundle_names[bundle_id]} final recognition got '
                         f'{len(streamlines_id)} streamlines')
@@ -199,8 +238,11 @@ class VotingScheme(object):
             curr_results_dict = {}
             curr_results_dict['indices'] = streamlines_id.tolist()
 
-            scores = bundles_wise_score[bundle_id,
-                                        streamlines_id].flatten()
+            # Average score over the votes
+            votes = self._get_sparse_values(bundles_wise_vote, bundle_id,
+                                            streamlines_id)
+            scores = self._get_sparse_values(bundles_wise_score, bundle_id,
+                                             streamlines_id) / votes
             curr_results_dict['scores'] = scores.tolist()
             results_dict[basename] = curr_results_dict
 
@@ -265,6 +307,16 @@ class VotingScheme(object):
         tmp_dir, tmp_memmap_filenames = streamlines_to_memmap(wb_streamlines,
                                                               'float16')
 
+        wb_index = None
+        if self.use_wb_index:
+            index_timer = time()
+            wb_index_filename = os.path.join(tmp_dir.name, 'resampled.dat')
+            wb_index = (wb_index_filename,
+                        resampled_streamlines_to_memmap(wb_streamlines,
+                                                        wb_index_filename))
+            logger.info('Resampling of the whole-brain tractogram took '
+                        f'{get_duration(index_timer)} sec.')
+
         # Memory cleanup (before multiprocessing)
         cluster_map.refdata = None
         for ref in gc.get_referrers(cluster_map) + \
@@ -277,9 +329,10 @@ class VotingScheme(object):
         # End of memory cleanup
 
         bsg = BundleSeg(tmp_memmap_filenames, self.transformation,
-                        clusters_indices, centroids)
+                        clusters_indices, centroids, wb_index=wb_index)
 
         # Update all BundleSeg initialisation into a single dictionnary
+        # Votes are accumulated as the results arrive.
         with Manager() as manager:
             model_bundles_dict = manager.dict(model_bundles_dict)
             pool = multiprocessing.Pool(nbr_processes)
@@ -287,32 +340,16 @@ class VotingScheme(object):
                 single_recognize,
                 zip(repeat(bsg), model_bundles_dict.keys(),
                     model_bundles_dict.values(),
-                    repeat(bundle_names), repeat([seed])))
+                    repeat(bundle_names), repeat([seed]),
+                    repeat(self.model_cache_dir)))
+            bundles_wise_vote, bundles_wise_score = accumulate_votes(
+                all_recognized_dict, len(bundle_names), len_wb_streamlines)
             pool.close()
             pool.join()
 
         logger.info(f'BundleSeg took {get_duration(total_timer)} sec. for '
                     f'{len(bundle_names)} bundles from {len(self.atlas_dir)} atlas')
 
-        bundles_wise_vote = np.zeros((len(bundle_names),
-                                      len_wb_streamlines),
-                                     dtype=np.uint8)
-        bundles_wise_score = np.zeros((len(bundle_names),
-                                       len_wb_streamlines),
-                                      dtype=np.float16)
-
-        for bundle_id, recognized_indices, recognized_scores in all_recognized_dict:
-            if recognized_indices is not None:
-                if len(recognized_indices) == 0:
-                    continue
-
-                bundles_wise_vote[bundle_id, recognized_indices.T] += 1
-                bundles_wise_score[bundle_id,
-                                   recognized_indices.T] += recognized_scores
-
-        bundles_wise_score[bundles_wise_vote != 0] \
-            /= bundles_wise_vote[bundles_wise_vote != 0]
-
         # Once everything was run, save the results using a voting system
         minimum_vote = np.array(bundle_count) * self.minimal_vote_ratio
         minimum_vote[np.logical_and(minimum_vote > 0, minimum_vote < 1)] = 1
@@ -334,6 +371,82 @@ class VotingScheme(object):
                     f'{get_duration(save_timer)} sec.')
 
 
+def _coo_to_csr(rows, cols, data, shape, dtype):
+    """ Sparse matrix from coordinates, duplicates being summed. """
+    if len(rows) > 0:
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        data = np.concatenate(data)
+    matrix = coo_matrix((np.asarray(data, dtype=dtype), (rows, cols)),
+                        shape=shape).tocsr()
+    matrix.sum_duplicates()
+    return matrix
+
+
+def accumulate_votes(all_recognized, nbr_bundles, nbr_streamlines):
+    """
+    Accumulate the results of the recognition of each model into sparse
+    matrices of votes and scores. Each streamline is recognized by a few
+    bundles only, so only the (bundle, streamline) pairs with a vote are
+    stored.
+
+    Parameters
+    ----------
+    all_recognized : iterable
+        Results of single_recognize: tuples (bundle_id, recognized_indices,
+        recognized_scores). Can be consumed as they arrive.
+    nbr_bundles : int
+        Number of bundles.
+    nbr_streamlines : int
+        Number of streamlines in the tractogram.
+
+    Returns
+    -------
+    bundles_wise_vote : scipy.sparse.csr_matrix
+        Number of votes of shape (nbr_bundles x nbr_streamlines).
+    bundles_wise_score : scipy.sparse.csr_matrix
+        Sum of scores of shape (nbr_bundles x nbr_streamlines).
+    """
+    shape = (nbr_bundles, nbr_streamlines)
+    bundles_wise_vote = csr_matrix(shape, dtype=np.uint16)
+    bundles_wise_score = csr_matrix(shape, dtype=np.float32)
+
+    rows, cols, scores = [], [], []
+    nb_pending = 0
+    for bundle_id, recognized_indices, recognized_scores in all_recognized:
+        if recognized_indices is None or len(recognized_indices) == 0:
+            continue
+
+        recognized_indices = np.ravel(recognized_indices)
+        rows.append(np.full(len(recognized_indices), bundle_id,
+                            dtype=np.int64))
+        cols.append(recognized_indices)
+        scores.append(np.ravel(recognized_scores))
+        nb_pending += len(recognized_indices)
+
+        if nb_pending >= NB_PENDING_VOTES:
+            bundles_wise_vote, bundles_wise_score = _add_votes(
+                bundles_wise_vote, bundles_wise_score, rows, cols, scores)
+            rows, cols, scores = [], [], []
+            nb_pending = 0
+
+    return _add_votes(bundles_wise_vote, bundles_wise_score,
+                      rows, cols, scores)
+
+
+def _add_votes(bundles_wise_vote, bundles_wise_score, rows, cols, scores):
+    shape = bundles_wise_vote.shape
+    votes = [np.ones(len(c), dtype=np.uint16) for c in cols]
+
+    bundles_wise_vote = bundles_wise_vote + \
+        _coo_to_csr(rows, cols, votes, shape, np.uint16)
+    bundles_wise_score = bundles_wise_score + \
+        _coo_to_csr(rows, cols, scores, shape, np.float32)
+    bundles_wise_vote.sort_indices()
+    bundles_wise_score.sort_indices()
+    return bundles_wise_vote, bundles_wise_score
+
+
 def single_recognize_parallel(args):
     """Wrapper function to multiprocess recobundles execution."""
     rbx = args[0]
@@ -363,6 +476,8 @@ def single_recognize(args):
         List of string with bundle names for models (to get bundle_id)
     seed : int
         Value to initialize the RandomState of numpy
+    model_cache_dir : str
+        Directory of the models cache. If None, no cache is used.
 
     Returns
     -------
@@ -379,8 +494,13 @@ def single_recognize(args):
     bundle_pruning_thr = args[2]
     bundle_names = args[3]
     np.random.seed(args[4][0])
+    model_cache_dir = args[5]
 
-    model_bundle = nib.streamlines.load(model_filepath).streamlines
+    # Only the parsing of the model can be cached (once for all subjects): it
+    # is resampled and clustered in subject space, as QBx and the pruning are
+    # not invariant to the transformation.
+    model_bundle = load_model_bundle(model_filepath,
+                                     cache_dir=model_cache_dir)
     model_bundle = transform_streamlines(model_bundle,
                                          bsg.transformation)
 
@@ -1,45 +1,65 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import itertools
 import logging
+import os
+import tempfile
 
 import bct
 
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.stats import t as stats_t
 from statsmodels.stats.multitest import multipletests
 
 from scilpy.tractanalysis.reproducibility_measures import compute_dice_voxel
+from scilpy.utils.parallel import SharedArray, get_nbr_processes, get_pool
 
+# Permutations are drawn and computed by batches, as matrix products.
+NB_PERMUTATIONS_PER_BATCH = 100
 
-def _ttest_stat_only(x, y, tail):
-    t = np.mean(x) - np.mean(y)
-    n1, n2 = len(x), len(y)
-    s = np.sqrt(((n1 - 1) * np.var(x, ddof=1) + (n2 - 1)
-                 * np.var(y, ddof=1)) / (n1 + n2 - 2))
-    denom = s * np.sqrt(1 / n1 + 1 / n2)
-    if denom == 0:
-        return 0
+# Number of random and lattice null models for the small-world coefficients.
+NB_NULL_MODELS = 10
+
+
+def _apply_tail(t, tail):
     if tail == 'both':
-        return np.abs(t / denom)
+        return np.abs(t)
     if tail == 'left':
-        return -t / denom
+        return -t
     else:
-        return t / denom
+        return t
+
+
+def _ttest_stat_only(x, y, tail):
+    """
+    Two-sample t statistic, on the last axis. Returns 0 where the pooled
+    standard deviation is 0.
+    """
+    t = np.mean(x, axis=-1) - np.mean(y, axis=-1)
+    n1, n2 = x.shape[-1], y.shape[-1]
+    s = np.sqrt(((n1 - 1) * np.var(x, ddof=1, axis=-1) + (n2 - 1)
+                 * np.var(y, ddof=1, axis=-1)) / (n1 + n2 - 2))
+    denom = s * np.sqrt(1 / n1 + 1 / n2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(denom == 0, 0, t / denom)
+    return _apply_tail(t, tail)
 
 
 def _ttest_paired_stat_only(x, y, tail):
-    n = len(x - y)
-    sample_ss = np.sum((x - y)**2) - np.sum(x - y)**2 / n
+    """
+    Paired t statistic, on the last axis.
+    """
+    n = x.shape[-1]
+    sample_ss = np.sum((x - y)**2, axis=-1) - \
+        np.sum(x - y, axis=-1)**2 / n
     unbiased_std = np.sqrt(sample_ss / (n - 1))
 
-    z = np.mean(x - y) / unbiased_std
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.mean(x - y, axis=-1) / unbiased_std
     t = z * np.sqrt(n)
-    if tail == 'both':
-        return np.abs(t)
-    if tail == 'left':
-        return -t
-    else:
-        return t
+    return _apply_tail(t, tail)
 
 
 def ttest_two_matrices(matrices_g1, matrices_g2, paired, tail, fdr,
@@ -47,8 +67,8 @@ def ttest_two_matrices(matrices_g1, matrices_g2, paired, tail, fdr,
     """
     Parameters
     ----------
-    matrices_g1: np.ndarray of shape ?  (toDO)
-    matrices_g2: np.ndarray of shape ?
+    matrices_g1: np.ndarray of shape (N, N, nb_subjects_g1)
+    matrices_g2: np.ndarray of shape (N, N, nb_subjects_g2)
     paired: bool
         Use paired sample t-test instead of population t-test. The two matrices
         must be ordered the same way.
@@ -91,20 +111,20 @@ def ttest_two_matrices(matrices_g1, matrices_g2, paired, tail, fdr,
     else:
         dof = nb_group_g1 + nb_group_g2 - 2
 
-    for ind in range(np.prod(matrix_shape)):
-        # Skip edges with no data, leaves a negative epsilon instead
-        if not matrices_g1[ind].any() and not matrices_g2[ind].any():
-            continue
+    # Skip edges with no data, leaves a negative epsilon instead
+    has_data = np.logical_or(np.any(matrices_g1, axis=1),
+                             np.any(matrices_g2, axis=1))
 
-        if paired:
-            t_stat = (_ttest_paired_stat_only(
-                matrices_g1[ind], matrices_g2[ind], tail))
-        else:
-            t_stat = _ttest_stat_only(
-                matrices_g1[ind], matrices_g2[ind], tail)
+    # All edges at once, as rows of the (N², nb_subjects) arrays.
+    if paired:
+        t_stat = _ttest_paired_stat_only(
+            matrices_g1[has_data], matrices_g2[has_data], tail)
+    else:
+        t_stat = _ttest_stat_only(
+            matrices_g1[has_data], matrices_g2[has_data], tail)
 
-        pval = stats_t.sf(t_stat, dof)
-        matrix_pval[ind] = pval if tail == 'both' else pval / 2.0
+    pval = stats_t.sf(t_stat, dof)
+    matrix_pval[has_data] = pval if tail == 'both' else pval / 2.0
 
     corr_matrix_pval = matrix_pval.reshape(matrix_shape)
     if fdr:
@@ -130,7 +150,299 @@ def ttest_two_matrices(matrices_g1, matrices_g2, paired, tail, fdr,
     return matrix_pval
 
 
-def omega_sigma(matrix):
+def _permuted_ttest_stats(data, permutations, nb_g1, paired, tail):
+    """
+    t statistics of all edges, for a batch of permutations, as matrix
+    products.
+
+    Parameters
+    ----------
+    data: np.ndarray of shape (nb_edges, nb_subjects)
+        Unpaired: the subjects of g1, then those of g2. Paired: the
+        differences g1 - g2. Centered on each edge's mean (unpaired).
+    permutations: np.ndarray of shape (nb_permutations, nb_subjects)
+        Unpaired: 1 for the subjects assigned to g1, else 0. Paired: the sign
+        of each difference (1 or -1).
+    nb_g1: int
+        Number of subjects in g1.
+    paired: bool
+        Paired or population t-test.
+    tail: str
+        One of ['left', 'right', 'both'].
+
+    Returns
+    -------
+    stats: np.ndarray of shape (nb_edges, nb_permutations)
+        The statistics. 0 where the standard deviation is 0.
+    """
+    n = data.shape[1]
+    sum_sq = np.sum(data ** 2, axis=1)[:, None]
+    # Below this, sums of squares are rounding errors: the std is 0.
+    tol = 1e-12 * sum_sq
+
+    if paired:
+        sums = data @ permutations.T
+        sample_ss = sum_sq - sums ** 2 / n
+        diff = sums / n
+        std_factor = 1 / (max(n - 1, 1) * n)
+    else:
+        n1, n2 = nb_g1, n - nb_g1
+        sums_1 = data @ permutations.T
+        sum_sq_1 = data ** 2 @ permutations.T
+        sums_2 = np.sum(data, axis=1)[:, None] - sums_1
+        sum_sq_2 = sum_sq - sum_sq_1
+        sample_ss = (sum_sq_1 - sums_1 ** 2 / n1) + \
+            (sum_sq_2 - sums_2 ** 2 / n2)
+        diff = sums_1 / n1 - sums_2 / n2
+        std_factor = (1 / n1 + 1 / n2) / max(n - 2, 1)
+
+    # std_factor * sample_ss is the variance of diff.
+    is_null = sample_ss <= tol
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(is_null, 0, diff / np.sqrt(std_factor * sample_ss))
+    return _apply_tail(t, tail)
+
+
+def _max_component_sizes(is_supra, rows, cols, nb_nodes):
+    """
+    Size (number of edges) of the largest connected component formed by the
+    supra-threshold edges, for each permutation (column of is_supra).
+    """
+    sizes = np.zeros(is_supra.shape[1], dtype=int)
+    for i in range(is_supra.shape[1]):
+        component_sizes = _get_components(is_supra[:, i], rows, cols,
+                                          nb_nodes)[1]
+        if len(component_sizes) > 0:
+            sizes[i] = np.max(component_sizes)
+    return sizes
+
+
+def _get_components(is_supra, rows, cols, nb_nodes):
+    """
+    Connected components of the graph formed by the supra-threshold edges.
+
+    Returns
+    -------
+    edge_components: np.ndarray of shape (nb_supra_edges,)
+        The component of each supra-threshold edge.
+    sizes: np.ndarray
+        The number of edges of each component.
+    """
+    graph = coo_matrix((np.ones(np.count_nonzero(is_supra)),
+                        (rows[is_supra], cols[is_supra])),
+                       shape=(nb_nodes, nb_nodes))
+    node_components = connected_components(graph, directed=False)[1]
+    edge_components = node_components[rows[is_supra]]
+    _, edge_components, sizes = np.unique(edge_components,
+                                          return_inverse=True,
+                                          return_counts=True)
+    return edge_components, sizes
+
+
+def _permutation_batch(data, nb_g1, paired, tail, seed, nb_permutations,
+                       rows, cols, nb_nodes, nbs_threshold):
+    """
+    Computes the null distribution for one batch of permutations.
+
+    Returns
+    -------
+    max_stats: np.ndarray of shape (nb_permutations,)
+        The maximal statistic over all edges, for each permutation.
+    max_sizes: np.ndarray of shape (nb_permutations,) or None
+        With NBS, the size of the largest component, for each permutation.
+    """
+    rng = np.random.default_rng(seed)
+    n = data.shape[1]
+    if paired:
+        permutations = rng.choice([-1., 1.], size=(nb_permutations, n))
+    else:
+        labels = np.zeros(n)
+        labels[:nb_g1] = 1
+        permutations = rng.permuted(np.tile(labels, (nb_permutations, 1)),
+                                    axis=1)
+
+    stats = _permuted_ttest_stats(data, permutations, nb_g1, paired, tail)
+    max_stats = np.max(stats, axis=0)
+    max_sizes = None
+    if nbs_threshold is not None:
+        max_sizes = _max_component_sizes(stats > nbs_threshold, rows, cols,
+                                         nb_nodes)
+    return max_stats, max_sizes
+
+
+def _permutation_batch_parallel(args):
+    data_descriptor = args[0]
+    shm, data = SharedArray.attach(data_descriptor)
+    try:
+        return _permutation_batch(data, *args[1:])
+    finally:
+        del data
+        shm.close()
+
+
+def permutation_test_two_matrices(matrices_g1, matrices_g2, paired, tail,
+                                  nb_permutations=1000, nbs_threshold=None,
+                                  seed=None, nbr_processes=1):
+    """
+    Edge-wise t-test between two populations, with p-values corrected for
+    the family-wise error (FWE) by permutation testing.
+
+    Without nbs_threshold, uses the maximal statistic: the p-value of an
+    edge is the proportion of permutations where the maximal statistic over
+    all edges reaches the edge's statistic.
+
+    With nbs_threshold, uses the network-based statistic (NBS) [1]: edges
+    with a statistic > nbs_threshold are grouped in connected components,
+    whose size (number of edges) is compared to the largest component of
+    each permutation. All edges of a component get the component's p-value.
+    Other tested edges get a p-value of 1.
+
+    Only the upper triangle of the matrices is tested (the matrices are
+    considered symmetric), and the output is symmetrized. Edges with no
+    data get a negative epsilon, as in ttest_two_matrices.
+
+    Parameters
+    ----------
+    matrices_g1: np.ndarray of shape (N, N, nb_subjects_g1)
+    matrices_g2: np.ndarray of shape (N, N, nb_subjects_g2)
+    paired: bool
+        Use paired sample t-test instead of population t-test. Permutations
+        then flip the sign of the differences instead of shuffling the
+        subjects between groups.
+    tail: str.
+        One of ['left', 'right', 'both'].
+    nb_permutations: int
+        Number of permutations.
+    nbs_threshold: float, optional
+        Threshold on the t statistic defining the supra-threshold edges, for
+        NBS. If None, the maximal statistic is used instead.
+    seed: int, optional
+        Seed of the random permutations. Permutations are drawn by batches of
+        NB_PERMUTATIONS_PER_BATCH, each with its own seed derived from it:
+        results do not depend on the number of processes.
+    nbr_processes: int
+        Number of processes. Batches of permutations are distributed to the
+        processes.
+
+    Returns
+    -------
+    matrix_pval: np.ndarray of shape (N, N)
+        The FWE-corrected p-values.
+
+    References
+    ----------
+    [1] Zalesky, Andrew, Alex Fornito, and Edward T. Bullmore.
+        "Network-based statistic: identifying differences in brain networks."
+        Neuroimage 53.4 (2010): 1197-1207.
+    """
+    matrix_shape = matrices_g1.shape[0:2]
+    nb_g1 = matrices_g1.shape[2]
+
+    # Tested edges: upper triangle, with data.
+    has_data = np.logical_or(np.any(matrices_g1, axis=2),
+                             np.any(matrices_g2, axis=2))
+    rows, cols = np.nonzero(np.triu(has_data))
+    logging.info('Performing {} permutations on {} edges.'
+                 .format(nb_permutations, len(rows)))
+
+    if paired:
+        data = matrices_g1[rows, cols] - matrices_g2[rows, cols]
+        observed = np.ones((1, nb_g1))
+    else:
+        data = np.concatenate((matrices_g1[rows, cols],
+                               matrices_g2[rows, cols]), axis=1)
+        # Centering each edge reduces rounding errors. The statistic does not
+        # change.
+        data = data - np.mean(data, axis=1, keepdims=True)
+        observed = np.zeros((1, data.shape[1]))
+        observed[0, :nb_g1] = 1
+    data = np.asarray(data, dtype=float)
+    stats = _permuted_ttest_stats(data, observed, nb_g1, paired, tail)[:, 0]
+
+    batches = np.diff(np.append(np.arange(0, nb_permutations,
+                                          NB_PERMUTATIONS_PER_BATCH),
+                                nb_permutations))
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    args = [(nb_g1, paired, tail, batch_seed, nb_batch, rows, cols,
+             matrix_shape[0], nbs_threshold)
+            for batch_seed, nb_batch in zip(seeds, batches)]
+
+    nbr_processes = get_nbr_processes(nbr_processes)
+    if nbr_processes == 1 or len(batches) <= 1:
+        results = [_permutation_batch(data, *a) for a in args]
+    else:
+        shared_data = SharedArray(data.shape, data.dtype, data)
+        try:
+            results = get_pool(nbr_processes).map(
+                _permutation_batch_parallel,
+                [(shared_data.descriptor,) + a for a in args])
+        finally:
+            shared_data.release()
+
+    edge_pval = np.ones(len(rows))
+    if nbs_threshold is None:
+        max_stats = np.sort(np.concatenate([r[0] for r in results]))
+        nb_larger = nb_permutations - np.searchsorted(max_stats, stats)
+        edge_pval = (nb_larger + 1) / (nb_permutations + 1)
+    else:
+        max_sizes = np.sort(np.concatenate([r[1] for r in results]))
+        is_supra = stats > nbs_threshold
+        edge_components, sizes = _get_components(is_supra, rows, cols,
+                                                 matrix_shape[0])
+        logging.info('Found {} supra-threshold components, of sizes {}.'
+                     .format(len(sizes), sizes))
+        nb_larger = nb_permutations - np.searchsorted(max_sizes, sizes)
+        edge_pval[is_supra] = ((nb_larger + 1) /
+                               (nb_permutations + 1))[edge_components]
+
+    # Negative epsilon, to differentiate from null p-values
+    matrix_pval = np.ones(matrix_shape) * -0.000001
+    matrix_pval[rows, cols] = edge_pval
+    matrix_pval[cols, rows] = edge_pval
+
+    return matrix_pval
+
+
+def _null_models_measures(args):
+    """
+    Generates one random and one lattice null model of a matrix, and returns
+    their measures (random transitivity, lattice transitivity, random path
+    length).
+    """
+    matrix, seed_rand, seed_latt = args
+    random = bct.randmio_und(matrix, 10, seed=seed_rand)[0]
+    lattice = bct.latmio_und(matrix, 10, seed=seed_latt)[1]
+
+    return (bct.transitivity_wu(random), bct.transitivity_wu(lattice),
+            float(np.average(bct.distance_wei(random)[0])))
+
+
+def get_null_models_cache_filename(cache_dir, matrix, seed=None):
+    """
+    Filename of the cached null models measures, keyed by the hash of the
+    matrix (and the seed, if any).
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache.
+    matrix : numpy.ndarray
+        The matrix.
+    seed : int, optional
+        Seed of the null models.
+
+    Returns
+    -------
+    cache_filename : str
+    """
+    matrix = np.ascontiguousarray(matrix)
+    matrix_hash = hashlib.sha256(matrix.tobytes())
+    matrix_hash.update('{}_{}'.format(matrix.shape, matrix.dtype).encode())
+    return os.path.join(cache_dir, '{}_{}.npz'.format(matrix_hash.hexdigest(),
+                                                      seed))
+
+
+def omega_sigma(matrix, nbr_processes=1, seed=None, cache_dir=None):
     """Returns the small-world coefficients (omega & sigma) of a graph.
     Omega ranges between -1 and 1. Values close to 0 mean the matrix
     features small-world characteristics.
@@ -143,6 +455,15 @@ def omega_sigma(matrix):
     ----------
     matrix : numpy.ndarray
         A weighted undirected graph.
+    nbr_processes : int
+        Number of processes. The null models are generated in parallel.
+    seed : int, optional
+        Seed of the null models. Results do not depend on nbr_processes.
+    cache_dir : str, optional
+        Directory of the cache. If given, the measures of the null models are
+        read from the cache when available, else computed and added to the
+        cache, so that other runs on the same matrix do not have to generate
+        them again. If None, no cache is used.
     Returns
     -------
     smallworld : tuple of float
@@ -157,25 +478,44 @@ def omega_sigma(matrix):
            Brain Connectivity. 1 (0038): 367-75.  PMC 3604768. PMID 22432451.
            doi:10.1089/brain.2011.0038.
     """
-    transitivity_rand_list = []
-    transitivity_latt_list = []
-    path_length_rand_list = []
-    for i in range(10):
-        logging.info('Generating random and lattice matrices, '
-                     'iteration #{}.'.format(i))
-        random = bct.randmio_und(matrix, 10)[0]
-        lattice = bct.latmio_und(matrix, 10)[1]
-
-        transitivity_rand_list.append(bct.transitivity_wu(random))
-        transitivity_latt_list.append(bct.transitivity_wu(lattice))
-        path_length_rand_list.append(
-            float(np.average(bct.distance_wei(random)[0])))
+    cache_filename = None
+    null_measures = None
+    if cache_dir is not None:
+        cache_filename = get_null_models_cache_filename(cache_dir, matrix,
+                                                        seed)
+        if os.path.isfile(cache_filename):
+            logging.info('Reading the null models measures from the cache.')
+            with np.load(cache_filename) as cache:
+                null_measures = cache['null_measures']
+
+    if null_measures is None:
+        logging.info('Generating {} random and lattice matrices.'
+                     .format(NB_NULL_MODELS))
+        # One seed per null model (for both randmio_und and latmio_und).
+        seeds = [s.generate_state(2) for s in
+                 np.random.SeedSequence(seed).spawn(NB_NULL_MODELS)]
+        tasks = [(matrix, int(s[0]), int(s[1])) for s in seeds]
+
+        nbr_processes = get_nbr_processes(nbr_processes)
+        if nbr_processes == 1:
+            null_measures = [_null_models_measures(t) for t in tasks]
+        else:
+            null_measures = get_pool(nbr_processes).map(
+                _null_models_measures, tasks)
+        null_measures = np.asarray(null_measures, dtype=float)
+
+        if cache_filename is not None:
+            # Writing in a temporary file first: other processes may be
+            # reading or writing the same null models.
+            fd, tmp_filename = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+            os.close(fd)
+            np.savez(tmp_filename, null_measures=null_measures)
+            os.replace(tmp_filename, cache_filename)
 
     transitivity = bct.transitivity_wu(matrix)
     path_length = float(np.average(bct.distance_wei(matrix)[0]))
-    transitivity_rand = np.mean(transitivity_rand_list)
-    transitivity_latt = np.mean(transitivity_latt_list)
-    path_length_rand = np.mean(path_length_rand_list)
+    transitivity_rand, transitivity_latt, path_length_rand = \
+        np.mean(null_measures, axis=0)
 
     omega = (path_length_rand / path_length) - \
         (transitivity / transitivity_latt)
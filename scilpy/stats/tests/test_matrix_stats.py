@@ -1,10 +1,120 @@
 # -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+from scipy.stats import ttest_ind, ttest_rel
+
+from scilpy.stats import matrix_stats
+from scilpy.stats.matrix_stats import (_permuted_ttest_stats,
+                                       _ttest_paired_stat_only,
+                                       _ttest_stat_only,
+                                       get_null_models_cache_filename,
+                                       omega_sigma,
+                                       permutation_test_two_matrices,
+                                       ttest_two_matrices)
+
+
+def _get_matrices(effect=0.):
+    # Symmetric matrices, with a first row/column without data and an
+    # effect on the edges between nodes 2, 3 and 4.
+    rng = np.random.default_rng(1234)
+    g1 = rng.random((10, 10, 12)) + 1
+    g2 = rng.random((10, 10, 12)) + 1
+    g1[2:5, 2:5] += effect
+    g1 = g1 + g1.transpose((1, 0, 2))
+    g2 = g2 + g2.transpose((1, 0, 2))
+    g1[0] = g1[:, 0] = g2[0] = g2[:, 0] = 0
+    return g1, g2
 
 
 def test_ttest_two_matrices():
-    # toDo
-    pass
+    g1, g2 = _get_matrices()
+
+    pval = ttest_two_matrices(g1, g2, False, 'both', False, False)
+    assert np.all(pval[0] == -0.000001)
+    expected = ttest_ind(g1[1:, 1:], g2[1:, 1:], axis=2).pvalue / 2
+    assert np.allclose(pval[1:, 1:], expected)
+
+    pval = ttest_two_matrices(g1, g2, True, 'right', False, False)
+    expected = ttest_rel(g1[1:, 1:], g2[1:, 1:], axis=2,
+                         alternative='greater').pvalue / 2
+    assert np.allclose(pval[1:, 1:], expected)
+
+    # Uniform edges: null statistic.
+    assert _ttest_stat_only(np.ones((1, 5)), np.ones((1, 4)), 'both') == 0
+
+
+def test_permuted_ttest_stats():
+    g1, g2 = _get_matrices()
+    x, y = g1[1:, 1:].reshape((-1, 12)), g2[1:, 1:].reshape((-1, 12))
+    rng = np.random.default_rng(0)
+
+    # Unpaired: shuffling the subjects between groups.
+    data = np.concatenate((x, y), axis=1)
+    permutations = np.array([rng.permutation(24) < 12 for _ in range(5)])
+    stats = _permuted_ttest_stats(data, permutations.astype(float), 12,
+                                  False, 'left')
+    for i, is_g1 in enumerate(permutations):
+        assert np.allclose(stats[:, i], _ttest_stat_only(
+            data[:, is_g1], data[:, ~is_g1], 'left'))
+
+    # Paired: flipping the signs of the differences.
+    signs = rng.choice([-1., 1.], size=(5, 12))
+    stats = _permuted_ttest_stats(x - y, signs, 12, True, 'both')
+    for i, sign in enumerate(signs):
+        assert np.allclose(stats[:, i], _ttest_paired_stat_only(
+            (x - y) * sign, np.zeros_like(x), 'both'))
+
+
+def test_permutation_test_two_matrices():
+    g1, g2 = _get_matrices(effect=1.)
+    is_effect = np.zeros((10, 10), dtype=bool)
+    is_effect[2:5, 2:5] = True
+
+    # Maximal statistic
+    pval = permutation_test_two_matrices(g1, g2, False, 'right',
+                                         nb_permutations=250, seed=0)
+    assert np.all(pval[0] == -0.000001)
+    assert np.allclose(pval, pval.T)
+    assert np.all(pval[is_effect] < 0.01)
+    assert np.all(pval[1:, 1:][~is_effect[1:, 1:]] > 0.05)
+
+    # Same results, whatever the number of processes.
+    assert np.array_equal(
+        pval, permutation_test_two_matrices(g1, g2, False, 'right',
+                                            nb_permutations=250, seed=0,
+                                            nbr_processes=2))
+
+    # NBS: the effect is one component.
+    pval = permutation_test_two_matrices(g1, g2, True, 'right',
+                                         nb_permutations=250,
+                                         nbs_threshold=4, seed=0)
+    assert np.all(pval[is_effect] == pval[2, 2])
+    assert pval[2, 2] < 0.01
+    assert np.all(pval[1:, 1:][~is_effect[1:, 1:]] == 1)
+
+
+def test_omega_sigma(tmp_path, monkeypatch):
+    # Weighted random graph, symmetric.
+    rng = np.random.default_rng(1234)
+    matrix = rng.random((20, 20)) * (rng.random((20, 20)) < 0.4)
+    matrix = np.triu(matrix, 1)
+    matrix = matrix + matrix.T
+
+    omega, sigma = omega_sigma(matrix, seed=0)
+    assert -1 <= omega <= 1
+
+    # Same results, whatever the number of processes.
+    assert (omega, sigma) == omega_sigma(matrix, nbr_processes=2, seed=0)
 
+    # Cache: the null models are not generated again.
+    assert (omega, sigma) == omega_sigma(matrix, seed=0,
+                                         cache_dir=str(tmp_path))
+    assert os.path.isfile(get_null_models_cache_filename(str(tmp_path),
+                                                         matrix, 0))
 
-def test_omega_sigma():
-    pass
+    def _fail(args):
+        raise AssertionError('Null models should be read from the cache.')
+    monkeypatch.setattr(matrix_stats, '_null_models_measures', _fail)
+    assert (omega, sigma) == omega_sigma(matrix, seed=0,
+                                         cache_dir=str(tmp_path))
@@ -71,6 +71,10 @@ class AbstractPropagator(object):
         # Will be reset at each new streamline.
         self.line_rng_generator = None
 
+    # Whether child classes implement the *_batch methods, to propagate many
+    # streamlines together.
+    supports_batch_propagation = False
+
     def reset_data(self, new_data=None):
         """
         Reset data before starting a new process. In current implementation,
@@ -255,6 +259,74 @@ class AbstractPropagator(object):
         """
         raise NotImplementedError
 
+    def prepare_forward_batch(self, seeding_pos, random_generators):
+        """
+        Equivalent of prepare_forward for N streamlines at once.
+
+        Parameters
+        ----------
+        seeding_pos: ndarray (N, 3)
+            The seeding positions, in the same space and origin as self.space,
+            self.origin.
+        random_generators: list of numpy Generators
+            One generator per streamline.
+
+        Returns
+        -------
+        v_in: tuple(ndarray (N, 3), ndarray (N,))
+            The tracking information of each streamline, as the batch
+            equivalent of a TrackingDirection: the directions and their
+            indices.
+        is_valid: ndarray (N,)
+            False where no good tracking direction can be set at the seeding
+            position (equivalent of PropagationStatus.ERROR).
+        """
+        raise NotImplementedError
+
+    def prepare_backward_batch(self, last_dirs, forward_dirs):
+        """
+        Equivalent of prepare_backward for N streamlines at once.
+
+        Parameters
+        ----------
+        last_dirs: ndarray (N, 3)
+            line[-1] - line[-2] of each reversed line, or NaNs if the line
+            contains only the seeding point.
+        forward_dirs: tuple(ndarray (N, 3), ndarray (N,))
+            v_in chosen at the forward step, as returned by
+            prepare_forward_batch.
+
+        Returns
+        -------
+        v_in: tuple(ndarray (N, 3), ndarray (N,))
+            Last direction of each streamline.
+        """
+        raise NotImplementedError
+
+    def propagate_batch(self, pos, v_in, random_generators):
+        """
+        Equivalent of propagate for N streamlines at once.
+
+        Parameters
+        ----------
+        pos: ndarray (N, 3)
+            Current positions.
+        v_in: tuple(ndarray (N, 3), ndarray (N,))
+            Previous tracking directions and their indices.
+        random_generators: list of numpy Generators
+            One generator per streamline.
+
+        Return
+        ------
+        new_pos: ndarray (N, 3)
+            The new segments positions.
+        new_dir: tuple(ndarray (N, 3), ndarray (N,))
+            The new segments directions and their indices.
+        is_direction_valid: ndarray (N,)
+            True where new_dir is valid.
+        """
+        raise NotImplementedError
+
 
 class PropagatorOnSphere(AbstractPropagator):
     def __init__(self, datavolume, step_size, rk_order, dipy_sphere,
@@ -325,7 +397,7 @@ class ODFPropagator(PropagatorOnSphere):
                  sub_sphere=0,
                  min_separation_angle=np.pi / 16.,
                  space=Space('vox'), origin=Origin('center'),
-                 is_legacy=True):
+                 is_legacy=True, precompute_maxima=False):
         """
 
         Parameters
@@ -369,6 +441,15 @@ class ODFPropagator(PropagatorOnSphere):
             choice implies the less data modification.
         is_legacy : bool, optional
             Whether or not the SH basis is in its legacy form.
+        precompute_maxima: bool, optional
+            For deterministic tracking only. If True, the maxima of the
+            thresholded SF are extracted once for every voxel and stored as
+            sphere indices (see self.maxima_cache), instead of being
+            re-computed from the SF at each step. With the nearest
+            interpolation, results are the same. With trilinear
+            interpolation, the next direction is the blend of the maxima of
+            the 8 neighbouring voxels most aligned with the previous
+            direction, weighted by their interpolation weights (as in EuDX).
         """
         super().__init__(datavolume, step_size, rk_order, dipy_sphere,
                          sub_sphere, space, origin)
@@ -394,6 +475,15 @@ class ODFPropagator(PropagatorOnSphere):
         # For deterministic tracking:
         self.maxima_neighbours = get_sphere_neighbours(self.sphere,
                                                        min_separation_angle)
+        # Same, as indices, for batch propagation. Rows are padded with the
+        # direction itself (which is part of its own neighbourhood).
+        nb_neighbours = np.sum(self.maxima_neighbours, axis=1)
+        self._maxima_neighbours_inds = np.tile(
+            np.arange(len(self.maxima_neighbours))[:, None],
+            (1, np.max(nb_neighbours)))
+        for i, neighbours in enumerate(self.maxima_neighbours):
+            self._maxima_neighbours_inds[i, :nb_neighbours[i]] = \
+                np.flatnonzero(neighbours)
 
         # ODF params
         self.sf_threshold = sf_threshold
@@ -406,6 +496,19 @@ class ODFPropagator(PropagatorOnSphere):
                                  smooth=0.006, return_inv=False,
                                  full_basis=full_basis, legacy=self.is_legacy)
 
+        # Maxima cache (deterministic tracking)
+        self.maxima_cache = None
+        if precompute_maxima:
+            if self.algo != 'det':
+                raise ValueError("Precomputed maxima can only be used with "
+                                 "deterministic tracking.")
+            if len(self.sphere.vertices) > np.iinfo(np.int16).max:
+                raise ValueError("Too many sphere directions to store the "
+                                 "maxima as int16 indices.")
+            self.maxima_cache = self._compute_maxima_cache()
+
+    supports_batch_propagation = True
+
     def _get_sf(self, pos):
         """
         Get the spherical function at position pos.
@@ -504,6 +607,15 @@ class ODFPropagator(PropagatorOnSphere):
             else:
                 return None
         elif self.algo == 'det':
+            if self.maxima_cache is not None:
+                inds, is_valid = self._get_next_dirs_from_maxima_cache(
+                    np.asarray(pos, dtype=float)[None, :],
+                    np.asarray(v_in, dtype=float)[None, :],
+                    np.asarray([v_in.index]))
+                if is_valid[0]:
+                    return self.dirs[inds[0]]
+                return None
+
             # Tracking field returns the list of possible maxima.
             possible_maxima = self._get_possible_next_dirs_det(pos, v_in)
             # Choosing one.
@@ -575,6 +687,250 @@ class ODFPropagator(PropagatorOnSphere):
                 maxima.append(self.dirs[i])
         return maxima
 
+    def _find_maxima(self, sf, candidates):
+        """
+        Find the maxima of N spherical functions (N, nb_directions) amongst
+        the candidate directions (boolean array of the same shape): positive
+        SF values equal to the maximum of their neighbourhood (see
+        min_separation_angle). Returns the rows and columns (sphere indices)
+        of the maxima, sorted.
+        """
+        rows, cols = np.nonzero(candidates & (sf > 0))
+        neighb_max = np.max(
+            sf[rows[:, None], self._maxima_neighbours_inds[cols]], axis=1)
+        is_max = sf[rows, cols] == neighb_max
+        return rows[is_max], cols[is_max]
+
+    def _compute_maxima_cache(self, chunk_size=1000):
+        """
+        Extract the maxima of the thresholded SF of every voxel.
+
+        Return
+        ------
+        maxima_cache: ndarray (X, Y, Z, K) of int16
+            Sphere indices of the maxima of each voxel, sorted, padded with
+            -1. K is the maximal number of maxima in a voxel.
+        """
+        data = self.datavolume.data
+        nb_coeffs = data.shape[-1]
+        flat_data = data.reshape((-1, nb_coeffs))
+        voxels = np.flatnonzero(np.any(flat_data != 0, axis=1))
+
+        all_rows = [np.zeros(0, dtype=int)]
+        all_cols = [np.zeros(0, dtype=int)]
+        for start in range(0, len(voxels), chunk_size):
+            chunk = voxels[start:start + chunk_size]
+            sf = np.dot(flat_data[chunk], self.B)
+            sf_max = np.max(sf, axis=1)
+            positive = sf_max > 0
+            sf[positive] /= sf_max[positive, None]
+            sf[sf < self.sf_threshold] = 0
+
+            rows, cols = self._find_maxima(sf, np.ones(sf.shape, dtype=bool))
+            all_rows.append(chunk[rows])
+            all_cols.append(cols)
+        rows = np.concatenate(all_rows)
+        cols = np.concatenate(all_cols)
+
+        # Rank of each maximum in its voxel (rows are sorted).
+        counts = np.bincount(rows, minlength=len(flat_data))
+        rank = np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]
+
+        maxima_cache = np.full((len(flat_data), max(np.max(counts), 1)), -1,
+                               dtype=np.int16)
+        maxima_cache[rows, rank] = cols
+        logging.debug("Precomputed the SF maxima of {} voxels (max {} per "
+                      "voxel).".format(len(voxels), maxima_cache.shape[1]))
+        return maxima_cache.reshape(data.shape[:3] + (-1,))
+
+    def _get_next_dirs_from_maxima_cache(self, pos, v_in_dirs, v_in_inds):
+        """
+        Deterministic choice of the next directions at N positions, using the
+        precomputed maxima: the maximum in the cone theta most aligned with
+        v_in. With trilinear interpolation, the chosen maxima of the 8
+        neighbouring voxels are blended using the interpolation weights, and
+        the result is brought back to the closest sphere direction.
+
+        Parameters
+        ----------
+        pos: ndarray (N, 3)
+            Current positions.
+        v_in_dirs: ndarray (N, 3)
+            Previous tracking directions.
+        v_in_inds: ndarray (N,)
+            Sphere indices of the previous tracking directions.
+
+        Return
+        ------
+        inds: ndarray (N,)
+            Sphere indices of the chosen directions.
+        is_valid: ndarray (N,)
+            False where no maximum was found.
+        """
+        voxels, weights = self.datavolume.get_interpolation_neighbours(
+            pos, space=self.space, origin=self.origin)
+        maxima = self.maxima_cache[voxels[..., 0], voxels[..., 1],
+                                   voxels[..., 2]].astype(int)
+
+        # Cosinus with v_in of the maxima in the cone (padding: -1).
+        in_cone = (maxima >= 0) & \
+            self.tracking_neighbours[v_in_inds[:, None, None], maxima]
+        cosinus = np.einsum('nmkd,nd->nmk', self.sphere.vertices[maxima],
+                            v_in_dirs)
+        cosinus[~in_cone] = 0
+
+        # Best maximum in each voxel
+        best = np.argmax(cosinus, axis=2)[..., None]
+        best_cosinus = np.take_along_axis(cosinus, best, axis=2)[..., 0]
+        best_inds = np.take_along_axis(maxima, best, axis=2)[..., 0]
+        found = best_cosinus > 0
+        if voxels.shape[1] == 1:
+            return best_inds[:, 0], found[:, 0]
+
+        found &= weights > 0
+        blended = np.sum((weights * found)[..., None] *
+                         self.sphere.vertices[best_inds], axis=1)
+        inds = np.argmax(np.dot(blended, self.sphere.vertices.T), axis=1)
+        return inds, np.any(found, axis=1)
+
+    # Batch versions. Each method is the vectorized equivalent of its
+    # single-streamline version above, and draws the same random numbers from
+    # each streamline's generator, so that outputs are the same (up to
+    # floating point rounding of the matrix products).
+
+    def _get_sf_batch(self, pos):
+        """
+        Get the spherical functions at positions pos (N, 3), each normalized
+        by its maximum amplitude. Returns an array (N, nb_directions).
+        """
+        sh = self.datavolume.get_values_at_coordinates(
+            pos, space=self.space, origin=self.origin)
+        sf = np.dot(sh.reshape((len(pos), -1)), self.B)
+
+        sf_max = np.max(sf, axis=1)
+        positive = sf_max > 0
+        sf[positive] /= sf_max[positive, None]
+        return sf
+
+    @staticmethod
+    def _sample_distribution_batch(sf, candidates, random_generators):
+        """
+        Vectorized equivalent of sample_distribution(sf[candidates]) for each
+        row, where candidates is a boolean mask of shape (N, nb_directions).
+        Returns the sampled indices (on the whole sphere) and a mask of the
+        rows for which a direction could be sampled.
+        """
+        sf = np.where(candidates, sf, 0)
+        cdf = np.cumsum(sf, axis=1)
+        total = cdf[:, -1]
+        is_valid = total > 0
+
+        inds = np.zeros(len(sf), dtype=int)
+        rows = np.flatnonzero(is_valid)
+        if len(rows) > 0:
+            thresholds = np.array([random_generators[r].random()
+                                   for r in rows]) * total[rows]
+            # First candidate reaching the threshold (as searchsorted).
+            inds[rows] = np.argmax((cdf[rows] >= thresholds[:, None]) &
+                                   candidates[rows], axis=1)
+        return inds, is_valid
+
+    def prepare_forward_batch(self, seeding_pos, random_generators):
+        """
+        Vectorized equivalent of prepare_forward. See
+        AbstractPropagator.prepare_forward_batch.
+        """
+        sf = self._get_sf_batch(seeding_pos)
+        sf[sf < self.sf_threshold_init] = 0
+        inds, is_valid = self._sample_distribution_batch(
+            sf, np.ones(sf.shape, dtype=bool), random_generators)
+        return (self.sphere.vertices[inds], inds), is_valid
+
+    def prepare_backward_batch(self, last_dirs, forward_dirs):
+        """
+        Vectorized equivalent of prepare_backward. See
+        AbstractPropagator.prepare_backward_batch.
+        """
+        no_step = np.isnan(last_dirs[:, 0])
+        dirs = np.where(no_step[:, None], -forward_dirs[0], last_dirs)
+        inds = np.argmax(np.dot(dirs, self.sphere.vertices.T), axis=1)
+        return self.sphere.vertices[inds], inds
+
+    def _sample_next_direction_batch(self, pos, v_in, random_generators):
+        """
+        Vectorized equivalent of _sample_next_direction_or_go_straight.
+        Returns is_direction_valid and v_out, as a tuple (directions,
+        indices), where v_in is kept for invalid directions.
+        """
+        v_in_dirs, v_in_inds = v_in
+        if self.algo == 'det' and self.maxima_cache is not None:
+            inds, is_valid = self._get_next_dirs_from_maxima_cache(
+                pos, v_in_dirs, v_in_inds)
+        elif self.algo == 'prob':
+            sf = self._get_sf_batch(pos)
+            sf[sf < self.sf_threshold] = 0
+            inds, is_valid = self._sample_distribution_batch(
+                sf, self.tracking_neighbours[v_in_inds], random_generators)
+        elif self.algo == 'det':
+            sf = self._get_sf_batch(pos)
+            sf[sf < self.sf_threshold] = 0
+
+            # Candidate maxima in the cone.
+            rows, cols = self._find_maxima(
+                sf, self.tracking_neighbours[v_in_inds])
+
+            # Choosing the maxima most aligned with v_in, if cos > 0.
+            cosinus = np.zeros(sf.shape)
+            cosinus[rows, cols] = np.sum(
+                v_in_dirs[rows] * self.sphere.vertices[cols], axis=1)
+            inds = np.argmax(cosinus, axis=1)
+            is_valid = cosinus[np.arange(len(inds)), inds] > 0
+        else:
+            raise ValueError("Tracking choice must be one of 'det' or 'prob'.")
+
+        dirs = np.where(is_valid[:, None], self.sphere.vertices[inds],
+                        v_in_dirs)
+        inds = np.where(is_valid, inds, v_in_inds)
+        return is_valid, (dirs, inds)
+
+    def propagate_batch(self, pos, v_in, random_generators):
+        """
+        Vectorized equivalent of propagate. See
+        AbstractPropagator.propagate_batch.
+        """
+        if self.rk_order == 1:
+            is_direction_valid, new_dir = self._sample_next_direction_batch(
+                pos, v_in, random_generators)
+
+        elif self.rk_order == 2:
+            is_direction_valid, dir1 = self._sample_next_direction_batch(
+                pos, v_in, random_generators)
+            _, new_dir = self._sample_next_direction_batch(
+                pos + 0.5 * self.step_size * dir1[0], dir1,
+                random_generators)
+
+        else:
+            # case self.rk_order == 4
+            is_direction_valid, dir1 = self._sample_next_direction_batch(
+                pos, v_in, random_generators)
+            v1 = dir1[0]
+            _, dir2 = self._sample_next_direction_batch(
+                pos + 0.5 * self.step_size * v1, dir1, random_generators)
+            v2 = dir2[0]
+            _, dir3 = self._sample_next_direction_batch(
+                pos + 0.5 * self.step_size * v2, dir2, random_generators)
+            v3 = dir3[0]
+            _, dir4 = self._sample_next_direction_batch(
+                pos + self.step_size * v3, dir3, random_generators)
+            v4 = dir4[0]
+
+            new_v = (v1 + 2 * v2 + 2 * v3 + v4) / 6
+            new_dir = (new_v, dir1[1])
+
+        new_pos = pos + self.step_size * new_dir[0]
+
+        return new_pos, new_dir, is_direction_valid
+
 
 class FibertubePropagator(AbstractPropagator):
     """
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
-from contextlib import nullcontext
-import itertools
 import logging
 import multiprocessing
+from multiprocessing import shared_memory
 import os
+import shutil
 import sys
 from tempfile import TemporaryDirectory
 import traceback
@@ -21,12 +21,17 @@ from scilpy.tracking.propagator import AbstractPropagator, PropagationStatus
 from scilpy.reconst.utils import find_order_from_nb_coeff
 from scilpy.tracking.seed import SeedGenerator
 from scilpy.gpuparallel.opencl_utils import CLKernel, CLManager, have_opencl
+from scilpy.utils.parallel import imap_bounded
 
 # For the multi-processing:
 # Dictionary. Will contain all parameters necessary for a sub-process
 # initialization.
 multiprocess_init_args = {}
 
+# Maximal number of seed sub-chunks in flight per process, with
+# multiprocessing. Bounds the memory used by the pending results.
+NB_CHUNKS_PER_PROCESS = 4
+
 
 class Tracker(object):
     def __init__(self, propagator: AbstractPropagator, mask: DataVolume,
@@ -35,7 +40,8 @@ class Tracker(object):
                  nbr_processes=1, save_seeds=False,
                  mmap_mode: Union[str, None] = None, rng_seed=1234,
                  track_forward_only=False, skip=0, verbose=False,
-                 min_iter=100, append_last_point=True):
+                 min_iter=100, append_last_point=True, batch_size=100,
+                 use_shared_memory=True, batch_propagation=False):
         """
         Parameters
         ----------
@@ -66,6 +72,7 @@ class Tracker(object):
         mmap_mode: str
             Memory-mapping mode. One of {None, 'r+', 'c'}. This value is passed
             to np.load() when loading the raw tracking data from a subprocess.
+            Only used if use_shared_memory is False.
         rng_seed: int
             The random "seed" for the random generator.
         track_forward_only: bool
@@ -87,6 +94,27 @@ class Tracker(object):
             direction (based on the propagator's definition of invalid; ex
             when angle is too sharp of sh_threshold not reached) are never
             added.
+        batch_size: int
+            Maximal number of seeds per sub-chunk. Seeds are split into small
+            sub-chunks that are distributed to the sub-processes as soon as
+            they become idle (so that a process tracking long streamlines
+            does not delay the others). The streamlines of a sub-chunk are
+            sent back at once, which bounds memory usage with
+            track_generator(). The results do not depend on this value nor on
+            the number of processes.
+        use_shared_memory: bool
+            With multiprocessing, if True, the data is copied once into a
+            shared memory block to which all sub-processes attach without
+            copy. Else, the data is saved to a temporary file and loaded back
+            by each sub-process with np.load(mmap_mode=mmap_mode), which may
+            be preferred on memory-constrained nodes. If there is not enough
+            space available in /dev/shm, falls back to the second option.
+        batch_propagation: bool
+            If True, all streamlines of a sub-chunk are propagated together,
+            in lockstep, using the propagator's vectorized methods (see
+            AbstractPropagator.propagate_batch). The streamlines are the same
+            as with the line-by-line propagation, up to floating point
+            rounding. Only available with propagators supporting it.
         """
         self.propagator = propagator
         self.mask = mask
@@ -102,6 +130,9 @@ class Tracker(object):
         self.track_forward_only = track_forward_only
         self.append_last_point = append_last_point
         self.skip = skip
+        self.batch_size = max(int(batch_size), 1)
+        self.use_shared_memory = use_shared_memory
+        self.batch_propagation = batch_propagation
 
         self.origin = self.propagator.origin
         self.space = self.propagator.space
@@ -113,6 +144,10 @@ class Tracker(object):
                 seed_generator.space != propagator.space):
             raise ValueError("Seed generator and propagator must work with "
                              "the same space and origin!")
+        if (self.batch_propagation and
+                not self.propagator.supports_batch_propagation):
+            raise ValueError("This propagator does not support batch "
+                             "propagation.")
 
         if self.min_nbr_pts <= 0:
             logging.warning("Minimum number of points cannot be 0. Changed to "
@@ -132,7 +167,9 @@ class Tracker(object):
 
     def track(self):
         """
-        Generate a set of streamline from seed, mask and odf files.
+        Generate a set of streamline from seed, mask and odf files. All
+        streamlines are kept in memory until the end; see track_generator() to
+        process them on-the-fly instead.
 
         Return
         ------
@@ -142,29 +179,102 @@ class Tracker(object):
             List of seeding positions, one 3-dimensional position per
             streamline.
         """
-        if self.nbr_processes < 2:
-            chunk_id = 0
-            lines, seeds = self._get_streamlines(chunk_id)
-        else:
-            # Each process will use get_streamlines_at_seeds
-            chunk_ids = np.arange(self.nbr_processes)
-            with TemporaryDirectory() as tmpdir:
-                # Lock for logging
-                lock = multiprocessing.Manager().Lock()
-                zipped_chunks = zip(chunk_ids, [lock] * self.nbr_processes)
+        streamlines = []
+        seeds = []
+        for streamline, seed in self.track_generator():
+            streamlines.append(streamline)
+            if self.save_seeds:
+                seeds.append(seed)
+
+        return streamlines, seeds
+
+    def track_generator(self):
+        """
+        Generate streamlines on-the-fly, for instance to save them
+        incrementally with scilpy.tracking.utils.save_tractogram.
+
+        Seeds are generated sequentially in the main process and split into
+        sub-chunks of at most self.batch_size seeds. With multiprocessing,
+        sub-processes pull the sub-chunks as they become idle, and the
+        streamlines of each sub-chunk are yielded in the seeds' order, so
+        that the output is the same whatever the number of processes.
 
-                pool = self._prepare_multiprocessing_pool(tmpdir)
+        Yields
+        ------
+        streamline: np.ndarray
+            The streamline, represented as an array of positions.
+        seed: np.ndarray or None
+            The seeding position of this streamline, if self.save_seeds.
+            Else, None.
+        """
+        p = tqdm(total=self.nbr_seeds, miniters=self.min_iter, leave=False,
+                 disable=not self.verbose)
 
-                lines_per_process, seeds_per_process = zip(*pool.map(
-                    self._get_streamlines_sub, zipped_chunks))
+        if self.nbr_processes < 2:
+            for first_seed, seeds in self._get_seed_chunks():
+                yield from zip(*self._get_streamlines(first_seed, seeds))
+                p.update(len(seeds))
+            p.close()
+            return
+
+        with TemporaryDirectory() as tmpdir:
+            pool, shm = self._prepare_multiprocessing_pool(tmpdir)
+            try:
+                # Ordered: sub-chunks are still processed by whichever
+                # process is idle, but results are received in order. Seeds
+                # are only generated as results are yielded: at most
+                # NB_CHUNKS_PER_PROCESS sub-chunks per process are in flight.
+                results = imap_bounded(
+                    pool, Tracker._get_streamlines_sub,
+                    self._get_seed_chunks(),
+                    NB_CHUNKS_PER_PROCESS * self.nbr_processes)
+                for streamlines, seeds, nb_seeds in results:
+                    yield from zip(streamlines, seeds)
+                    p.update(nb_seeds)
                 pool.close()
+            except BaseException:
+                # Includes GeneratorExit, if the generator is not consumed
+                # entirely.
+                pool.terminate()
+                raise
+            finally:
                 # Make sure all worker processes have exited before leaving
                 # context manager.
                 pool.join()
-                lines = [line for line in itertools.chain(*lines_per_process)]
-                seeds = [seed for seed in itertools.chain(*seeds_per_process)]
+                p.close()
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
 
-        return lines, seeds
+    def _get_seed_chunks(self):
+        """
+        Generates the seeds sequentially, from a single random generator
+        initialized with self.rng_seed and self.skip, and splits them into
+        sub-chunks. Positions are thus the same as with a single process.
+
+        Yields
+        ------
+        first_seed: int
+            Index of the first seed of the sub-chunk (not counting skipped
+            seeds).
+        seeds: np.ndarray of shape (n, 3)
+            The seeding positions of the sub-chunk.
+        """
+        random_generator, indices = self.seed_generator.init_generator(
+            self.rng_seed, self.skip)
+
+        # With multiprocessing, making sure there are enough sub-chunks for
+        # all processes to be kept busy.
+        chunk_size = min(self.batch_size,
+                         int(np.ceil(self.nbr_seeds /
+                                     (4 * self.nbr_processes))))
+        chunk_size = max(chunk_size, 1)
+        for first_seed in range(0, self.nbr_seeds, chunk_size):
+            nb_seeds = min(chunk_size, self.nbr_seeds - first_seed)
+            seeds = [self.seed_generator.get_next_pos(
+                random_generator, indices, self.skip + s)
+                for s in range(first_seed, first_seed + nb_seeds)]
+            yield first_seed, np.asarray(seeds, dtype=float)
 
     def _set_nbr_processes(self, nbr_processes):
         """
@@ -195,22 +305,47 @@ class Tracker(object):
         Params
         ------
         tmpdir: str
-            Path where to save temporarily the data. This will allow clearing
-            the data from memory. We will fetch it back later.
+            Path where to save temporarily the data, if not using shared
+            memory. This will allow clearing the data from memory. We will
+            fetch it back later.
 
         Returns
         -------
         pool: The multiprocessing pool.
+        shm: multiprocessing.shared_memory.SharedMemory or None
+            The shared memory block holding the data, if any. It must be
+            closed and unlinked by the caller once the pool is done.
         """
-        # Using pool with a class method will serialize all parameters
-        # in the class, which can be heavy, but it is what we would be
-        # doing manually with a static class.
-        # Be careful however, parameter changes inside the method will
-        # not be kept.
-
-        # Saving data. We will reload it in each process.
-        data_file_name = os.path.join(tmpdir, 'data.npy')
-        np.save(data_file_name, self.propagator.datavolume.data)
+        # The tracker itself is sent only once to each process, through the
+        # initializer, rather than being serialized with every sub-chunk.
+        init_args = {'tracker': self}
+
+        data = self.propagator.datavolume.data
+        shm = None
+        if self.use_shared_memory and \
+                self._has_enough_shared_memory(data.nbytes):
+            # Copying data once in shared memory. Each process will attach
+            # to it.
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(data.nbytes, 1))
+            shared_data = np.ndarray(data.shape, dtype=data.dtype,
+                                     buffer=shm.buf)
+            shared_data[:] = data
+            del shared_data
+            init_args.update({
+                'shm_name': shm.name,
+                'shape': data.shape,
+                'dtype': data.dtype
+            })
+        else:
+            # Saving data. We will reload it in each process.
+            data_file_name = os.path.join(tmpdir, 'data.npy')
+            np.save(data_file_name, data)
+            init_args.update({
+                'data_file_name': data_file_name,
+                'mmap_mode': self.mmap_mode
+            })
+        del data
 
         # Clear data from memory
         self.propagator.reset_data(new_data=None)
@@ -218,47 +353,69 @@ class Tracker(object):
         pool = multiprocessing.Pool(
             self.nbr_processes,
             initializer=self._send_multiprocess_args_to_global,
-            initargs=({
-                'data_file_name': data_file_name,
-                'mmap_mode': self.mmap_mode
-            },))
+            initargs=(init_args,))
 
-        return pool
+        return pool, shm
+
+    @staticmethod
+    def _has_enough_shared_memory(nbytes):
+        """
+        Verifies that the shared memory file system (if known) can hold
+        nbytes. Writing beyond its limit would crash the process.
+        """
+        if os.path.isdir('/dev/shm'):
+            available = shutil.disk_usage('/dev/shm').free
+            if available < nbytes:
+                logging.warning(
+                    "Not enough shared memory available ({:.1f} MB) to hold "
+                    "the data ({:.1f} MB). Sharing it through a temporary "
+                    "file instead.".format(available / 1e6, nbytes / 1e6))
+                return False
+        return True
 
     @staticmethod
     def _send_multiprocess_args_to_global(init_args):
         """
         Sends subprocess' initialisation arguments to global for easier access
-        by the multiprocessing pool.
+        by the multiprocessing pool, and loads back the data once for this
+        process.
         """
         global multiprocess_init_args
         multiprocess_init_args = init_args
+        init_args['tracker']._reload_data_for_new_process(init_args)
         return
 
-    def _get_streamlines_sub(self, params):
+    @staticmethod
+    def _get_streamlines_sub(params):
         """
-        multiprocessing.pool.map input function. Calls the main tracking
-        method (_get_streamlines) with correct initialization arguments
-        (taken from the global variable multiprocess_init_args).
+        multiprocessing.pool.imap input function. Calls the main tracking
+        method (_get_streamlines) of the tracker received at the process'
+        initialization (taken from the global variable
+        multiprocess_init_args).
 
         Parameters
         ----------
-        params: Tuple[chunk_id, Lock]
-            chunk_id: int, this processes's id.
-            Lock: the multiprocessing lock.
+        params: Tuple[first_seed, seeds]
+            first_seed: int, index of the first seed of this sub-chunk.
+            seeds: np.ndarray, the seeding positions of this sub-chunk.
 
         Return
         -------
-        lines: list
+        streamlines: list
             List of list of 3D positions (streamlines).
+        seeds: list
+            The seed of each streamline (or None).
+        nb_seeds: int
+            The number of processed seeds, for the progress bar.
         """
-        chunk_id, lock = params
+        first_seed, seeds = params
         global multiprocess_init_args
 
-        self._reload_data_for_new_process(multiprocess_init_args)
+        tracker = multiprocess_init_args['tracker']
         try:
-            streamlines, seeds = self._get_streamlines(chunk_id, lock)
-            return streamlines, seeds
+            streamlines, seeds_out = tracker._get_streamlines(first_seed,
+                                                              seeds)
+            return streamlines, seeds_out, len(seeds)
         except Exception as e:
             logging.error("Operation _get_streamlines_sub() failed.")
             traceback.print_exception(*sys.exc_info(), file=sys.stderr)
@@ -270,77 +427,71 @@ class Tracker(object):
 
         Params
         ------
-        init_args: Iterable
-            Args necessary to reset data. In current implementation: a tuple;
-            (file where the data is saved, mmap_mode).
+        init_args: dict
+            Args necessary to reset data. In current implementation: either
+            the name, shape and dtype of the shared memory block holding the
+            data, or the file where the data is saved and the mmap_mode.
         """
-        self.propagator.reset_data(np.load(
-            init_args['data_file_name'], mmap_mode=init_args['mmap_mode']))
+        if 'shm_name' in init_args:
+            # Keeping a reference to the block in the init args: the data is
+            # only valid as long as it is open.
+            shm = shared_memory.SharedMemory(name=init_args['shm_name'])
+            init_args['shm'] = shm
+            data = np.ndarray(init_args['shape'], dtype=init_args['dtype'],
+                              buffer=shm.buf)
+        else:
+            data = np.load(init_args['data_file_name'],
+                           mmap_mode=init_args['mmap_mode'])
+        self.propagator.reset_data(data)
 
-    def _get_streamlines(self, chunk_id, lock=None):
+    def _get_streamlines(self, first_seed, seeds):
         """
-        Tracks the n streamlines associates with current process (identified by
-        chunk_id). The number n is the total number of seeds / the number of
-        processes. If asked by user, may compress the streamlines and save the
-        seeds.
+        Tracks the streamlines of a sub-chunk of seeds. If asked by user, may
+        compress the streamlines and save the seeds.
 
         Parameters
         ----------
-        chunk_id: int
-            This process ID.
-        lock: Lock
-            The multiprocessing lock for verbose printing (optional with
-            single processing).
+        first_seed: int
+            Index of the first seed of the sub-chunk (not counting skipped
+            seeds).
+        seeds: np.ndarray of shape (n, 3)
+            The seeding positions.
 
         Returns
         -------
         streamlines: list
             The successful streamlines.
         seeds: list
-            The list of seeds for each streamline, if self.save_seeds. Else, an
-            empty list.
+            The seed of each streamline, if self.save_seeds. Else, None for
+            each streamline.
         """
-        streamlines = []
-        seeds = []
-
-        # Initialize the random number generator to cover multiprocessing,
-        # skip, which voxel to seed and the subvoxel random position
-        chunk_size = int(self.nbr_seeds / self.nbr_processes)
-        first_seed_of_chunk = chunk_id * chunk_size + self.skip
-        random_generator, indices = self.seed_generator.init_generator(
-            self.rng_seed, first_seed_of_chunk)
-        if chunk_id == self.nbr_processes - 1:
-            chunk_size += self.nbr_seeds % self.nbr_processes
-
-        # Getting streamlines
-        tqdm_text = "#" + "{}".format(chunk_id).zfill(3)
-
-        if self.verbose:
-            if lock is None:
-                lock = nullcontext()
-            with lock:
-                p = tqdm(total=chunk_size, desc=tqdm_text, position=chunk_id+1,
-                         leave=False)
-
-        for s in range(chunk_size):
-            seed = self.seed_generator.get_next_pos(
-                random_generator, indices, first_seed_of_chunk + s)
+        line_generators = []
+        for i, seed in enumerate(seeds):
+            seed = tuple(seed)
 
             # Setting the random value.
             # Previous usage (and usage in Dipy) is to set the random seed
             # based on the (real) seed position. However, in the case where we
             # like to have exactly the same seed more than once, this will lead
             # to exactly the same line, even in probabilistic tracking.
-            # Changing to seed position + seed number.
-            # Then in the case of multiprocessing, adding also a fraction based
-            # on current process ID.
-            eps = s + chunk_id / (self.nbr_processes + 1)
-            line_generator = np.random.default_rng(
-                np.abs(hash((seed + (eps, eps, eps), self.rng_seed))))
-
-            # Forward and backward tracking
-            line = self._get_line_both_directions(seed, line_generator)
+            # Changing to seed position + seed number. The seed number does
+            # not depend on the sub-chunks, so results are the same whatever
+            # the number of processes.
+            eps = first_seed + i
+            line_generators.append(np.random.default_rng(
+                np.abs(hash((seed + (eps, eps, eps), self.rng_seed)))))
+
+        # Forward and backward tracking
+        if self.batch_propagation:
+            lines = self._get_lines_both_directions_batch(seeds,
+                                                          line_generators)
+        else:
+            lines = [self._get_line_both_directions(tuple(seed), generator)
+                     for seed, generator in zip(seeds, line_generators)]
 
+        streamlines = []
+        saved_seeds = []
+        for seed, line in zip(seeds, lines):
             if line is not None:
                 streamline = np.array(line, dtype='float32')
 
@@ -356,22 +507,12 @@ class Tracker(object):
                         compress_streamlines(streamline, self.compression_th)
 
                 streamlines.append(streamline)
-
                 if self.save_seeds:
-                    seeds.append(np.asarray(seed, dtype='float32'))
-
-            # Note. Option min_iter does not work with manual pbar update.
-            # Will verify manually, lower.
-            # Fixed choice of value rather than a percentage of the chunk
-            # size because our tracker is quite slow.
-            if self.verbose and (s + 1) % self.min_iter == 0:
-                with lock:
-                    p.update(self.min_iter)
-
-        if self.verbose:
-            with lock:
-                p.close()
-        return streamlines, seeds
+                    saved_seeds.append(np.asarray(seed, dtype='float32'))
+                else:
+                    saved_seeds.append(None)
+
+        return streamlines, saved_seeds
 
     def _get_line_both_directions(self, seeding_pos, line_generator):
         """
@@ -411,6 +552,126 @@ class Tracker(object):
             return line
         return None
 
+    def _get_lines_both_directions_batch(self, seeds, line_generators):
+        """
+        Equivalent of _get_line_both_directions for all seeds at once: the
+        streamlines are propagated together, one step at the time, with the
+        vectorized methods of the propagator.
+
+        Parameters
+        ----------
+        seeds : ndarray (N, 3)
+            The seed positions.
+        line_generators: list of numpy Generators
+            One random generator per seed.
+
+        Returns
+        -------
+        lines: list
+            For each seed, the generated streamline as a ndarray (n, 3), or
+            None if it could not be tracked or if its number of points is not
+            within [min_nbr_pts, max_nbr_pts].
+        """
+        seeds = np.asarray(seeds, dtype=float).reshape((-1, 3))
+        nb_lines = len(seeds)
+
+        # Forward
+        lines = np.zeros((nb_lines, self.max_nbr_pts, 3))
+        lines[:, 0] = seeds
+        lengths = np.ones(nb_lines, dtype=int)
+        forward_dirs, is_valid = self.propagator.prepare_forward_batch(
+            seeds, line_generators)
+        self._propagate_lines_batch(lines, lengths, forward_dirs, is_valid,
+                                    line_generators)
+
+        # Backward
+        if not self.track_forward_only:
+            # Reversing each line
+            src = lengths[:, None] - 1 - np.arange(self.max_nbr_pts)[None, :]
+            rows, cols = np.nonzero(src >= 0)
+            reversed_lines = np.zeros_like(lines)
+            reversed_lines[rows, cols] = lines[rows, src[rows, cols]]
+            lines = reversed_lines
+
+            last_dirs = np.full((nb_lines, 3), np.nan)
+            has_step = lengths > 1
+            last_dirs[has_step] = (lines[has_step, lengths[has_step] - 1] -
+                                   lines[has_step, lengths[has_step] - 2])
+            backward_dirs = self.propagator.prepare_backward_batch(
+                last_dirs, forward_dirs)
+            self._propagate_lines_batch(lines, lengths, backward_dirs,
+                                        is_valid, line_generators)
+
+        # Clean streamlines
+        keep = (is_valid & (self.min_nbr_pts <= lengths) &
+                (lengths <= self.max_nbr_pts))
+        return [lines[i, :lengths[i]] if keep[i] else None
+                for i in range(nb_lines)]
+
+    def _propagate_lines_batch(self, lines, lengths, v_in, active,
+                               line_generators):
+        """
+        Equivalent of _propagate_line for N lines at once. Lines are
+        modified in-place.
+
+        Parameters
+        ----------
+        lines: ndarray (N, max_nbr_pts, 3)
+            The lines to propagate. The current position of line i is
+            lines[i, lengths[i] - 1].
+        lengths: ndarray (N,)
+            The current number of points of each line. Modified in-place.
+        v_in: tuple(ndarray (N, 3), ndarray (N,))
+            Tracking information of each line, as understood by the
+            propagator's batch methods.
+        active: ndarray (N,)
+            Lines to propagate.
+        line_generators: list of numpy Generators
+            One random generator per line.
+        """
+        dirs = np.array(v_in[0], dtype=float)
+        inds = np.array(v_in[1])
+        invalid_direction_count = np.zeros(len(lines), dtype=int)
+        active = active & (lengths < self.max_nbr_pts)
+        while np.any(active):
+            current = np.flatnonzero(active)
+            new_pos, (new_dirs, new_inds), is_direction_valid = \
+                self.propagator.propagate_batch(
+                    lines[current, lengths[current] - 1],
+                    (dirs[current], inds[current]),
+                    [line_generators[i] for i in current])
+
+            # Verifying if direction is valid
+            # If invalid too many times: stop. Else, verify tracking mask.
+            invalid_direction_count[current] = np.where(
+                is_direction_valid, 0, invalid_direction_count[current] + 1)
+            stopped = invalid_direction_count[current] > self.max_invalid_dirs
+
+            can_continue = ~stopped & self._verify_stopping_criteria_batch(
+                new_pos)
+            if self.append_last_point:
+                append = ~stopped
+            else:
+                append = can_continue
+            lines[current[append], lengths[current[append]]] = new_pos[append]
+            lengths[current[append]] += 1
+
+            dirs[current] = new_dirs
+            inds[current] = new_inds
+            active[current] = can_continue & \
+                (lengths[current] < self.max_nbr_pts)
+
+    def _verify_stopping_criteria_batch(self, last_pos):
+        """
+        Equivalent of _verify_stopping_criteria for N positions at once.
+        Returns a boolean array (N,).
+        """
+        in_bound = self.mask.are_coordinates_in_bound(
+            last_pos, space=self.space, origin=self.origin)
+        values = self.mask.get_values_at_coordinates(
+            last_pos, space=self.space, origin=self.origin)
+        return in_bound & ~(values <= 0)
+
     def _propagate_line(self, line, tracking_info):
         """
         Generate a streamline in forward or backward direction from an initial
@@ -188,8 +188,10 @@ def save_tractogram(
 
     Parameters
     ----------
-    streamlines_generator : generator
-        Streamlines generator.
+    streamlines_generator : iterable
+        Streamlines generator, yielding (streamline, seed). It is only
+        iterated once, so it may be a one-shot generator such as
+        Tracker.track_generator().
     tracts_format : TrkFile or TckFile
         Tractogram format.
     ref_img : nibabel.Nifti1Image
@@ -218,7 +220,7 @@ def save_tractogram(
     scaled_max_length = max_length / voxel_size
 
     # Tracking is expected to be returned in voxel space, origin `center`.
-    def tracks_generator_wrapper():
+    def tracks_generator():
         for strl, seed in tqdm_if_verbose(streamlines_generator,
                                           verbose=verbose,
                                           total=total_nb_seeds,
@@ -254,6 +256,17 @@ def save_tractogram(
 
                 yield TractogramItem(strl, dps, {})
 
+    # LazyTractogram calls the data function once to peek at the first item,
+    # and once more when saving. Keeping the first item rather than tracking
+    # twice.
+    tractogram_items = tracks_generator()
+    first_item = next(tractogram_items, None)
+
+    def tracks_generator_wrapper():
+        if first_item is not None:
+            yield first_item
+        yield from tractogram_items
+
     tractogram = LazyTractogram.from_data_func(tracks_generator_wrapper)
     tractogram.affine_to_rasmm = ref_img.affine
 
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import itertools
+from collections import deque
 import logging
 import os
 
@@ -17,6 +17,14 @@ from scilpy.tractograms.streamline_operations import \
     (remove_loops as perform_remove_loops,
      remove_sharp_turns_qb,
      remove_streamlines_with_overlapping_points, filter_streamlines_by_length)
+from scilpy.utils.parallel import SharedArray, get_nbr_processes, get_pool
+
+# Number of streamlines segmented at once in compute_connectivity.
+CHUNK_SIZE = 100000
+
+# Number of cleaned connections (per process) that can wait to be written in
+# the hdf5 by construct_hdf5_from_connectivity.
+NB_CONNECTIONS_PER_PROCESS = 2
 
 
 def extract_longest_segments_from_profile(strl_indices, atlas_data):
@@ -87,10 +95,101 @@ def extract_longest_segments_from_profile(strl_indices, atlas_data):
              'end_index': end_idx}]
 
 
-def compute_connectivity(indices, atlas_data, real_labels, segmenting_func):
+def _first_per_streamline(strl_ids, values, nb_streamlines, default):
+    """
+    For sorted streamline ids, the first value of each streamline (default
+    for streamlines without values).
+    """
+    first = np.full(nb_streamlines, default, dtype=values.dtype)
+    is_first = np.ones(len(strl_ids), dtype=bool)
+    is_first[1:] = strl_ids[1:] != strl_ids[:-1]
+    first[strl_ids[is_first]] = values[is_first]
+    return first
+
+
+def extract_longest_segments_from_profiles(indices, atlas_data):
+    """
+    Vectorized equivalent of extract_longest_segments_from_profile, for all
+    streamlines at once. Streamlines going out of the atlas are ignored.
+
+    Parameters
+    ----------
+    indices: ArraySequence
+        The 3D indices [i, j, k] of all voxels traversed by all streamlines.
+    atlas_data: np.ndarray
+        The loaded image containing the labels.
+
+    Returns
+    -------
+    strl_idx, start_label, end_label, in_idx, out_idx: np.ndarray
+        For each streamline with a valid segment: the index of the
+        streamline, its labels at both ends, and the indices (in the
+        traversed voxels) of its start and end.
+    """
+    if not isinstance(indices, ArraySequence):
+        indices = ArraySequence(indices)
+
+    lengths = np.asarray(indices._lengths, dtype=np.intp)
+    offsets = np.asarray(indices._offsets, dtype=np.intp)
+    nb_streamlines = len(lengths)
+
+    # Position of each traversed voxel in its streamline.
+    strl_ids = np.repeat(np.arange(nb_streamlines), lengths)
+    first_voxels = np.cumsum(lengths) - lengths
+    positions = np.arange(len(strl_ids)) - np.repeat(first_voxels, lengths)
+    voxels = np.asarray(indices._data, dtype=np.intp).reshape((-1, 3))[
+        np.repeat(offsets, lengths) + positions]
+
+    # Managing streamlines out of bound: ignored. Their voxels are set to
+    # background.
+    in_bound = np.all((voxels >= 0) & (voxels < atlas_data.shape[:3]), axis=1)
+    is_valid = np.ones(nb_streamlines, dtype=bool)
+    is_valid[strl_ids[~in_bound]] = False
+    labels = np.zeros(len(voxels), dtype=atlas_data.dtype)
+    labels[in_bound] = atlas_data[tuple(voxels[in_bound].T)]
+
+    # toDo. background/wm is defined as label 0, but should be asked to user.
+    # Start: first GM region encountered (first voxel with a label).
+    # End: last voxel with a label. (Positions are sorted in each streamline:
+    # the first value of the reversed arrays is the last one.)
+    is_gm = labels > 0
+    start_idx = _first_per_streamline(strl_ids[is_gm], positions[is_gm],
+                                      nb_streamlines, -1)
+    end_idx = _first_per_streamline(strl_ids[is_gm][::-1],
+                                    positions[is_gm][::-1],
+                                    nb_streamlines, -1)
+    is_valid &= start_idx >= 0
+
+    # The streamline must leave GM (first label 0 after the start), before
+    # its last voxel. If not, this is a weird streamline never leaving GM.
+    is_wm = ~is_gm & (positions > start_idx[strl_ids])
+    wm_idx = _first_per_streamline(strl_ids[is_wm], positions[is_wm],
+                                   nb_streamlines, -1)
+    is_valid &= (wm_idx >= 0) & (wm_idx < lengths - 1)
+    is_valid &= end_idx > start_idx + 1
+
+    strl_idx = np.flatnonzero(is_valid)
+    in_idx = start_idx[strl_idx]
+    out_idx = end_idx[strl_idx]
+    return (strl_idx, labels[first_voxels[strl_idx] + in_idx],
+            labels[first_voxels[strl_idx] + out_idx], in_idx, out_idx)
+
+
+def _extract_longest_segments_parallel(args):
+    indices, atlas_descriptor = args
+    shm, atlas_data = SharedArray.attach(atlas_descriptor)
+    try:
+        return extract_longest_segments_from_profiles(indices, atlas_data)
+    finally:
+        del atlas_data
+        shm.close()
+
+
+def compute_connectivity(indices, atlas_data, nbr_processes=1):
     """
     Segments a tractogram into "bundles", or "connections" between all pairs
-    of labels.
+    of labels. For each streamline, the longest segment between two labels is
+    kept (see extract_longest_segments_from_profile).
 
     Parameters
     ----------
@@ -100,49 +199,65 @@ def compute_connectivity(indices, atlas_data, real_labels, segmenting_func):
         streamlines_to_voxel_coordinates function.
     atlas_data: np.ndarray
         The loaded image containing the labels.
-    real_labels: np.ndarray
-        The list of labels of interest in the image.
-    segmenting_func: Callable
-        The function used for segmentation.
-        Ex: extract_longest_segments_from_profile
+    nbr_processes: int
+        Number of processes. Streamlines are processed by chunks of
+        CHUNK_SIZE.
 
     Returns
     -------
     connectivity: dict
-        A dict containing one key per real_labels (ex, 1, 2) (starting point).
-
-        - The value of connectivity[1] is again a dict with again the
-            real_labels as keys.
-
-        - The value of connectivity[1][2] is a list of length n, where n is
-            the number of streamlines starting in 1 and finishing in 2. Each
-            value is a dict of the following shape:
-
-           >>> 'strl_idx': int --> The idex of the streamline in the raw data.
-           >>> 'in_idx:    int -->
-           >>> 'out_idx': int  -->
+        The segments of all connected streamlines, as flat arrays of the same
+        length, sorted by connection (pair of labels, in any order), then
+        by streamline index:
+
+           >>> 'strl_idx': The index of the streamline in the raw data.
+           >>> 'start_label': The label at the start of the segment.
+           >>> 'end_label': The label at the end of the segment.
+           >>> 'in_idx': The index of the voxel where the segment starts.
+           >>> 'out_idx': The index of the voxel where the segment ends.
+
+        Streamlines going from label A to label B are placed before those
+        going from B to A.
     """
-    connectivity = {k: {lab: [] for lab in real_labels} for k in real_labels}
-
-    # toDo. real_labels is not used in segmenting func!
-    for strl_idx, strl_vox_indices in enumerate(indices):
-        # Managing streamlines out of bound.
-        if (np.array(strl_vox_indices) > atlas_data.shape).any():
-            continue
-
-        # Finding start_label and end_label.
-        segments_info = segmenting_func(strl_vox_indices, atlas_data)
-        for si in segments_info:
-            connectivity[si['start_label']][si['end_label']].append(
-                {'strl_idx': strl_idx,
-                 'in_idx': si['start_index'],
-                 'out_idx': si['end_index']})
-
-    return connectivity
+    nbr_processes = get_nbr_processes(nbr_processes)
+
+    # Chunks are copies: slices would pickle the whole data.
+    chunks = range(0, len(indices), CHUNK_SIZE)
+    if nbr_processes == 1 or len(chunks) <= 1:
+        results = [extract_longest_segments_from_profiles(
+            indices[i:i + CHUNK_SIZE], atlas_data) for i in chunks]
+    else:
+        shared_atlas = SharedArray(atlas_data.shape, atlas_data.dtype,
+                                   atlas_data)
+        try:
+            results = get_pool(nbr_processes).map(
+                _extract_longest_segments_parallel,
+                [(indices[i:i + CHUNK_SIZE].copy(), shared_atlas.descriptor)
+                 for i in chunks])
+        finally:
+            shared_atlas.release()
+
+    keys = ['strl_idx', 'start_label', 'end_label', 'in_idx', 'out_idx']
+    if len(results) == 0:
+        return {key: np.zeros(0, dtype=int) for key in keys}
+
+    connectivity = {key: np.concatenate(values)
+                    for key, values in zip(keys, zip(*results))}
+
+    # Streamline indices are relative to their chunk.
+    connectivity['strl_idx'] += np.repeat(np.asarray(chunks),
+                                          [len(r[0]) for r in results])
+
+    start_label = connectivity['start_label']
+    end_label = connectivity['end_label']
+    order = np.lexsort((connectivity['strl_idx'], start_label > end_label,
+                        np.maximum(start_label, end_label),
+                        np.minimum(start_label, end_label)))
+    return {key: values[order] for key, values in connectivity.items()}
 
 
 def construct_hdf5_from_connectivity(
-        sft, indices, points_to_idx, real_labels, con_info,
+        sft, indices, points_to_idx, con_info,
         hdf5_file, saving_options, out_paths,
         prune_from_length, min_length, max_length,  # step 1
         remove_loops, loop_max_angle,               # step 2
@@ -159,8 +274,6 @@ def construct_hdf5_from_connectivity(
         Results from streamlines_to_voxel_coordinates.
     points_to_idx: ArraySequence
         Results from streamlines_to_voxel_coordinates.
-    real_labels: np.ndarray
-        The labels.
     con_info: dict
         The result from compute_connectivity.
     hdf5_file: hdf5 file
@@ -188,197 +301,240 @@ def construct_hdf5_from_connectivity(
         If true, remove sharp turns base on Quickbundles. Else skip step 4.
     curv_qb_distance: float
     nbr_cpu: int
-        Number of cpu for steps allowing multiprocessing.
+        Number of processes. Connections are cleaned in parallel, and
+        written to the hdf5 one at a time.
     """
     sft.to_vox()
     sft.to_corner()
-
-    comb_list = list(itertools.combinations(real_labels, r=2))
-    comb_list.extend(zip(real_labels, real_labels))
-
-    # Each connection is processed independently. Multiprocessing would be
-    # a burden on the I/O of most SSD/HD.
-    iteration_counter = 0
-    for in_label, out_label in comb_list:
-        iteration_counter += 1
-        if iteration_counter > 0 and iteration_counter % 100 == 0:
-            logging.info('Processing connection {}/{}'
-                         .format(iteration_counter, len(comb_list)))
-        logging.debug('Processing connection {}/{}: labels {} - {}'
-                      .format(iteration_counter, len(comb_list),
-                              in_label, out_label))
-
-        # Extracting this connection's info from the big dict con_info
-        pair_info = []
-        if out_label in con_info[in_label]:
-            pair_info.extend(con_info[in_label][out_label])
-        if in_label in con_info[out_label]:
-            pair_info.extend(con_info[out_label][in_label])
-        if len(pair_info) == 0:
-            logging.debug("No streamlines found for this connection: not "
-                          "saving in the hdf5.")
-            continue
-
-        # Preparing streamlines. Keeping only the segment between the two
-        # associated labels.
-        logging.debug("- Keeping only the segments between the two associated "
-                      "labels for each streamline. Any data_per_point will be "
-                      "lost.")
-        current_streamlines = []
-        connecting_ids = []
-        for connection in pair_info:
-            strl_idx = connection['strl_idx']
-            curr_streamlines = compute_streamline_segment(
-                sft.streamlines[strl_idx],
-                indices[strl_idx],
-                connection['in_idx'],
-                connection['out_idx'],
-                points_to_idx[strl_idx])
-            current_streamlines.append(curr_streamlines)
-            connecting_ids.append(strl_idx)
-        raw_dps = sft.data_per_streamline[connecting_ids]
-        current_sft = StatefulTractogram.from_sft(current_streamlines, sft,
-                                                  data_per_streamline=raw_dps,
-                                                  data_per_point={})
+    nbr_cpu = get_nbr_processes(nbr_cpu)
+
+    # con_info is sorted by connection: each connection is a slice.
+    in_labels = np.minimum(con_info['start_label'], con_info['end_label'])
+    out_labels = np.maximum(con_info['start_label'], con_info['end_label'])
+    bounds = np.flatnonzero((np.diff(in_labels) != 0) |
+                            (np.diff(out_labels) != 0)) + 1
+    bounds = np.concatenate(([0], bounds, [len(in_labels)]))
+    nb_connections = len(bounds) - 1 if len(in_labels) > 0 else 0
+
+    # Small reference for the workers (the tractogram, without streamlines).
+    reference = StatefulTractogram.from_sft([], sft)
+    cleaning_options = (saving_options, out_paths,
+                        prune_from_length, min_length, max_length,
+                        remove_loops, loop_max_angle,
+                        remove_outliers, outlier_threshold,
+                        remove_curv_dev, curv_qb_distance)
+
+    def _get_tasks():
+        for iteration_counter in range(1, nb_connections + 1):
+            start, end = bounds[iteration_counter - 1:iteration_counter + 1]
+            if iteration_counter % 100 == 0:
+                logging.info('Processing connection {}/{}'
+                             .format(iteration_counter, nb_connections))
+            logging.debug('Processing connection {}/{}: labels {} - {}'
+                          .format(iteration_counter, nb_connections,
+                                  in_labels[start], out_labels[start]))
+
+            # Copies: only this connection's data is sent to the workers.
+            connecting_ids = con_info['strl_idx'][start:end]
+            yield (in_labels[start], out_labels[start], reference,
+                   sft.streamlines[connecting_ids].copy(),
+                   indices[connecting_ids].copy(),
+                   points_to_idx[connecting_ids].copy(),
+                   con_info['in_idx'][start:end],
+                   con_info['out_idx'][start:end],
+                   dict(sft.data_per_streamline[connecting_ids]),
+                   cleaning_options)
+
+    # Each connection is cleaned independently, in parallel. The hdf5 is only
+    # written here, one connection at a time, in order. At most
+    # NB_CONNECTIONS_PER_PROCESS connections per process are waiting to be
+    # written, to bound the memory.
+    if nbr_cpu == 1:
+        for task in _get_tasks():
+            _write_connection(hdf5_file, _process_connection(task))
+    else:
+        pool = get_pool(nbr_cpu)
+        pending = deque()
+        for task in _get_tasks():
+            if len(pending) >= nbr_cpu * NB_CONNECTIONS_PER_PROCESS:
+                _write_connection(hdf5_file, pending.popleft().get())
+            pending.append(pool.apply_async(_process_connection, (task,)))
+        while len(pending) > 0:
+            _write_connection(hdf5_file, pending.popleft().get())
+
+
+def _process_connection(args):
+    """
+    Cleans the streamlines of one connection. Returns None if no streamline
+    remains, else the labels, streamlines and data_per_streamline to save in
+    the hdf5.
+    """
+    (in_label, out_label, reference, streamlines, indices, points_to_idx,
+     in_ids, out_ids, raw_dps, cleaning_options) = args
+    (saving_options, out_paths,
+     prune_from_length, min_length, max_length,
+     remove_loops, loop_max_angle,
+     remove_outliers, outlier_threshold,
+     remove_curv_dev, curv_qb_distance) = cleaning_options
+
+    # Preparing streamlines. Keeping only the segment between the two
+    # associated labels.
+    logging.debug("- Keeping only the segments between the two associated "
+                  "labels for each streamline. Any data_per_point will be "
+                  "lost.")
+    current_streamlines = []
+    for i in range(len(streamlines)):
+        current_streamlines.append(compute_streamline_segment(
+            streamlines[i], indices[i], in_ids[i], out_ids[i],
+            points_to_idx[i]))
+    current_sft = StatefulTractogram.from_sft(current_streamlines, reference,
+                                              data_per_streamline=raw_dps,
+                                              data_per_point={})
+    _save_intermediate(current_sft, saving_options, out_paths,
+                       in_label, out_label,
+                       save_type='raw', step_name='raw')
+    del current_streamlines
+
+    # Cleaning.
+    # Each step is processed from the previous 'success'
+    #   1. raw         -> length pass/fail
+    #   2. length pass -> loops pass/fail
+    #   3. loops pass  -> outlier detection pass/fail
+    #   4. outlier detection pass -> qb curvature pass/fail
+    #   5. qb curvature pass == final connections
+
+    # STEP 1
+    if prune_from_length:
+        logging.debug("- Step 1: Pruning by length: [{}, {}]"
+                      .format(min_length, max_length))
+        _, valid_length_ids = filter_streamlines_by_length(
+            current_sft, min_length, max_length)
+        invalid_length_ids = np.setdiff1d(np.arange(len(current_sft)),
+                                          valid_length_ids)
+
+        # Discarded:
+        discarded_sft = current_sft[invalid_length_ids]
+        _save_intermediate(discarded_sft, saving_options, out_paths,
+                           in_label, out_label, save_type='discarded',
+                           step_name='invalid_length')
+
+        # Remaining:
+        logging.debug("  Streamlines with valid length: {} / {}"
+                      .format(len(valid_length_ids), len(current_sft)))
+        current_sft = current_sft[valid_length_ids]
         _save_intermediate(current_sft, saving_options, out_paths,
-                           in_label, out_label,
-                           save_type='raw', step_name='raw')
-        del current_streamlines
-
-        # Cleaning.
-        # Each step is processed from the previous 'success'
-        #   1. raw         -> length pass/fail
-        #   2. length pass -> loops pass/fail
-        #   3. loops pass  -> outlier detection pass/fail
-        #   4. outlier detection pass -> qb curvature pass/fail
-        #   5. qb curvature pass == final connections
-
-        # STEP 1
-        if prune_from_length:
-            logging.debug("- Step 1: Pruning by length: [{}, {}]"
-                          .format(min_length, max_length))
-            _, valid_length_ids = filter_streamlines_by_length(
-                current_sft, min_length, max_length)
-            invalid_length_ids = np.setdiff1d(np.arange(len(current_sft)),
-                                              valid_length_ids)
-
-            # Discarded:
-            discarded_sft = current_sft[invalid_length_ids]
-            _save_intermediate(discarded_sft, saving_options, out_paths,
-                               in_label, out_label, save_type='discarded',
-                               step_name='invalid_length')
-
-            # Remaining:
-            logging.debug("  Streamlines with valid length: {} / {}"
-                          .format(len(valid_length_ids), len(current_sft)))
-            current_sft = current_sft[valid_length_ids]
-            _save_intermediate(current_sft, saving_options, out_paths,
-                               in_label, out_label, save_type='intermediate',
-                               step_name='valid_length')
-        else:
-            logging.debug("- Step 1 skipped (no pruning from length)")
-
-        if len(current_sft) == 0:
-            logging.debug("- No remaining streamlines. Stopping now.")
-            continue
-
-        # STEP 2
-        if remove_loops:
-            logging.debug("- Step 2: Removing loops > {}"
-                          .format(loop_max_angle))
-            no_loop_ids, _ = perform_remove_loops(
-                current_sft.streamlines, loop_max_angle, num_processes=nbr_cpu)
-            loop_ids = np.setdiff1d(np.arange(len(current_sft)), no_loop_ids)
-
-            # Discarded:
-            discarded_sft = current_sft[loop_ids]
-            _save_intermediate(discarded_sft, saving_options, out_paths,
-                               in_label, out_label, save_type='discarded',
-                               step_name='loops')
-
-            # Remaining:
-            logging.debug("  Streamlines with no loops: {} / {}"
-                          .format(len(no_loop_ids), len(current_sft)))
-            no_loops_sft = current_sft[no_loop_ids]
-            _save_intermediate(no_loops_sft, saving_options, out_paths,
-                               in_label, out_label, save_type='intermediate',
-                               step_name='no_loops')
-        else:
-            logging.debug("- Step 2 skipped (not removing loops)")
-
-        if len(current_sft) == 0:
-            logging.debug("- No remaining streamlines. Stopping now.")
-            continue
-
-        # STEP 3
-        if remove_outliers:
-            logging.debug("- Step 3: Removing outliers (Qb threshold: {})."
-                          .format(outlier_threshold))
-            outliers_ids, inliers_ids = remove_outliers_qb(
-                current_sft.streamlines, outlier_threshold, nb_samplings=10,
-                fast_approx=True)
-
-            # Discarded:
-            discarded_sft = current_sft[outliers_ids]
-            _save_intermediate(discarded_sft, saving_options, out_paths,
-                               in_label, out_label,  save_type='discarded',
-                               step_name='outliers')
-
-            # Remaining:
-            logging.debug("  Streamlines with no outliers: {} / {}"
-                          .format(len(inliers_ids), len(current_sft)))
-            current_sft = current_sft[inliers_ids]
-            _save_intermediate(current_sft, saving_options, out_paths,
-                               in_label, out_label, save_type='intermediate',
-                               step_name='inliers')
-        else:
-            logging.debug("- Step 3 skipped (not removing outliers)")
-
-        if len(current_sft) == 0:
-            logging.debug("- No remaining streamlines. Stopping now.")
-            continue
-
-        # STEP 4
-        if remove_curv_dev:
-            logging.debug("- Step 4: Removing sharp turns (Qb threshold: {})"
-                          .format(curv_qb_distance))
-            no_qb_curv_ids = remove_sharp_turns_qb(
-                current_sft.streamlines, qb_threshold=curv_qb_distance)
-            qb_curv_ids = np.setdiff1d(np.arange(len(current_sft)),
-                                       no_qb_curv_ids)
-
-            # Discarded:
-            discarded_sft = current_sft[qb_curv_ids]
-            _save_intermediate(discarded_sft, saving_options, out_paths,
-                               in_label, out_label,  save_type='discarded',
-                               step_name='qb_curv')
-
-            # Remaining:
-            logging.debug("  Streamlines with no sharp turns: {} / {}"
-                          .format(len(no_qb_curv_ids), len(current_sft)))
-            current_sft = current_sft[no_qb_curv_ids]
-            # (Saving below; they are the final streamlines, saved even if
-            # step 4 not done.)
-        else:
-            logging.debug("- Step 4 skipped (not removing sharp turns)")
-
-        # Final streamlines.
-        # Due to the cutting, streamlines can become invalid (meaning, they
-        # could have overlapping points)
-        logging.debug("Cleaning final streamlines: verifying that cutting the "
-                      "longest segment did not lead to overlapping points.")
-        current_sft = remove_streamlines_with_overlapping_points(current_sft)
-
-        logging.debug("  Final streamlines: {}".format(len(current_sft)))
+                           in_label, out_label, save_type='intermediate',
+                           step_name='valid_length')
+    else:
+        logging.debug("- Step 1 skipped (no pruning from length)")
+
+    if len(current_sft) == 0:
+        logging.debug("- No remaining streamlines. Stopping now.")
+        return None
+
+    # STEP 2
+    if remove_loops:
+        logging.debug("- Step 2: Removing loops > {}"
+                      .format(loop_max_angle))
+        no_loop_ids, _ = perform_remove_loops(
+            current_sft.streamlines, loop_max_angle)
+        loop_ids = np.setdiff1d(np.arange(len(current_sft)), no_loop_ids)
+
+        # Discarded:
+        discarded_sft = current_sft[loop_ids]
+        _save_intermediate(discarded_sft, saving_options, out_paths,
+                           in_label, out_label, save_type='discarded',
+                           step_name='loops')
+
+        # Remaining:
+        logging.debug("  Streamlines with no loops: {} / {}"
+                      .format(len(no_loop_ids), len(current_sft)))
+        no_loops_sft = current_sft[no_loop_ids]
+        _save_intermediate(no_loops_sft, saving_options, out_paths,
+                           in_label, out_label, save_type='intermediate',
+                           step_name='no_loops')
+    else:
+        logging.debug("- Step 2 skipped (not removing loops)")
+
+    if len(current_sft) == 0:
+        logging.debug("- No remaining streamlines. Stopping now.")
+        return None
+
+    # STEP 3
+    if remove_outliers:
+        logging.debug("- Step 3: Removing outliers (Qb threshold: {})."
+                      .format(outlier_threshold))
+        outliers_ids, inliers_ids = remove_outliers_qb(
+            current_sft.streamlines, outlier_threshold, nb_samplings=10,
+            fast_approx=True)
+
+        # Discarded:
+        discarded_sft = current_sft[outliers_ids]
+        _save_intermediate(discarded_sft, saving_options, out_paths,
+                           in_label, out_label,  save_type='discarded',
+                           step_name='outliers')
+
+        # Remaining:
+        logging.debug("  Streamlines with no outliers: {} / {}"
+                      .format(len(inliers_ids), len(current_sft)))
+        current_sft = current_sft[inliers_ids]
         _save_intermediate(current_sft, saving_options, out_paths,
-                           in_label, out_label, save_type='final',
-                           step_name='final')
-
-        # Saving final streamlines in the hdf5
-        group = hdf5_file.create_group('{}_{}'.format(in_label, out_label))
-        construct_hdf5_group_from_streamlines(
-            group, current_sft.streamlines,
-            dps=current_sft.data_per_streamline)
+                           in_label, out_label, save_type='intermediate',
+                           step_name='inliers')
+    else:
+        logging.debug("- Step 3 skipped (not removing outliers)")
+
+    if len(current_sft) == 0:
+        logging.debug("- No remaining streamlines. Stopping now.")
+        return None
+
+    # STEP 4
+    if remove_curv_dev:
+        logging.debug("- Step 4: Removing sharp turns (Qb threshold: {})"
+                      .format(curv_qb_distance))
+        no_qb_curv_ids = remove_sharp_turns_qb(
+            current_sft.streamlines, qb_threshold=curv_qb_distance)
+        qb_curv_ids = np.setdiff1d(np.arange(len(current_sft)),
+                                   no_qb_curv_ids)
+
+        # Discarded:
+        discarded_sft = current_sft[qb_curv_ids]
+        _save_intermediate(discarded_sft, saving_options, out_paths,
+                           in_label, out_label,  save_type='discarded',
+                           step_name='qb_curv')
+
+        # Remaining:
+        logging.debug("  Streamlines with no sharp turns: {} / {}"
+                      .format(len(no_qb_curv_ids), len(current_sft)))
+        current_sft = current_sft[no_qb_curv_ids]
+        # (Saving below; they are the final streamlines, saved even if
+        # step 4 not done.)
+    else:
+        logging.debug("- Step 4 skipped (not removing sharp turns)")
+
+    # Final streamlines.
+    # Due to the cutting, streamlines can become invalid (meaning, they
+    # could have overlapping points)
+    logging.debug("Cleaning final streamlines: verifying that cutting the "
+                  "longest segment did not lead to overlapping points.")
+    current_sft = remove_streamlines_with_overlapping_points(current_sft)
+
+    logging.debug("  Final streamlines: {}".format(len(current_sft)))
+    _save_intermediate(current_sft, saving_options, out_paths,
+                       in_label, out_label, save_type='final',
+                       step_name='final')
+
+    return in_label, out_label, current_sft.streamlines, \
+        dict(current_sft.data_per_streamline)
+
+
+def _write_connection(hdf5_file, connection):
+    """ Saves the final streamlines of a connection in the hdf5. """
+    if connection is None:
+        return
+    in_label, out_label, streamlines, dps = connection
+    group = hdf5_file.create_group('{}_{}'.format(in_label, out_label))
+    construct_hdf5_group_from_streamlines(group, streamlines, dps=dps)
 
 
 def _save_intermediate(sft, saving_options, out_paths, in_label, out_label,
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
+import h5py
+import nibabel as nib
+from nibabel.streamlines.array_sequence import ArraySequence
+import numpy as np
+
+from scilpy.tractanalysis import connectivity_segmentation
+from scilpy.tractanalysis.connectivity_segmentation import (
+    compute_connectivity, construct_hdf5_from_connectivity,
+    extract_longest_segments_from_profile)
+from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
+
+
+def _get_data():
+    rng = np.random.default_rng(1234)
+    atlas = rng.integers(1, 4, (6, 6, 6)) * (rng.random((6, 6, 6)) < 0.4)
+    indices = [rng.integers(0, 6, (int(rng.integers(0, 12)), 3))
+               for _ in range(300)]
+    # Out of bound: ignored.
+    indices[0][:, 0] = 6
+    return ArraySequence(indices), atlas.astype(np.uint16)
+
+
+def test_compute_connectivity(monkeypatch):
+    # Small chunks, to test the processing by chunks.
+    monkeypatch.setattr(connectivity_segmentation, 'CHUNK_SIZE', 70)
+    indices, atlas = _get_data()
+
+    expected = []
+    for strl_idx, strl_vox_indices in enumerate(indices):
+        if strl_idx == 0:
+            continue
+        for si in extract_longest_segments_from_profile(strl_vox_indices,
+                                                        atlas):
+            expected.append((min(si['start_label'], si['end_label']),
+                             max(si['start_label'], si['end_label']),
+                             si['start_label'] > si['end_label'], strl_idx,
+                             si['start_label'], si['end_label'],
+                             si['start_index'], si['end_index']))
+    expected = np.array(sorted(expected))[:, 3:]
+
+    for nbr_processes in [1, 2]:
+        con_info = compute_connectivity(indices, atlas,
+                                        nbr_processes=nbr_processes)
+        assert np.array_equal(np.stack((con_info['strl_idx'],
+                                        con_info['start_label'],
+                                        con_info['end_label'],
+                                        con_info['in_idx'],
+                                        con_info['out_idx']), axis=1),
+                              expected)
+
+
+def test_construct_hdf5_from_connectivity(tmp_path):
+    # Three labels, in a row. Streamlines from one label to another.
+    rng = np.random.default_rng(1234)
+    atlas = np.zeros((30, 10, 10), dtype=np.uint16)
+    atlas[0:5] = 1
+    atlas[12:17] = 2
+    atlas[25:30] = 3
+    streamlines = []
+    for _ in range(60):
+        start, end = rng.choice([2.5, 14.5, 27.5], 2, replace=False)
+        points = np.linspace([start, 5, 5], [end, 5, 5], 20)
+        streamlines.append((points + rng.normal(0, 0.3, points.shape))
+                           .astype(np.float32))
+    sft = StatefulTractogram(
+        streamlines, nib.Nifti1Image(atlas, np.eye(4)), space=Space.VOX,
+        origin=Origin('corner'))
+    sft.data_per_streamline['ids'] = np.arange(60)[:, None]
+
+    indices, points_to_idx = streamlines_to_voxel_coordinates(
+        sft.streamlines, return_mapping=True)
+    con_info = compute_connectivity(indices, atlas)
+
+    results = []
+    for nbr_cpu in [1, 2]:
+        with h5py.File(tmp_path / 'out_{}.h5'.format(nbr_cpu), 'w') as f:
+            construct_hdf5_from_connectivity(
+                sft, indices, points_to_idx, con_info, f,
+                {'raw': False, 'intermediate': False, 'discarded': False,
+                 'final': False}, {},
+                True, 5, 50, True, 360, False, 0.6, False, 10, nbr_cpu)
+            results.append({key: (f[key]['data'][:], f[key]['ids'][:])
+                            for key in f.keys()})
+
+    assert list(results[0].keys()) == ['1_2', '1_3', '2_3']
+    for key in results[0]:
+        assert np.array_equal(results[0][key][0], results[1][key][0])
+        assert np.array_equal(results[0][key][1], results[1][key][1])
+        connecting_ids = con_info['strl_idx'][
+            (np.minimum(con_info['start_label'], con_info['end_label']) ==
+             int(key[0])) &
+            (np.maximum(con_info['start_label'], con_info['end_label']) ==
+             int(key[2]))]
+        assert np.array_equal(results[0][key][1].ravel(), connecting_ids)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from nibabel.streamlines.array_sequence import ArraySequence
+import numpy as np
+
+from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
+from scilpy.tractanalysis.voxel_boundary_intersection import \
+    subdivide_streamlines_at_voxel_faces
+from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
+
+
+def _get_streamlines():
+    rng = np.random.default_rng(1234)
+    streamlines = []
+    for _ in range(100):
+        nb_points = int(rng.integers(2, 20))
+        s = np.cumsum(rng.normal(0, 1, (nb_points, 3)), axis=0) + 5
+        streamlines.append(np.clip(s, 0.01, 9.99).astype(np.float32))
+    return ArraySequence(streamlines)
+
+
+def test_compute_tract_counts_map():
+    streamlines = ArraySequence([[[0.5, 0.5, 0.5], [2.5, 0.5, 0.5]],
+                                 [[1.5, 0.5, 0.5], [1.5, 1.5, 0.5],
+                                  [1.5, 0.7, 0.5]]])
+    counts = compute_tract_counts_map(streamlines, (3, 3, 3))
+    assert counts[0, 0, 0] == 1
+    assert counts[1, 0, 0] == 2
+    assert counts[1, 1, 0] == 1
+    assert np.sum(counts) == 5
+
+    # Same result with many threads, or from a list.
+    streamlines = _get_streamlines()
+    counts = compute_tract_counts_map(streamlines, (10, 10, 10))
+    assert np.array_equal(
+        compute_tract_counts_map(streamlines, (10, 10, 10), nbr_threads=4),
+        counts)
+    assert np.array_equal(
+        compute_tract_counts_map(list(streamlines), (10, 10, 10)), counts)
+
+
+def test_parallel_voxel_traversal():
+    streamlines = _get_streamlines()
+
+    indices, points_to_idx = streamlines_to_voxel_coordinates(
+        streamlines, return_mapping=True)
+    indices_4, points_to_idx_4 = streamlines_to_voxel_coordinates(
+        streamlines, return_mapping=True, nbr_threads=4)
+    assert np.array_equal(indices.get_data(), indices_4.get_data())
+    assert np.array_equal(indices._offsets, indices_4._offsets)
+    assert np.array_equal(points_to_idx.get_data(),
+                          points_to_idx_4.get_data())
+
+    # Slices: only the selected streamlines are processed.
+    indices_slice = streamlines_to_voxel_coordinates(streamlines[10:20],
+                                                     nbr_threads=4)
+    for i in range(10):
+        assert np.array_equal(indices_slice[i], indices[i + 10])
+
+    split = subdivide_streamlines_at_voxel_faces(streamlines)
+    split_4 = subdivide_streamlines_at_voxel_faces(streamlines,
+                                                   nbr_threads=4)
+    assert np.array_equal(split.get_data(), split_4.get_data())
+    assert np.array_equal(split._lengths, split_4._lengths)
@@ -5,10 +5,15 @@ from libc.math cimport ceil, fabs, floor, sqrt
 from libc.math cimport fmin as cfmin
 
 import cython
+from cython.parallel cimport prange
+from libc.stdlib cimport free, malloc
 import nibabel as nib
 import numpy as np
 cimport numpy as cnp
 
+from scilpy.tractograms.uncompress import _get_blocks
+from scilpy.utils.parallel import get_nbr_processes
+
 
 cdef struct Pointers:
     # Incremented when we complete a streamline. Saved at the start of each
@@ -28,7 +33,7 @@ cdef struct Pointers:
 
 @cython.boundscheck(False)
 @cython.cdivision(True)
-def subdivide_streamlines_at_voxel_faces(streamlines):
+def subdivide_streamlines_at_voxel_faces(streamlines, nbr_threads=1):
     """
     Cut streamlines segments into smaller segments such that a segment covering
     more than one voxel is split into smaller segments that either end or start
@@ -38,6 +43,9 @@ def subdivide_streamlines_at_voxel_faces(streamlines):
     ----------
     streamlines: list of ndarray
         Streamlines coordinates in voxel space, corner origin.
+    nbr_threads: int
+        Number of threads. If None or <= 0, all CPUs are used. Streamlines
+        are processed by independent blocks.
 
     Returns
     -------
@@ -47,16 +55,20 @@ def subdivide_streamlines_at_voxel_faces(streamlines):
     """
     cdef:
         cnp.npy_intp nb_streamlines = len(streamlines._lengths)
-        cnp.npy_intp at_point = 0
-
-        # Multiplying by 6 is simply a heuristic to avoiding resizing too many
-        # times. In my bundles tests, I had either 0 or 1 resize.
-        cnp.npy_intp max_points = (streamlines.get_data().size // 6) * 12
+        cnp.npy_intp nb_blocks, block_idx, start, end
+        int nb_threads = get_nbr_processes(nbr_threads)
+        bint finished
 
     new_array_sequence = nib.streamlines.array_sequence.ArraySequence()
-    new_array_sequence._lengths.resize(nb_streamlines)
-    new_array_sequence._offsets.resize(nb_streamlines)
-    new_array_sequence._data = np.empty(max_points * 3, np.float32)
+    if nb_streamlines == 0:
+        new_array_sequence._data = np.zeros((0, 3), np.float32)
+        return new_array_sequence
+
+    streamlines, blocks = _get_blocks(streamlines, nb_threads)
+    nb_blocks = len(blocks) - 1
+
+    new_array_sequence._lengths = np.zeros(nb_streamlines, np.intp)
+    new_array_sequence._offsets = np.zeros(nb_streamlines, np.intp)
 
     cdef:
         cnp.npy_intp[:] lengths_view_in = streamlines._lengths
@@ -64,36 +76,84 @@ def subdivide_streamlines_at_voxel_faces(streamlines):
         float[:, :] data_view_in = streamlines._data
         cnp.npy_intp[:] lengths_view_out = new_array_sequence._lengths
         cnp.npy_intp[:] offsets_view_out = new_array_sequence._offsets
-        cnp.float32_t[:] data_view_out = new_array_sequence._data
-
-    cdef Pointers pointers
-    pointers.lengths_in = &lengths_view_in[0]
-    pointers.lengths_in_end = pointers.lengths_in + nb_streamlines
-    pointers.offsets_in = &offsets_view_in[0]
-    pointers.data_in = &data_view_in[0, 0]
-    pointers.lengths_out = &lengths_view_out[0]
-    pointers.offsets_out = &offsets_view_out[0]
-    pointers.data_out = &data_view_out[0]
-
-    while 1:
-        at_point = _grid_intersections(&pointers, at_point, max_points - 1)
-        if pointers.lengths_in == pointers.lengths_in_end:
-            # Job finished, we can return the streamlines
-            break
-
-        # Resize and point the memoryview and pointer on the right data
-        max_points += max_points / 3  # Make it one third bigger
-        new_array_sequence._data.resize(max_points * 3, refcheck=False)
-        data_view_out = new_array_sequence._data
-        pointers.data_out = &data_view_out[0] + at_point * 3
-
-    new_array_sequence._data.resize((at_point, 3), refcheck=False)
+        cnp.float32_t[:] data_view_out
+
+        Pointers *pointers = <Pointers *>malloc(nb_blocks * sizeof(Pointers))
+        cnp.npy_intp[:] at_point = np.zeros(nb_blocks, np.intp)
+        cnp.npy_intp[:] max_points = np.zeros(nb_blocks, np.intp)
+
+    # Each block has its own output data. Lengths are written in place.
+    blocks_data = []
+    try:
+        for block_idx in range(nb_blocks):
+            start, end = blocks[block_idx], blocks[block_idx + 1]
+
+            # Multiplying by 2 is simply a heuristic to avoiding resizing too
+            # many times. In my bundles tests, I had either 0 or 1 resize.
+            max_points[block_idx] = max(
+                np.sum(streamlines._lengths[start:end]) * 2, 16)
+            blocks_data.append(np.empty(max_points[block_idx] * 3,
+                                        np.float32))
+            data_view_out = blocks_data[block_idx]
+
+            pointers[block_idx].lengths_in = &lengths_view_in[start]
+            pointers[block_idx].lengths_in_end = &lengths_view_in[0] + end
+            pointers[block_idx].offsets_in = &offsets_view_in[start]
+            pointers[block_idx].data_in = \
+                &data_view_in[offsets_view_in[start], 0]
+            pointers[block_idx].lengths_out = &lengths_view_out[start]
+            pointers[block_idx].offsets_out = &offsets_view_out[start]
+            pointers[block_idx].data_out = &data_view_out[0]
+
+        while 1:
+            for block_idx in prange(nb_blocks, num_threads=nb_threads,
+                                    schedule='dynamic', nogil=True):
+                if pointers[block_idx].lengths_in != \
+                        pointers[block_idx].lengths_in_end:
+                    at_point[block_idx] = _grid_intersections(
+                        &pointers[block_idx], at_point[block_idx],
+                        max_points[block_idx] - 1)
+
+            finished = True
+            for block_idx in range(nb_blocks):
+                if pointers[block_idx].lengths_in == \
+                        pointers[block_idx].lengths_in_end:
+                    # Job finished for this block
+                    continue
+                finished = False
+
+                # Resize and point the memoryview and pointer on the right
+                # data. Make it one third bigger.
+                max_points[block_idx] += max_points[block_idx] // 3
+                blocks_data[block_idx].resize(max_points[block_idx] * 3,
+                                              refcheck=False)
+                data_view_out = blocks_data[block_idx]
+                pointers[block_idx].data_out = \
+                    &data_view_out[0] + at_point[block_idx] * 3
+
+            if finished:
+                # Job finished, we can return the streamlines
+                break
+    finally:
+        free(pointers)
+
+    # Offsets were computed inside each block.
+    new_array_sequence._offsets[:] = \
+        np.cumsum(new_array_sequence._lengths) - new_array_sequence._lengths
+
+    if nb_blocks == 1:
+        new_array_sequence._data = blocks_data[0]
+        new_array_sequence._data.resize((at_point[0], 3), refcheck=False)
+    else:
+        new_array_sequence._data = np.concatenate(
+            [data[:at_point[i] * 3] for i, data in enumerate(blocks_data)]
+        ).reshape((-1, 3))
     return new_array_sequence
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef inline double norm(double x, double y, double z) nogil:
+cdef inline double norm(double x, double y, double z) noexcept nogil:
     cdef double val = sqrt(x*x + y*y + z*z)
     return val
 
@@ -104,7 +164,7 @@ cdef inline double norm(double x, double y, double z) nogil:
 cdef inline void c_get_closest_edge(double *p,
                                     double *direction,
                                     double *edge,
-                                    double eps=1.0) nogil:
+                                    double eps=1.0) noexcept nogil:
     edge[0] = floor(p[0] + eps) if direction[0] >= 0.0 else ceil(p[0] - eps)
     edge[1] = floor(p[1] + eps) if direction[1] >= 0.0 else ceil(p[1] - eps)
     edge[2] = floor(p[2] + eps) if direction[2] >= 0.0 else ceil(p[2] - eps)
@@ -112,28 +172,28 @@ cdef inline void c_get_closest_edge(double *p,
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef inline void copypoint_f(float * a, float * b) nogil:
+cdef inline void copypoint_f(float * a, float * b) noexcept nogil:
     for i in range(3):
         b[i] = a[i]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef inline void copypoint_d(double * a, double * b) nogil:
+cdef inline void copypoint_d(double * a, double * b) noexcept nogil:
     for i in range(3):
         b[i] = a[i]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef inline void copypoint_f2d(float * a, double * b) nogil:
+cdef inline void copypoint_f2d(float * a, double * b) noexcept nogil:
     for i in range(3):
         b[i] = <double>(a[i])
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef inline void copypoint_d2f(double * a, float * b) nogil:
+cdef inline void copypoint_d2f(double * a, float * b) noexcept nogil:
     for i in range(3):
         b[i] = <float>(a[i])
 
@@ -143,7 +203,7 @@ cdef inline void copypoint_d2f(double * a, float * b) nogil:
 cdef cnp.npy_intp _grid_intersections(
         Pointers* pointers,
         cnp.npy_intp at_point,
-        cnp.npy_intp max_points) nogil:
+        cnp.npy_intp max_points) noexcept nogil:
     cdef:
         float *backup_data_in
         cnp.npy_intp backup_at_point
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from nibabel.streamlines.array_sequence import ArraySequence
 import numpy as np
 
 from scilpy.viz.color import clip_and_normalize_data_for_cmap
@@ -113,11 +114,40 @@ def convert_dps_to_dpp(sft, keys, overwrite=False):
     return sft
 
 
+def _get_compact(sequence):
+    """
+    The ArraySequence with its elements stored contiguously and in order in
+    its _data, as expected when working on _data directly. A slice or a
+    reordering of a tractogram (ex, sft[ids]) shares the _data of the whole
+    tractogram: it is then copied.
+    """
+    lengths = np.asarray(sequence._lengths)
+    if len(sequence._data) == np.sum(lengths) and \
+            np.array_equal(sequence._offsets, np.cumsum(lengths) - lengths):
+        return sequence
+    return sequence.copy()
+
+
+def _get_endpoints_idx(streamlines):
+    """
+    Indices, in streamlines._data, of the first and last point of each
+    (non-empty) streamline. The streamlines must be compact (see
+    _get_compact).
+    """
+    lengths = np.asarray(streamlines._lengths)
+    offsets = np.asarray(streamlines._offsets)[lengths > 0]
+    lengths = lengths[lengths > 0]
+    return np.concatenate((offsets, offsets + lengths - 1))
+
+
 def project_map_to_streamlines(sft, map_volume, endpoints_only=False):
     """
     Projects a map onto the points of streamlines. The result is a
     data_per_point.
 
+    All points are interpolated at once, on the concatenated points of the
+    streamlines.
+
     Parameters
     ----------
     sft: StatefulTractogram
@@ -131,46 +161,34 @@ def project_map_to_streamlines(sft, map_volume, endpoints_only=False):
 
     Returns
     -------
-    streamline_data: List[List]
+    streamline_data: ArraySequence
         The values that could now be associated to a data_per_point key.
-        The map_volume projected to each point of the streamlines.
+        The map_volume projected to each point of the streamlines, of shape
+        (nb_points, dimension) for each streamline.
     """
     if len(map_volume.data.shape) == 4:
         dimension = map_volume.data.shape[3]
     else:
         dimension = 1
 
-    streamline_data = []
+    streamlines = _get_compact(sft.streamlines)
+    points = streamlines._data
     if endpoints_only:
-        for s in sft.streamlines:
-            p1_data = map_volume.get_value_at_coordinate(
-                s[0][0], s[0][1], s[0][2],
-                space=sft.space, origin=sft.origin)
-            p2_data = map_volume.get_value_at_coordinate(
-                s[-1][0], s[-1][1], s[-1][2],
-                space=sft.space, origin=sft.origin)
-
-            thisstreamline_data = np.ones((len(s), dimension)) * np.nan
-
-            thisstreamline_data[0] = p1_data
-            thisstreamline_data[-1] = p2_data
-            thisstreamline_data = np.asarray(thisstreamline_data)
-
-            streamline_data.append(
-                np.reshape(thisstreamline_data,
-                           (len(thisstreamline_data), dimension)))
+        idx = _get_endpoints_idx(streamlines)
+        data = np.full((len(points), dimension), np.nan)
+        data[idx] = map_volume.get_values_at_coordinates(
+            points[idx], space=sft.space,
+            origin=sft.origin).reshape((-1, dimension))
     else:
-        # toDo: there is a double loop. Could be faster?
-        for s in sft.streamlines:
-            thisstreamline_data = []
-            for p in s:
-                thisstreamline_data.append(map_volume.get_value_at_coordinate(
-                    p[0], p[1], p[2], space=sft.space, origin=sft.origin))
-
-            streamline_data.append(
-                np.reshape(thisstreamline_data,
-                           (len(thisstreamline_data), dimension)))
-
+        data = map_volume.get_values_at_coordinates(
+            points, space=sft.space,
+            origin=sft.origin).reshape((-1, dimension))
+
+    # Same offsets and lengths as the (compact) streamlines.
+    streamline_data = ArraySequence()
+    streamline_data._data = data
+    streamline_data._offsets = streamlines._offsets.copy()
+    streamline_data._lengths = streamlines._lengths.copy()
     return streamline_data
 
 
@@ -205,19 +223,26 @@ def project_dpp_to_map(sft, dpp_key, sum_lines=False, endpoints_only=False):
     # the voxel where it is.
     sft.to_corner()
 
+    streamlines = _get_compact(sft.streamlines)
+    points = streamlines._data
+    values = _get_compact(sft.data_per_point[dpp_key])._data.reshape(
+        (len(points), -1))
+    if values.shape[1] != 1:
+        raise ValueError("Data per point {} should have one value per point "
+                         "to be projected to a map.".format(dpp_key))
+    values = values[:, 0]
+
+    if endpoints_only:
+        idx = _get_endpoints_idx(streamlines)
+        points = points[idx]
+        values = values[idx]
+
     # count: could also use compute_tract_counts_map.
-    count = np.zeros(sft.dimensions)
-    the_map = np.zeros(sft.dimensions)
-    for s in range(len(sft)):
-        if endpoints_only:
-            points = [0, -1]
-        else:
-            points = range(len(sft.streamlines[s]))
-
-        for p in points:
-            x, y, z = sft.streamlines[s][p, :].astype(int)  # Or floor
-            count[x, y, z] += 1
-            the_map[x, y, z] += np.squeeze(sft.data_per_point[dpp_key][s][p])
+    dims = tuple(sft.dimensions)
+    voxels = np.ravel_multi_index(points.astype(int).T, dims)  # Or floor
+    count = np.bincount(voxels, minlength=np.prod(dims)).reshape(dims)
+    the_map = np.bincount(voxels, weights=values,
+                          minlength=np.prod(dims)).reshape(dims)
 
     if not sum_lines:
         count = np.maximum(count, 1e-6)  # Avoid division by 0
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""
+Index of streamlines allowing to find (almost) identical streamlines, in
+near-linear time.
+
+Streamlines are hashed in a grid using their number of points and the
+cell (of size 4 * epsilon) of their first point. Two streamlines can only
+match if they have the same number of points and if their first points are
+in neighbouring cells. Candidates are then verified, in a vectorized way:
+first on a small signature (first, middle and last points), then on all
+points.
+"""
+
+import itertools
+
+from nibabel.streamlines.array_sequence import ArraySequence
+import numpy as np
+
+# Maximal number of points compared at once when verifying candidates.
+# Candidates are verified by independent chunks.
+BLOCK_NB_POINTS = 2 ** 20
+
+# Maximal value of the hash keys (they are stored as int64).
+_MAX_KEY = 2 ** 62
+
+# Neighbouring cells to look at, in the direction of the closest side of
+# the cell along each axis (including the cell itself).
+_NEIGHBOURS = np.array(list(itertools.product((0, 1), repeat=3)))
+
+
+def _as_array_sequence(streamlines):
+    if isinstance(streamlines, ArraySequence):
+        return streamlines
+    return ArraySequence(streamlines)
+
+
+def _expand_ranges(starts, counts):
+    """
+    Concatenation of the ranges [start, start + count[, vectorized.
+    Also returns, for each value, the index of its range.
+    """
+    range_ids = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    values = (np.arange(counts.sum()) - np.repeat(first, counts) +
+              np.repeat(starts, counts))
+    return values, range_ids
+
+
+class StreamlineIndex(object):
+    """
+    Spatial hash of a set of streamlines, to find the streamlines that are
+    identical to others, up to a distance of 2 * epsilon on all points.
+
+    The index is built once and can be queried with any set of streamlines
+    (see query), or with its own streamlines (see query_pairs).
+    """
+    def __init__(self, streamlines, epsilon=0.001):
+        """
+        Parameters
+        ----------
+        streamlines: list of np.ndarray or ArraySequence
+            The streamlines to index.
+        epsilon: float
+            Two streamlines match if all their points are at a distance
+            smaller than 2 * epsilon.
+        """
+        self.streamlines = _as_array_sequence(streamlines)
+        self.radius = 2 * epsilon
+
+        self._lengths = np.asarray(self.streamlines._lengths, dtype=np.int64)
+        self._offsets = np.asarray(self.streamlines._offsets, dtype=np.int64)
+        self._points = self.streamlines._data.reshape((-1, 3))
+        valid = self._lengths > 0
+
+        # Grid: first points of the streamlines, in cells of size twice the
+        # radius. With very small radius (or very large tractograms), the
+        # cells are enlarged so that keys fit in an int64. Bigger cells only
+        # produce more candidates, never fewer.
+        self._unique_lengths = np.unique(self._lengths[valid])
+        if np.any(valid):
+            first_points = self._points[self._offsets[valid]]
+            self._origin = first_points.min(axis=0)
+            extent = first_points.max(axis=0) - self._origin
+        else:
+            self._origin = np.zeros(3)
+            extent = np.zeros(3)
+
+        self._cell_size = 2 * self.radius
+        while True:
+            # + 3: one empty cell on each side, for neighbours.
+            self._dims = [int(d) for d in
+                          np.floor(extent / self._cell_size) + 3]
+            nb_keys = (max(len(self._unique_lengths), 1) *
+                       self._dims[0] * self._dims[1] * self._dims[2])
+            if nb_keys < _MAX_KEY:
+                break
+            self._cell_size *= 2
+
+        keys = self._get_keys(self._lengths, self._offsets, self._points)
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[self._order]
+
+    def __len__(self):
+        return len(self.streamlines)
+
+    def _get_cells(self, lengths, offsets, points):
+        """
+        Cell of the first point of each streamline, and direction (-1 or 1)
+        of the closest side of the cell along each axis.
+        """
+        valid = lengths > 0
+        cells = np.zeros((len(lengths), 3), dtype=np.int64)
+        sides = np.ones((len(lengths), 3), dtype=np.int64)
+        coords = (points[offsets[valid]] - self._origin) / self._cell_size
+        cells[valid] = np.floor(coords).astype(np.int64) + 1
+        sides[valid] = np.where(coords % 1 < 0.5, -1, 1)
+        return cells, sides, valid
+
+    def _pack_keys(self, length_ids, cells, valid):
+        """ Hash keys. Invalid entries (outside the grid) are set to -1. """
+        dims = np.asarray(self._dims)
+        valid = valid & np.all((cells >= 0) & (cells < dims), axis=1)
+        cells = np.where(valid[:, None], cells, 0)
+        keys = ((length_ids * dims[0] + cells[:, 0]) * dims[1] +
+                cells[:, 1]) * dims[2] + cells[:, 2]
+        keys[~valid] = -1
+        return keys
+
+    def _get_length_ids(self, lengths):
+        length_ids = np.searchsorted(self._unique_lengths, lengths)
+        length_ids = np.minimum(length_ids, len(self._unique_lengths) - 1)
+        valid = (lengths > 0) & (len(self._unique_lengths) > 0)
+        valid[valid] = self._unique_lengths[length_ids[valid]] == \
+            lengths[valid]
+        return length_ids.astype(np.int64), valid
+
+    def _get_keys(self, lengths, offsets, points):
+        length_ids, valid_lengths = self._get_length_ids(lengths)
+        cells, _, valid = self._get_cells(lengths, offsets, points)
+        return self._pack_keys(length_ids, cells, valid & valid_lengths)
+
+    def _get_candidates(self, lengths, offsets, points):
+        """
+        Candidate pairs (query index, index in self.streamlines): same number
+        of points and first points in neighbouring cells. Cells are at least
+        twice the radius: any point within the radius of a point is in its
+        cell or in the neighbouring cell on the side of the closest border,
+        along each axis.
+        """
+        length_ids, valid_lengths = self._get_length_ids(lengths)
+        cells, sides, valid = self._get_cells(lengths, offsets, points)
+        valid &= valid_lengths
+
+        # Sorting the queries by key: the keys of their neighbours are then
+        # (mostly) sorted too, which makes searchsorted much faster.
+        order = np.argsort(self._pack_keys(length_ids, cells, valid),
+                           kind='stable')
+        length_ids = length_ids[order]
+        cells = cells[order]
+        sides = sides[order]
+        valid = valid[order]
+
+        query_ids = []
+        indexed_ids = []
+        for neighbour in _NEIGHBOURS:
+            keys = self._pack_keys(length_ids, cells + neighbour * sides,
+                                   valid)
+            left = np.searchsorted(self._sorted_keys, keys, side='left')
+            right = np.searchsorted(self._sorted_keys, keys, side='right')
+            counts = np.where(keys >= 0, right - left, 0)
+
+            positions, ids = _expand_ranges(left, counts)
+            query_ids.append(order[ids])
+            indexed_ids.append(self._order[positions])
+
+        return np.concatenate(query_ids), np.concatenate(indexed_ids)
+
+    def _verify(self, query_ids, indexed_ids, lengths, offsets, points):
+        """
+        Keep the candidates where all points are at a distance smaller than
+        the radius. Returns the kept pairs and their average difference.
+        """
+        # Quick check on the first, middle and last points.
+        to_check = np.ones(len(query_ids), dtype=bool)
+        nb_points = lengths[query_ids]
+        for k in (np.zeros_like(nb_points), nb_points // 2, nb_points - 1):
+            diff = (points[offsets[query_ids] + k] -
+                    self._points[self._offsets[indexed_ids] + k])
+            to_check &= np.linalg.norm(diff, axis=1) < self.radius
+        query_ids = query_ids[to_check]
+        indexed_ids = indexed_ids[to_check]
+        nb_points = nb_points[to_check]
+
+        # Full check, by chunks of a bounded number of points.
+        is_match = np.zeros(len(query_ids), dtype=bool)
+        avg_diff = np.zeros((len(query_ids), 3))
+        cumsum = np.cumsum(nb_points)
+        start = 0
+        while start < len(query_ids):
+            # Always at least one pair per chunk.
+            end = np.searchsorted(cumsum, cumsum[start] - nb_points[start] +
+                                  BLOCK_NB_POINTS, side='right')
+            end = max(end, start + 1)
+            chunk = slice(start, end)
+            counts = nb_points[chunk]
+            query_points, _ = _expand_ranges(offsets[query_ids[chunk]],
+                                             counts)
+            indexed_points, _ = _expand_ranges(
+                self._offsets[indexed_ids[chunk]], counts)
+            diff = points[query_points] - self._points[indexed_points]
+
+            first = np.cumsum(counts) - counts
+            too_far = np.linalg.norm(diff, axis=1) >= self.radius
+            is_match[chunk] = ~np.logical_or.reduceat(too_far, first)
+            avg_diff[chunk] = (np.add.reduceat(diff, first, axis=0) /
+                               counts[:, None])
+            start = end
+
+        return (query_ids[is_match], indexed_ids[is_match],
+                avg_diff[is_match])
+
+    def query(self, streamlines, return_distances=False):
+        """
+        Find the indexed streamlines identical to the given streamlines.
+
+        Parameters
+        ----------
+        streamlines: list of np.ndarray or ArraySequence
+            The streamlines to look for.
+        return_distances: bool
+            If true, also return the average difference (vector) between the
+            points of the matched streamlines.
+
+        Returns
+        -------
+        matches: np.ndarray of shape (M, 2)
+            Pairs of indices (index in streamlines, index in the indexed
+            streamlines), sorted.
+        distances: np.ndarray of shape (M, 3)
+            Only if return_distances.
+        """
+        streamlines = _as_array_sequence(streamlines)
+        lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+        offsets = np.asarray(streamlines._offsets, dtype=np.int64)
+        points = streamlines._data.reshape((-1, 3))
+
+        query_ids, indexed_ids = self._get_candidates(lengths, offsets,
+                                                      points)
+        return self._format_matches(
+            *self._verify(query_ids, indexed_ids, lengths, offsets, points),
+            return_distances=return_distances)
+
+    def query_pairs(self, return_distances=False):
+        """
+        Find all pairs of identical streamlines in the index.
+
+        Parameters
+        ----------
+        return_distances: bool
+            If true, also return the average difference (vector) between the
+            points of the matched streamlines.
+
+        Returns
+        -------
+        matches: np.ndarray of shape (M, 2)
+            Pairs of indices (i, j), with i < j, sorted.
+        distances: np.ndarray of shape (M, 3)
+            Only if return_distances.
+        """
+        query_ids, indexed_ids = self._get_candidates(
+            self._lengths, self._offsets, self._points)
+        # Each pair is found twice. Yourself is never a match.
+        upper = query_ids < indexed_ids
+        return self._format_matches(
+            *self._verify(query_ids[upper], indexed_ids[upper],
+                          self._lengths, self._offsets, self._points),
+            return_distances=return_distances)
+
+    @staticmethod
+    def _format_matches(query_ids, indexed_ids, avg_diff,
+                        return_distances=False):
+        order = np.lexsort((indexed_ids, query_ids))
+        matches = np.stack((query_ids[order], indexed_ids[order]), axis=1)
+        if return_distances:
+            return matches, avg_diff[order]
+        return matches
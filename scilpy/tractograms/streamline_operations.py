@@ -902,9 +902,12 @@ def remove_loops(streamlines, max_angle, num_processes=1):
     streamlines_clean: list or ndarray
         The remaining streamlines.
     """
-    pool = Pool(num_processes)
-    windings = pool.map(tm.winding, streamlines)
-    pool.close()
+    if num_processes == 1:
+        windings = [tm.winding(s) for s in streamlines]
+    else:
+        pool = Pool(num_processes)
+        windings = pool.map(tm.winding, streamlines)
+        pool.close()
 
     streamlines_clean = streamlines[np.array(windings) < max_angle]
     ids = list(np.where(np.array(windings) < max_angle)[0])
@@ -6,9 +6,9 @@ from dipy.io.stateful_tractogram import StatefulTractogram, Space, Origin
 from scilpy.image.volume_space_management import DataVolume
 from scilpy.tests.utils import nan_array_equal
 from scilpy.tractograms.dps_and_dpp_management import (
-    add_data_as_color_dpp, convert_dps_to_dpp, project_map_to_streamlines,
-    project_dpp_to_map, perform_operation_on_dpp, perform_operation_dpp_to_dps,
-    perform_correlation_on_endpoints)
+    _get_compact, add_data_as_color_dpp, convert_dps_to_dpp,
+    project_map_to_streamlines, project_dpp_to_map, perform_operation_on_dpp,
+    perform_operation_dpp_to_dps, perform_correlation_on_endpoints)
 from scilpy.viz.color import get_lookup_table
 
 
@@ -27,6 +27,36 @@ def _get_small_sft():
     return fake_sft
 
 
+def _get_sft_with_dpp():
+    # SFT = 15 streamlines of 2 to 6 points, with the value of the voxel of
+    # each point as dpp.
+    rng = np.random.RandomState(0)
+    map_data = rng.rand(5, 5, 5)
+    streamlines = [rng.rand(2 + i % 5, 3) * 5 for i in range(15)]
+    fake_ref = nib.Nifti1Image(np.zeros((5, 5, 5)), affine=np.eye(4))
+    fake_sft = StatefulTractogram(
+        streamlines, reference=fake_ref, space=Space.VOX,
+        origin=Origin('corner'),
+        data_per_point={'my_dpp': [map_data[tuple(s.astype(int).T)][:, None]
+                                   for s in streamlines]})
+    return fake_sft, map_data
+
+
+def test_get_compact():
+    fake_sft, _ = _get_sft_with_dpp()
+    streamlines = fake_sft.streamlines
+    assert _get_compact(streamlines) is streamlines
+
+    # Subset, or all streamlines in another order: views on the same data.
+    for ids in [[3, 7, 12], list(range(15))[::-1]]:
+        compact = _get_compact(streamlines[ids])
+        assert len(compact._data) == np.sum(compact._lengths)
+        assert np.array_equal(compact._offsets,
+                              np.cumsum(compact._lengths) - compact._lengths)
+        for s, j in zip(compact, ids):
+            assert np.array_equal(s, streamlines[j])
+
+
 def test_add_data_as_color_dpp():
     lut = get_lookup_table('viridis')
 
@@ -103,6 +133,7 @@ def test_project_map_to_streamlines():
     # Test 1A. All points
     dpp = project_map_to_streamlines(fake_sft, map_volume)
     fake_sft.data_per_point['test1A'] = dpp  # Will fail if not the right shape
+    assert np.array_equal(dpp._lengths, fake_sft.streamlines._lengths)
     assert np.array_equal(dpp[0].squeeze(), [1] * 3)
     assert np.array_equal(dpp[1].squeeze(), [2] * 4)
 
@@ -128,6 +159,29 @@ def test_project_map_to_streamlines():
     assert np.array_equal(dpp[1], [[2, 2]] * 4)
 
 
+def test_project_map_to_streamlines_subset():
+    # A subset of a tractogram shares the points of the whole tractogram.
+    fake_sft, map_data = _get_sft_with_dpp()
+    map_volume = DataVolume(map_data, voxres=[1, 1, 1],
+                            interpolation='nearest')
+
+    for ids in [[3, 7, 12], [12, 3, 7]]:
+        sub_sft = fake_sft[ids]
+        dpp = project_map_to_streamlines(sub_sft, map_volume)
+        sub_sft.data_per_point['test'] = dpp
+        assert len(dpp) == 3
+        for i, j in enumerate(ids):
+            assert np.allclose(dpp[i], fake_sft.data_per_point['my_dpp'][j])
+
+        dpp = project_map_to_streamlines(sub_sft, map_volume,
+                                         endpoints_only=True)
+        for i, j in enumerate(ids):
+            expected = np.full(len(dpp[i]), np.nan)
+            expected[[0, -1]] = \
+                fake_sft.data_per_point['my_dpp'][j][[0, -1], 0]
+            assert nan_array_equal(dpp[i].squeeze(), expected)
+
+
 def test_project_dpp_to_map():
     fake_sft = _get_small_sft()
     fake_sft.data_per_point['my_dpp'] = [[1]*3, [2]*4]
@@ -155,6 +209,27 @@ def test_project_dpp_to_map():
     assert np.array_equal(map_data, expected)
 
 
+def test_project_dpp_to_map_subset():
+    # A subset of a tractogram shares the points of the whole tractogram.
+    fake_sft, _ = _get_sft_with_dpp()
+
+    for ids in [[3, 7, 12], [12, 3, 7]]:
+        # Expected: same as a tractogram built from the subset only.
+        sub_sft = fake_sft[ids]
+        compact_sft = StatefulTractogram.from_sft(
+            [fake_sft.streamlines[j] for j in ids], fake_sft,
+            data_per_point={'my_dpp': [fake_sft.data_per_point['my_dpp'][j]
+                                       for j in ids]})
+
+        for endpoints_only in [False, True]:
+            map_data = project_dpp_to_map(sub_sft, 'my_dpp', sum_lines=True,
+                                          endpoints_only=endpoints_only)
+            expected = project_dpp_to_map(compact_sft, 'my_dpp',
+                                          sum_lines=True,
+                                          endpoints_only=endpoints_only)
+            assert np.allclose(map_data, expected)
+
+
 def test_perform_operation_on_dpp():
     fake_sft = _get_small_sft()
     fake_sft.data_per_point['my_dpp'] = [[[1, 0]]*3,
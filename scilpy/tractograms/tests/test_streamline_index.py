@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from scilpy.tractograms.streamline_index import StreamlineIndex
+
+
+def _get_streamlines():
+    rng = np.random.default_rng(1234)
+    streamlines = [rng.random((int(rng.integers(2, 6)), 3)) for _ in range(50)]
+
+    # Adding a slightly shifted copy of the first 10 streamlines
+    streamlines += [s + 0.0005 for s in streamlines[0:10]]
+    return streamlines
+
+
+def _brute_force(queries, streamlines, radius):
+    return [[i, j] for i, q in enumerate(queries)
+            for j, s in enumerate(streamlines)
+            if len(q) == len(s) and
+            np.all(np.linalg.norm(q - s, axis=1) < radius)]
+
+
+def test_query_pairs():
+    streamlines = _get_streamlines()
+    index = StreamlineIndex(streamlines, epsilon=0.001)
+
+    matches, distances = index.query_pairs(return_distances=True)
+    expected = [[i, j] for i, j in _brute_force(streamlines, streamlines,
+                                                0.002) if i < j]
+    assert np.array_equal(matches, expected)
+    assert np.array_equal(matches[:10], [[i, i + 50] for i in range(10)])
+    assert np.allclose(distances[:10], -0.0005)
+
+    # With a large epsilon, many more matches.
+    index = StreamlineIndex(streamlines, epsilon=0.5)
+    expected = [[i, j] for i, j in _brute_force(streamlines, streamlines,
+                                                1.0) if i < j]
+    assert np.array_equal(index.query_pairs(), expected)
+
+
+def test_query():
+    streamlines = _get_streamlines()
+    index = StreamlineIndex(streamlines[0:50], epsilon=0.001)
+
+    matches = index.query(streamlines[45:])
+    assert np.array_equal(matches,
+                          [[i, i + 45] for i in range(5)] +
+                          [[i + 5, i] for i in range(10)])
+
+    # Nothing to find
+    assert len(index.query([np.full((3, 3), 10.)])) == 0
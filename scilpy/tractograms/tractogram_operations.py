@@ -23,7 +23,6 @@ from nibabel.streamlines.array_sequence import ArraySequence
 import numpy as np
 from numpy.polynomial.polynomial import Polynomial
 from scipy.ndimage import map_coordinates
-from scipy.spatial import cKDTree
 
 from scilpy.tractanalysis.bundle_operations import uniformize_bundle_sft
 from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
@@ -33,6 +32,7 @@ from scilpy.tractograms.streamline_operations import smooth_line_gaussian, \
     remove_overlapping_points_streamlines, filter_streamlines_by_nb_points
 from scilpy.tractograms.streamline_and_mask_operations import \
     cut_streamlines_with_mask
+from scilpy.tractograms.streamline_index import StreamlineIndex
 from scilpy.utils.spatial import generate_rotation_matrix
 
 MIN_NB_POINTS = 10
@@ -399,115 +399,56 @@ def _find_identical_streamlines(streamlines_list, epsilon=0.001,
     Tuple, ArraySequence, np.ndarray
         Returns the concatenated streamlines and the indices to pick from it
     """
-    streamlines = ArraySequence(itertools.chain(*streamlines_list))
-    nb_streamlines = np.cumsum([len(sft) for sft in streamlines_list])
-    nb_streamlines = np.insert(nb_streamlines, 0, 0)
-
     if union_mode and difference_mode:
         raise ValueError('Cannot use union_mode and difference_mode at the '
                          'same time.')
-    intersect_mode = (not union_mode and not difference_mode)
-
-    all_tree = {}
-    all_tree_mapping = {}
-    first_points = np.array(streamlines.get_data()[streamlines._offsets])
-
-    # Uses the number of point to speed up the search in the ckdtree
-    for point_count in np.unique(streamlines._lengths):
-        same_length_ind = np.where(streamlines._lengths == point_count)[0]
-        all_tree[point_count] = cKDTree(first_points[same_length_ind])
-        all_tree_mapping[point_count] = same_length_ind
-
-    inversion_val = 1 if union_mode or difference_mode else 0
-    streamlines_to_keep = np.ones((len(streamlines),)) * inversion_val
-    average_match_distance = []
-
-    # Difference by design will never select streamlines that are not from the
-    # first set
-    if difference_mode:
-        streamlines_to_keep[nb_streamlines[1]:] = 0
-    for i, streamline in enumerate(streamlines):
-        # Unless we do a union, there is no point looking past the first set
-        if not union_mode and i >= nb_streamlines[1]:
-            break
-
-        # Find the closest (first) points
-        distance_ind = all_tree[len(streamline)].query_ball_point(
-            streamline[0], r=2*epsilon)
-        actual_ind = np.sort(all_tree_mapping[len(streamline)][distance_ind])
-
-        # Intersection requires finding matches in all sets
-        if intersect_mode:
-            intersect_test = np.zeros((len(nb_streamlines)-1,))
-
-            # The streamline's set itself is obviously already ok.
-            set_i = np.max(np.where(nb_streamlines <= i)[0])
-            intersect_test[set_i] = True
-
-        # Looking at similar streamlines only:
-        for j in actual_ind:
-            # 1) Yourself is never a match.
-            #    (For union : always kept)
-            #    (For difference: if another is found, we will remove i)
-            #    (For intersection: will be kept lower if others are found).
-            if i == j:
-                continue
 
-            # Actual check of the whole streamline
-            sub_vector = streamline-streamlines[j]
-            norm = np.linalg.norm(sub_vector, axis=1)
-            average_match_distance.append(np.average(sub_vector, axis=0))
-
-            if union_mode:
-                # 1) Yourself is not a match
-                # 2) If the streamline hasn't been selected (by another match)
-                # 3) The streamline is 'identical'
-                if streamlines_to_keep[i] == 1 and (norm < 2*epsilon).all():
-                    streamlines_to_keep[j] = 0
-
-            elif difference_mode:
-                # 1) Yourself is not a match
-                # 2) The streamline is 'identical'
-                if (norm < 2*epsilon).all():
-                    set_j = np.max(np.where(nb_streamlines <= j)[0])
-
-                    # If it is an identical streamline, but from the first set,
-                    # it needs to be removed, otherwise remove all instances
-                    if set_j == 0:
-                        # If it is the first 'encounter', keep it.
-                        # Else, remove it.
-                        if streamlines_to_keep[actual_ind].all():
-                            streamlines_to_keep[j] = 0
-                    else:
-                        streamlines_to_keep[actual_ind] = 0
-            else:  # intersect_mode
-                # 1) Yourself is not a match
-                # 2) An equivalent streamline has not been selected by another
-                #    match.
-                # 3) The streamline is 'identical'
-                if (not np.any(streamlines_to_keep[actual_ind])
-                        and (norm < 2*epsilon).all()):
-                    set_j = np.max(np.where(nb_streamlines <= j)[0])
-                    # If it is an identical streamline, but from the same set
-                    # it needs to be removed (keeping streamlines_to_keep at 0)
-
-                    # Else: will be added only if it is found in all sets
-                    if set_i != set_j:
-                        intersect_test[set_j] = True
-
-        # Verify that you actually found a match in each set
-        if intersect_mode and intersect_test.all():
-            # Keeping only the first one; i.
-            streamlines_to_keep[i] = 1
+    streamlines = ArraySequence(itertools.chain(*streamlines_list))
+    set_ids = np.repeat(np.arange(len(streamlines_list)),
+                        [len(s) for s in streamlines_list])
+
+    # All pairs (i, j) of identical streamlines, with i < j. Sets are
+    # concatenated in order, so set_ids[i] <= set_ids[j].
+    index = StreamlineIndex(streamlines, epsilon=epsilon)
+    matches, match_distances = index.query_pairs(return_distances=True)
+    set_i = set_ids[matches[:, 0]]
+    set_j = set_ids[matches[:, 1]]
+
+    if union_mode:
+        streamlines_to_keep = np.ones((len(streamlines),), dtype=bool)
+    else:
+        # Difference and intersection by design will never select
+        # streamlines that are not from the first set
+        streamlines_to_keep = set_ids == 0
+        from_first_set = np.logical_and(set_i == 0, set_j > 0)
+        if difference_mode:
+            # Remove all streamlines having a match in another set
+            streamlines_to_keep[matches[from_first_set, 0]] = False
+        else:
+            # Intersection requires finding matches in all sets
+            found_in_set = np.zeros((len(streamlines),
+                                     len(streamlines_list)), dtype=bool)
+            found_in_set[:, 0] = True
+            found_in_set[matches[from_first_set, 0],
+                         set_j[from_first_set]] = True
+            streamlines_to_keep &= np.all(found_in_set, axis=1)
+
+    # Duplicates (in the kept streamlines): keeping only the first one.
+    # Matches are sorted: when reaching the pairs (i, j), all pairs (k, i)
+    # have been processed and we know if i is kept.
+    matches = matches[np.all(streamlines_to_keep[matches], axis=1)]
+    for i, j in matches:
+        if streamlines_to_keep[i]:
+            streamlines_to_keep[j] = False
 
     # To facilitate debugging and discovering shifts in data
-    if average_match_distance:
+    if len(match_distances) > 0:
         logging.info('Average matches distance: {}mm'.format(
-            np.round(np.average(average_match_distance, axis=0), 5)))
+            np.round(np.average(match_distances, axis=0), 5)))
     else:
         logging.info('No matches found.')
 
-    return streamlines, np.where(streamlines_to_keep > 0)[0].astype(np.uint32)
+    return streamlines, np.where(streamlines_to_keep)[0].astype(np.uint32)
 
 
 def concatenate_sft(sft_list, erase_metadata=False, metadata_fake_init=False):
@@ -5,10 +5,18 @@ from libc.math cimport ceil, fabs, floor, sqrt
 from libc.math cimport fmin as cfmin
 
 import cython
+from cython.parallel cimport prange
+from libc.stdlib cimport free, malloc
 import nibabel as nib
 import numpy as np
 cimport numpy as cnp
 
+from scilpy.utils.parallel import get_nbr_processes
+
+# Number of blocks of streamlines per thread. More blocks than threads
+# balances the load when some streamlines are longer than others.
+NB_BLOCKS_PER_THREAD = 4
+
 cdef struct Pointers:
     # Incremented when we complete a streamline. Saved at the start of each
     # streamline because we need to start anew if we resize data_out
@@ -30,9 +38,28 @@ cdef struct Pointers:
     cnp.uint16_t *points_to_index_out
 
 
+def _get_blocks(streamlines, nbr_threads):
+    """
+    Make sure that the points of the streamlines are contiguous (the kernels
+    read them sequentially), and split the streamlines in contiguous blocks,
+    processed independently.
+    """
+    lengths = np.asarray(streamlines._lengths)
+    offsets = np.asarray(streamlines._offsets)
+    if not np.array_equal(offsets[1:], offsets[:-1] + lengths[:-1]):
+        streamlines = streamlines.copy()
+
+    nb_blocks = 1
+    if nbr_threads > 1:
+        nb_blocks = min(len(lengths), nbr_threads * NB_BLOCKS_PER_THREAD)
+    blocks = np.linspace(0, len(lengths), nb_blocks + 1).astype(np.intp)
+    return streamlines, blocks
+
+
 @cython.boundscheck(False)
 @cython.cdivision(True)
-def streamlines_to_voxel_coordinates(streamlines, return_mapping=False):
+def streamlines_to_voxel_coordinates(streamlines, return_mapping=False,
+                                     nbr_threads=1):
     """
     Get the indices of the voxels traversed by each streamline; then returns
     an ArraySequence of indices, i.e. [i, j, k] coordinates.
@@ -43,6 +70,9 @@ def streamlines_to_voxel_coordinates(streamlines, return_mapping=False):
         Should be in voxel space, aligned to corner.
     return_mapping: bool
         If true, also returns the points_to_idx.
+    nbr_threads: int
+        Number of threads. If None or <= 0, all CPUs are used. Streamlines
+        are processed by independent blocks.
 
     Returns
     -------
@@ -62,21 +92,27 @@ def streamlines_to_voxel_coordinates(streamlines, return_mapping=False):
     """
     cdef:
         cnp.npy_intp nb_streamlines = len(streamlines._lengths)
-        cnp.npy_intp at_point = 0
-
-        # Multiplying by 6 is simply a heuristic to avoiding resizing too many
-        # times. In my bundles tests, I had either 0 or 1 resize.
-        cnp.npy_intp max_points = (streamlines._data.size // 3)
+        cnp.npy_intp nb_points = np.sum(streamlines._lengths)
+        cnp.npy_intp nb_blocks, block_idx, start, end, nb_done
+        int nb_threads = get_nbr_processes(nbr_threads)
+        bint finished
 
     new_array_sequence = nib.streamlines.array_sequence.ArraySequence()
-    new_array_sequence._lengths.resize(nb_streamlines)
-    new_array_sequence._offsets.resize(nb_streamlines)
-    new_array_sequence._data = np.empty(max_points * 3, np.uint16)
-
     points_to_index = nib.streamlines.array_sequence.ArraySequence()
-    points_to_index._lengths.resize(nb_streamlines)
-    points_to_index._offsets.resize(nb_streamlines)
-    points_to_index._data = np.zeros(int(streamlines._data.size / 3), np.uint16)
+    if nb_streamlines == 0:
+        new_array_sequence._data = np.zeros((0, 3), np.uint16)
+        points_to_index._data = np.zeros(0, np.uint16)
+        if not return_mapping:
+            return new_array_sequence
+        return new_array_sequence, points_to_index
+
+    streamlines, blocks = _get_blocks(streamlines, nb_threads)
+    nb_blocks = len(blocks) - 1
+
+    new_array_sequence._lengths = np.zeros(nb_streamlines, np.intp)
+    new_array_sequence._offsets = np.zeros(nb_streamlines, np.intp)
+    points_to_index._lengths = np.zeros(nb_streamlines, np.intp)
+    points_to_index._offsets = np.zeros(nb_streamlines, np.intp)
 
     cdef:
         cnp.npy_intp[:] lengths_view_in = streamlines._lengths
@@ -84,43 +120,114 @@ def streamlines_to_voxel_coordinates(streamlines, return_mapping=False):
         float[:, :] data_view_in = streamlines._data
         cnp.npy_intp[:] lengths_view_out = new_array_sequence._lengths
         cnp.npy_intp[:] offsets_view_out = new_array_sequence._offsets
-        cnp.uint16_t[:] data_view_out = new_array_sequence._data
+        cnp.uint16_t[:] data_view_out
         cnp.npy_intp[:] pti_lengths_view_out = points_to_index._lengths
         cnp.npy_intp[:] pti_offsets_view_out = points_to_index._offsets
-        cnp.uint16_t[:] points_to_index_view_out = points_to_index._data
-
-    cdef Pointers pointers
-    pointers.lengths_in = &lengths_view_in[0]
-    pointers.lengths_in_end = pointers.lengths_in + nb_streamlines
-    pointers.offsets_in = &offsets_view_in[0]
-    pointers.data_in = &data_view_in[0, 0]
-    pointers.lengths_out = &lengths_view_out[0]
-    pointers.offsets_out = &offsets_view_out[0]
-    pointers.data_out = &data_view_out[0]
-    pointers.pti_lengths_out = &pti_lengths_view_out[0]
-    pointers.pti_offsets_out = &pti_offsets_view_out[0]
-    pointers.points_to_index_out = &points_to_index_view_out[0]
-
-    while 1:
-        at_point = _streamlines_to_voxel_coordinates(&pointers,
-                                                     at_point,
-                                                     max_points - 1)
-        if pointers.lengths_in == pointers.lengths_in_end:
-            # Job finished, we can return the streamlines
-            break
-
-        # Resize and point the memoryview and pointer on the right data
-        max_points += max_points / 3  # Make it one third bigger
-        new_array_sequence._data.resize(max_points * 3, refcheck=False)
-        data_view_out = new_array_sequence._data
-        pointers.data_out = &data_view_out[0] + at_point * 3
-
-        if at_point == 0:
-            pointers.points_to_index_out = &points_to_index_view_out[0]
-        else:
-            pointers.points_to_index_out = &points_to_index_view_out[0] + pointers.offsets_in[0]
-
-    new_array_sequence._data.resize((at_point, 3), refcheck=False)
+        cnp.uint16_t[:] points_to_index_view_out
+
+        Pointers *pointers = <Pointers *>malloc(nb_blocks * sizeof(Pointers))
+        cnp.npy_intp[:] at_point = np.zeros(nb_blocks, np.intp)
+        cnp.npy_intp[:] max_points = np.zeros(nb_blocks, np.intp)
+
+    # Each block has its own output data and points_to_index data. Lengths
+    # are written in place.
+    blocks_data = []
+    blocks_pti = []
+    try:
+        for block_idx in range(nb_blocks):
+            start, end = blocks[block_idx], blocks[block_idx + 1]
+
+            # The number of points is simply a heuristic to avoiding resizing
+            # too many times. In my bundles tests, I had either 0 or 1 resize.
+            max_points[block_idx] = max(
+                np.sum(streamlines._lengths[start:end]), 16)
+            blocks_data.append(np.empty(max_points[block_idx] * 3, np.uint16))
+            data_view_out = blocks_data[block_idx]
+
+            # At most one index per point, plus the last point.
+            blocks_pti.append(np.zeros(
+                np.sum(streamlines._lengths[start:end]) + end - start,
+                np.uint16))
+            points_to_index_view_out = blocks_pti[block_idx]
+
+            pointers[block_idx].lengths_in = &lengths_view_in[start]
+            pointers[block_idx].lengths_in_end = &lengths_view_in[0] + end
+            pointers[block_idx].offsets_in = &offsets_view_in[start]
+            pointers[block_idx].data_in = \
+                &data_view_in[offsets_view_in[start], 0]
+            pointers[block_idx].lengths_out = &lengths_view_out[start]
+            pointers[block_idx].offsets_out = &offsets_view_out[start]
+            pointers[block_idx].data_out = &data_view_out[0]
+            pointers[block_idx].pti_lengths_out = &pti_lengths_view_out[start]
+            pointers[block_idx].pti_offsets_out = &pti_offsets_view_out[start]
+            pointers[block_idx].points_to_index_out = \
+                &points_to_index_view_out[0]
+
+        while 1:
+            for block_idx in prange(nb_blocks, num_threads=nb_threads,
+                                    schedule='dynamic', nogil=True):
+                if pointers[block_idx].lengths_in != \
+                        pointers[block_idx].lengths_in_end:
+                    at_point[block_idx] = _streamlines_to_voxel_coordinates(
+                        &pointers[block_idx], at_point[block_idx],
+                        max_points[block_idx] - 1)
+
+            finished = True
+            for block_idx in range(nb_blocks):
+                if pointers[block_idx].lengths_in == \
+                        pointers[block_idx].lengths_in_end:
+                    # Job finished for this block
+                    continue
+                finished = False
+
+                # Resize and point the memoryview and pointer on the right
+                # data. Make it one third bigger.
+                max_points[block_idx] += max_points[block_idx] // 3
+                blocks_data[block_idx].resize(max_points[block_idx] * 3,
+                                              refcheck=False)
+                data_view_out = blocks_data[block_idx]
+                pointers[block_idx].data_out = \
+                    &data_view_out[0] + at_point[block_idx] * 3
+
+                # Start again after the last finished streamline
+                start = blocks[block_idx]
+                nb_done = pointers[block_idx].lengths_in - \
+                    &lengths_view_in[start]
+                points_to_index_view_out = blocks_pti[block_idx]
+                pointers[block_idx].points_to_index_out = \
+                    &points_to_index_view_out[0]
+                if nb_done > 0:
+                    pointers[block_idx].points_to_index_out += \
+                        pti_offsets_view_out[start + nb_done - 1] + \
+                        pti_lengths_view_out[start + nb_done - 1]
+
+            if finished:
+                # Job finished, we can return the streamlines
+                break
+    finally:
+        free(pointers)
+
+    # Offsets were computed inside each block.
+    new_array_sequence._offsets[:] = \
+        np.cumsum(new_array_sequence._lengths) - new_array_sequence._lengths
+    points_to_index._offsets[:] = \
+        np.cumsum(points_to_index._lengths) - points_to_index._lengths
+
+    if nb_blocks == 1:
+        new_array_sequence._data = blocks_data[0]
+        new_array_sequence._data.resize((at_point[0], 3), refcheck=False)
+    else:
+        new_array_sequence._data = np.concatenate(
+            [data[:at_point[i] * 3] for i, data in enumerate(blocks_data)]
+        ).reshape((-1, 3))
+
+    if return_mapping:
+        pti_data = np.concatenate(
+            [pti[:np.sum(points_to_index._lengths[blocks[i]:blocks[i + 1]])]
+             for i, pti in enumerate(blocks_pti)])
+        points_to_index._data = np.zeros(max(nb_points, len(pti_data)),
+                                         np.uint16)
+        points_to_index._data[:len(pti_data)] = pti_data
 
     if not return_mapping:
         return new_array_sequence
@@ -130,7 +237,7 @@ def streamlines_to_voxel_coordinates(streamlines, return_mapping=False):
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef inline double norm(double x, double y, double z) nogil:
+cdef inline double norm(double x, double y, double z) noexcept nogil:
     cdef double val = sqrt(x*x + y*y + z*z)
     return val
 
@@ -141,7 +248,7 @@ cdef inline double norm(double x, double y, double z) nogil:
 cdef inline void c_get_closest_edge(double *p,
                                     double *direction,
                                     double *edge,
-                                    double eps=1.0) nogil:
+                                    double eps=1.0) noexcept nogil:
     edge[0] = floor(p[0] + eps) if direction[0] >= 0.0 else ceil(p[0] - eps)
     edge[1] = floor(p[1] + eps) if direction[1] >= 0.0 else ceil(p[1] - eps)
     edge[2] = floor(p[2] + eps) if direction[2] >= 0.0 else ceil(p[2] - eps)
@@ -152,7 +259,7 @@ cdef inline void c_get_closest_edge(double *p,
 cdef cnp.npy_intp _streamlines_to_voxel_coordinates(
         Pointers* pointers,
         cnp.npy_intp at_point,
-        cnp.npy_intp max_points) nogil:
+        cnp.npy_intp max_points) noexcept nogil:
     cdef:
         float *backup_data_in
         cnp.npy_intp backup_at_point
@@ -329,9 +436,6 @@ cdef cnp.npy_intp _streamlines_to_voxel_coordinates(
         last_y = <cnp.uint16_t>next_pt[1]
         last_z = <cnp.uint16_t>next_pt[2]
         if x != last_x or y != last_y or z != last_z:
-            with gil:
-                print('Got inside last')
-
             pointers.data_out[0] = last_x
             pointers.data_out[1] = last_y
             pointers.data_out[2] = last_z
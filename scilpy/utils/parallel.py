@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Shared multiprocessing executor.
+
+Voxel-wise functions (fits, peaks, metrics) are applied in parallel on
+ravelled data of shape (N, ...) with parallel_map_on_rows. Compared to
+creating a new multiprocessing.Pool at each call:
+
+- The pool is created once and kept warm between calls (see get_pool), so
+  that multi-stage pipelines (ex: fODF fit -> peaks -> metrics) do not pay
+  the processes creation each time.
+- Inputs and outputs are placed in shared memory. Tasks only send the names
+  of the shared memory blocks and the range of rows to process, and results
+  are written in place, instead of pickling data chunks back and forth.
+- The voxels of a mask are gathered directly in shared memory, and the
+  outputs are handed to the caller as they are, without intermediate copies.
+  The caller releases them when leaving the with block of
+  parallel_map_on_rows.
+"""
+import atexit
+from collections import deque
+from contextlib import contextmanager
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Persistent pool, shared by all calls to parallel_map_on_rows.
+_POOL = None
+_POOL_SIZE = 0
+
+# Number of tasks per process. More tasks than processes balances the load
+# when some rows are slower to process than others.
+NB_TASKS_PER_PROCESS = 4
+
+
+def get_nbr_processes(nbr_processes):
+    """
+    Number of processes to use: multiprocessing.cpu_count() if nbr_processes
+    is None or <= 0.
+    """
+    if nbr_processes is None or nbr_processes <= 0:
+        return multiprocessing.cpu_count()
+    return nbr_processes
+
+
+def get_pool(nbr_processes):
+    """
+    Get the persistent pool of processes. It is created at the first call,
+    or re-created if a different number of processes is asked.
+
+    Parameters
+    ----------
+    nbr_processes: int
+        Number of processes in the pool.
+
+    Returns
+    -------
+    pool: multiprocessing.Pool
+    """
+    global _POOL, _POOL_SIZE
+    if _POOL is None or _POOL_SIZE != nbr_processes:
+        close_pool()
+        logging.debug("Starting a pool of {} processes.".format(nbr_processes))
+        _POOL = multiprocessing.Pool(nbr_processes)
+        _POOL_SIZE = nbr_processes
+    return _POOL
+
+
+@atexit.register
+def close_pool():
+    """
+    Close the persistent pool, if any. Called automatically at exit.
+    """
+    global _POOL, _POOL_SIZE
+    if _POOL is not None:
+        _POOL.terminate()
+        _POOL.join()
+        _POOL = None
+        _POOL_SIZE = 0
+
+
+def imap_bounded(pool, func, tasks, max_pending):
+    """
+    Ordered equivalent of pool.imap(func, tasks), with backpressure. The
+    tasks are only drawn from their (possibly lazy) iterable as results are
+    consumed: at most max_pending tasks are submitted to the pool and not yet
+    yielded. Contrary to pool.imap, which drains the tasks into the pool's
+    queue, this bounds the memory used by pending tasks and by the results
+    waiting behind a slow task.
+
+    Parameters
+    ----------
+    pool: multiprocessing.Pool
+        The pool of processes.
+    func: callable
+        Module-level function (it must be picklable), called as func(task).
+    tasks: iterable
+        The tasks. Can be a generator.
+    max_pending: int
+        Maximal number of tasks in flight.
+
+    Yields
+    ------
+    result:
+        func(task), for each task, in order.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+class SharedArray(object):
+    """
+    Numpy array in a shared memory block, which can be attached to from other
+    processes through its descriptor.
+    """
+    def __init__(self, shape, dtype, data=None):
+        """
+        Parameters
+        ----------
+        shape: tuple
+            Shape of the array.
+        dtype: np.dtype
+            Data type of the array.
+        data: np.ndarray, optional
+            Data to copy in the array. Else, the array is filled with zeros.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=max(nbytes, 1))
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                buffer=self.shm.buf)
+        if data is not None:
+            self.array[:] = data
+        else:
+            self.array.fill(0)
+
+    @property
+    def descriptor(self):
+        """ (name, shape, dtype): what other processes need to attach. """
+        return self.shm.name, self.shape, self.dtype
+
+    @staticmethod
+    def attach(descriptor):
+        """
+        Attach to a shared array from its descriptor.
+
+        Returns
+        -------
+        shm: multiprocessing.shared_memory.SharedMemory
+            The shared memory block. Must be closed once the array is not
+            used anymore (all references to the array must be deleted first).
+        array: np.ndarray
+            The shared array.
+        """
+        name, shape, dtype = descriptor
+        shm = shared_memory.SharedMemory(name=name)
+        return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def from_rows(cls, data, mask=None):
+        """
+        Shared array of the rows of data. If a mask is given, the rows are the
+        elements of data in the mask (data[mask]), gathered directly in the
+        shared memory block without a temporary copy.
+
+        Parameters
+        ----------
+        data: np.ndarray
+            The data.
+        mask: np.ndarray, optional
+            Boolean mask, of shape data.shape[:mask.ndim].
+
+        Returns
+        -------
+        shared: SharedArray
+        """
+        if mask is None:
+            return cls(data.shape, data.dtype, data)
+
+        row_shape = data.shape[mask.ndim:]
+        shared = cls((np.count_nonzero(mask),) + row_shape, data.dtype)
+        np.compress(mask.ravel(), data.reshape((-1,) + row_shape), axis=0,
+                    out=shared.array)
+        return shared
+
+    def release(self):
+        """
+        Free the shared memory block. The array becomes invalid: no other
+        reference to it (or to a view of it) must remain.
+        """
+        self.array = None
+        self.shm.unlink()
+        self.shm.close()
+
+
+class _LocalArray(object):
+    """
+    Same interface as SharedArray, for arrays computed in the calling process.
+    """
+    def __init__(self, array):
+        self.array = array
+
+    def release(self):
+        self.array = None
+
+
+def _process_rows(args):
+    """
+    Task sent to the pool: applies func on rows [start, end[ of the shared
+    inputs and writes its results in the shared outputs.
+    """
+    func, input_descriptors, output_descriptors, start, end, func_args = args
+
+    blocks = []
+    inputs = []
+    array = results = None
+    try:
+        for descriptor in input_descriptors:
+            shm, array = SharedArray.attach(descriptor)
+            blocks.append(shm)
+            inputs.append(array[start:end])
+
+        results = func(*inputs, *func_args)
+
+        for descriptor, result in zip(output_descriptors, results):
+            shm, array = SharedArray.attach(descriptor)
+            blocks.append(shm)
+            if np.shape(result) != array[start:end].shape:
+                raise ValueError(
+                    "Expected an output of shape {}, got {}.".format(
+                        array[start:end].shape, np.shape(result)))
+            array[start:end] = result
+
+        # Anything else (ex, reductions) is sent back as is.
+        return tuple(results[len(output_descriptors):])
+    finally:
+        # The views on the blocks must be deleted before closing them.
+        del inputs, array, results
+        for shm in blocks:
+            shm.close()
+
+
+@contextmanager
+def parallel_map_on_rows(func, inputs, outputs, nbr_processes=None,
+                         func_args=(), mask=None):
+    """
+    Apply func on the rows of the inputs, in parallel, using the persistent
+    pool and shared memory. To be used as a context manager:
+
+        with parallel_map_on_rows(func, [data], [(shape, dtype)],
+                                  mask=mask) as ((out,), extras):
+            volume[mask] = out.array
+
+    The outputs are the shared memory blocks in which the processes wrote
+    their results: they are not copied back. They are released when exiting
+    the with block, so their content must be used or copied before, and no
+    reference to their arrays must be kept.
+
+    Parameters
+    ----------
+    func: callable
+        Module-level function (it must be picklable), called as
+        func(*input_chunks, *func_args), where input chunks are consecutive
+        rows of the inputs. It must return a tuple, starting with one array
+        per output (with the same number of rows as the chunks). Any other
+        returned value (ex, partial reductions) is collected per chunk.
+    inputs: list of np.ndarray
+        Input arrays, all with the same number of rows N. If mask is given,
+        the rows are the elements of each input in the mask.
+    outputs: list of tuple (shape, dtype)
+        Shape (excluding the first dimension, N) and dtype of each output.
+    nbr_processes: int, optional
+        Number of processes. Default: multiprocessing.cpu_count(). With 1
+        process, func is simply called on the whole inputs.
+    func_args: tuple, optional
+        Additional arguments to func. They are pickled with each task, so
+        they should be small (ex, parameters, B matrix, sphere).
+    mask: np.ndarray, optional
+        Boolean mask, of shape input.shape[:mask.ndim] for all inputs. The
+        voxels in the mask are gathered directly in shared memory.
+
+    Yields
+    ------
+    results: list of SharedArray
+        The outputs. Their array, of shape (N,) + shape, is valid until the
+        end of the with block.
+    extras: list of tuple
+        For each chunk, in order, the other values returned by func.
+    """
+    nbr_processes = get_nbr_processes(nbr_processes)
+    nb_rows = len(inputs[0]) if mask is None else np.count_nonzero(mask)
+
+    # Separating the case nbr_processes=1 to help get good coverage metrics
+    # (codecov does not deal well with multiprocessing)
+    if nbr_processes == 1 or nb_rows == 0:
+        if mask is not None:
+            inputs = [data[mask] for data in inputs]
+        results = func(*inputs, *func_args)
+        del inputs
+
+        arrays = []
+        for result, (shape, dtype) in zip(results, outputs):
+            result = np.asarray(result, dtype=dtype)
+            if result.shape != (nb_rows,) + tuple(shape):
+                raise ValueError(
+                    "Expected an output of shape {}, got {}.".format(
+                        (nb_rows,) + tuple(shape), result.shape))
+            arrays.append(_LocalArray(result))
+        extras = [tuple(results[len(outputs):])]
+        del results
+
+        try:
+            yield arrays, extras
+        finally:
+            for a in arrays:
+                a.release()
+        return
+
+    shared_outputs = []
+    try:
+        shared_inputs = []
+        try:
+            for data in inputs:
+                shared_inputs.append(SharedArray.from_rows(data, mask))
+            for shape, dtype in outputs:
+                shared_outputs.append(
+                    SharedArray((nb_rows,) + tuple(shape), dtype))
+
+            nb_tasks = min(nb_rows, nbr_processes * NB_TASKS_PER_PROCESS)
+            bounds = np.linspace(0, nb_rows, nb_tasks + 1).astype(int)
+            tasks = [(func,
+                      [s.descriptor for s in shared_inputs],
+                      [s.descriptor for s in shared_outputs],
+                      bounds[i], bounds[i + 1], func_args)
+                     for i in range(nb_tasks)]
+
+            extras = get_pool(nbr_processes).map(_process_rows, tasks)
+        finally:
+            # The inputs are not needed anymore.
+            for s in shared_inputs:
+                s.release()
+
+        yield shared_outputs, extras
+    finally:
+        for s in shared_outputs:
+            s.release()
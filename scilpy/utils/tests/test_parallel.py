@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from scilpy.utils.parallel import (close_pool, get_pool, imap_bounded,
+                                   parallel_map_on_rows)
+
+
+def _scale_and_sum(a, b, factor):
+    return a * factor, a[:, 0] + b, np.max(a[:, 0])
+
+
+def test_parallel_map_on_rows():
+    rng = np.random.default_rng(0)
+    a = rng.random((100, 3))
+    b = rng.random(100)
+
+    for nbr_processes in [1, 2]:
+        with parallel_map_on_rows(
+                _scale_and_sum, [a, b], [((3,), np.float32), ((), float)],
+                nbr_processes=nbr_processes,
+                func_args=(2.,)) as ((scaled, summed), extras):
+            assert scaled.array.dtype == np.float32
+            assert np.allclose(scaled.array, 2 * a)
+            assert np.allclose(summed.array, a[:, 0] + b)
+            assert max(e[0] for e in extras) == np.max(a[:, 0])
+
+        # The outputs are released at the end of the with block.
+        assert scaled.array is None
+
+
+def test_parallel_map_on_rows_mask():
+    rng = np.random.default_rng(0)
+    a = rng.random((4, 5, 6, 3))
+    b = rng.random((4, 5, 6))
+    mask = rng.random((4, 5, 6)) > 0.5
+
+    for nbr_processes in [1, 2]:
+        with parallel_map_on_rows(
+                _scale_and_sum, [a, b], [((3,), float), ((), float)],
+                nbr_processes=nbr_processes, func_args=(2.,),
+                mask=mask) as ((scaled, summed), _):
+            assert np.allclose(scaled.array, 2 * a[mask])
+            assert np.allclose(summed.array, a[mask][:, 0] + b[mask])
+
+
+def _wrong_shape(a):
+    return (a[:1],)
+
+
+def test_parallel_map_on_rows_wrong_shape():
+    a = np.ones((10, 3))
+    for nbr_processes in [1, 2]:
+        with pytest.raises(ValueError):
+            with parallel_map_on_rows(_wrong_shape, [a], [((3,), float)],
+                                      nbr_processes=nbr_processes):
+                pass
+
+
+def _square(x):
+    return x ** 2
+
+
+def test_imap_bounded():
+    drawn = []
+
+    def _tasks():
+        for i in range(50):
+            drawn.append(i)
+            yield i
+
+    results = []
+    for result in imap_bounded(get_pool(2), _square, _tasks(), 3):
+        # Tasks are drawn lazily: at most 3 in flight, including this one.
+        assert len(drawn) - len(results) <= 3
+        results.append(result)
+    assert results == [i ** 2 for i in range(50)]
+
+
+def test_get_pool():
+    # The pool is kept between calls.
+    pool = get_pool(2)
+    assert get_pool(2) is pool
+    close_pool()
@@ -27,6 +27,15 @@ statistical tests, useful when using --fdr or --bonferroni.
 of observations (subjects). They must be listed in the right order using --g1
 and --g2.
 
+--permutations will correct the p-values for the family-wise error (FWE) by
+permutation testing, instead of --fdr or --bonferroni. Subjects are shuffled
+between groups (or, with --paired, the signs of the differences are flipped).
+By default, the maximal t statistic over all edges is used. With
+--nbs_threshold, the network-based statistic (NBS) [2] is used instead:
+connected components of edges with a t statistic above the threshold are
+found, and all edges of a component get the p-value of the component's size.
+Only the upper triangle of the matrices is tested.
+
 Formerly: scil_compare_connectivity.py
 ----------------------------------------------------------------------------
 References:
@@ -45,12 +54,15 @@ import logging
 import numpy as np
 
 from scilpy.io.utils import (add_overwrite_arg,
+                             add_processes_arg,
                              add_verbose_arg,
                              assert_inputs_exist,
                              assert_outputs_exist,
                              load_matrix_in_any_format,
-                             save_matrix_in_any_format)
-from scilpy.stats.matrix_stats import ttest_two_matrices
+                             save_matrix_in_any_format,
+                             validate_nbr_processes)
+from scilpy.stats.matrix_stats import (permutation_test_two_matrices,
+                                       ttest_two_matrices)
 from scilpy.version import version_string
 
 
@@ -87,6 +99,19 @@ def _build_arg_parser():
                      help='Perform a Bonferroni correction for the p-values.\n'
                           'Uses the number of non-zero edges as number of '
                           'tests.')
+    fwe.add_argument('--permutations', type=int, metavar='NB',
+                     help='Perform a permutation test with NB permutations, '
+                          'for a FWE correction\nof the p-values (max '
+                          'statistic, or NBS with --nbs_threshold).')
+
+    perm = p.add_argument_group('Permutation testing options')
+    perm.add_argument('--nbs_threshold', type=float, metavar='T',
+                      help='Use the network-based statistic, with edges '
+                           'having a t statistic > T.\n'
+                           'Requires --permutations.')
+    perm.add_argument('--seed', type=int, default=None,
+                      help='Seed of the permutations. Results do not depend '
+                           'on --processes.')
 
     p.add_argument('--p_threshold', nargs=2, metavar=('THRESH', 'OUT_FILE'),
                    help='Threshold the final p-value matrix and save the '
@@ -95,6 +120,7 @@ def _build_arg_parser():
                    help='Binary filtering mask (.npy) to apply before '
                         'computing the measures.')
 
+    add_processes_arg(p)
     add_verbose_arg(p)
     add_overwrite_arg(p)
 
@@ -108,6 +134,12 @@ def main():
 
     assert_inputs_exist(parser, args.in_g1+args.in_g2, args.filtering_mask)
     assert_outputs_exist(parser, args, args.out_pval_matrix)
+    nbr_cpu = validate_nbr_processes(parser, args)
+
+    if args.nbs_threshold is not None and not args.permutations:
+        parser.error('--nbs_threshold requires --permutations.')
+    if args.permutations is not None and args.permutations < 1:
+        parser.error('--permutations must be at least 1.')
 
     if args.filtering_mask:
         filtering_mask = load_matrix_in_any_format(args.filtering_mask)
@@ -129,8 +161,16 @@ def main():
         parser.error('For paired statistic both groups must have the same '
                      'number of observations.')
 
-    matrix_pval = ttest_two_matrices(matrices_g1, matrices_g2, args.paired,
-                                     args.tail, args.fdr, args.bonferroni)
+    if args.permutations:
+        matrix_pval = permutation_test_two_matrices(
+            matrices_g1, matrices_g2, args.paired, args.tail,
+            nb_permutations=args.permutations,
+            nbs_threshold=args.nbs_threshold, seed=args.seed,
+            nbr_processes=nbr_cpu)
+    else:
+        matrix_pval = ttest_two_matrices(matrices_g1, matrices_g2,
+                                         args.paired, args.tail, args.fdr,
+                                         args.bonferroni)
 
     save_matrix_in_any_format(args.out_pval_matrix, matrix_pval)
 
@@ -15,6 +15,12 @@ the --append_json option as well as using the same output filename.
 Some measures output one value per node, the default behavior is to list
 them all. To obtain only the average use the --avg_node_wise option.
 
+With --small_world, random and lattice null models of the length-weighted
+matrix are generated, which is slow on large matrices. They are generated in
+parallel with --processes. With --small_world_cache_dir, the measures of the
+null models are cached, keyed by the hash of the matrix: runs on the same
+matrix (ex, re-running a group analysis) will read them from the cache.
+
 The computed connectivity measures are:
 centrality, modularity, assortativity, participation, clustering,
 nodal_strength, local_efficiency, global_efficiency, density, rich_club,
@@ -44,10 +50,12 @@ import os
 from scilpy.connectivity.matrix_tools import evaluate_graph_measures
 from scilpy.io.utils import (add_json_args,
                              add_overwrite_arg,
+                             add_processes_arg,
                              add_verbose_arg,
                              assert_inputs_exist,
                              assert_outputs_exist,
-                             load_matrix_in_any_format)
+                             load_matrix_in_any_format,
+                             validate_nbr_processes)
 from scilpy.version import version_string
 
 
@@ -75,8 +83,13 @@ def _build_arg_parser():
     p.add_argument('--small_world', action='store_true',
                    help='Compute measure related to small worldness (omega '
                         'and sigma).\n This option is much slower.')
+    p.add_argument('--small_world_cache_dir',
+                   help='Directory where to cache the measures of the small '
+                        'world null models.\nUseful when computing the '
+                        'measures of the same matrices again.')
 
     add_json_args(p)
+    add_processes_arg(p)
     add_verbose_arg(p)
     add_overwrite_arg(p)
 
@@ -98,6 +111,10 @@ def main():
                      'before re-launching a group analysis.'.format(
                             args.out_json))
 
+    nbr_cpu = validate_nbr_processes(parser, args)
+    if args.small_world_cache_dir is not None:
+        os.makedirs(args.small_world_cache_dir, exist_ok=True)
+
     if args.append_json and args.overwrite:
         parser.error('Cannot use the append option at the same time as '
                      'overwrite.\nAmbiguous behavior, consider deleting the '
@@ -112,8 +129,10 @@ def main():
         conn_matrix *= mask_matrix
         len_matrix *= mask_matrix
 
-    gtm_dict = evaluate_graph_measures(conn_matrix, len_matrix,
-                                       args.avg_node_wise, args.small_world)
+    gtm_dict = evaluate_graph_measures(
+        conn_matrix, len_matrix, args.avg_node_wise, args.small_world,
+        nbr_processes=nbr_cpu,
+        small_world_cache_dir=args.small_world_cache_dir)
 
     if os.path.isfile(args.out_json) and args.append_json:
         with open(args.out_json) as json_data:
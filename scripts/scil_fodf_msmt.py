@@ -38,7 +38,7 @@ from scilpy.io.utils import (add_overwrite_arg, add_processes_arg,
                              add_sh_basis_args, add_skip_b0_check_arg,
                              add_verbose_arg, add_tolerance_arg,
                              parse_sh_basis_arg, assert_headers_compatible)
-from scilpy.reconst.fodf import (fit_from_model,
+from scilpy.reconst.fodf import (fit_coeffs_from_model,
                                  verify_failed_voxels_shm_coeff,
                                  verify_frf_files)
 from scilpy.reconst.sh import convert_sh_basis, verify_data_vs_sh_order
@@ -179,19 +179,13 @@ def main():
                                        reg_sphere=reg_sphere,
                                        sh_order_max=args.sh_order)
 
-    # Computing msmt-CSD fit
-    msmt_fit = fit_from_model(msmt_model, data,
-                              mask=mask, nbr_processes=args.nbr_processes)
-
-    # mmsmt_fit is a MultiVoxelFit.
-    #   - memsmt_fit.array_fit is a 3D np.ndarray, where value in each voxel is
-    #     a dipy.reconst.mcsd.MSDeconvFit object.
-    #   - When accessing memsmt_fit.all_shm_coeff, we get an array of shape
-    #     (x, y, z, n), where n is the number of fitted values.
-    shm_coeff = msmt_fit.all_shm_coeff
+    # Computing msmt-CSD fit. Only the coefficients of all tissues (as
+    # MSDeconvFit.all_shm_coeff, of shape (x, y, z, n)) and the volume
+    # fractions are kept.
+    shm_coeff, vf = fit_coeffs_from_model(
+        msmt_model, data, attributes=['all_shm_coeff', 'volume_fractions'],
+        mask=mask, nbr_processes=args.nbr_processes)
     shm_coeff = verify_failed_voxels_shm_coeff(shm_coeff)
-
-    vf = msmt_fit.volume_fractions
     vf = np.where(np.isnan(vf), 0, vf)
 
     # Saving results
@@ -202,7 +196,8 @@ def main():
                                     output_basis=sh_basis,
                                     is_input_legacy=True,
                                     is_output_legacy=is_legacy,
-                                    nbr_processes=args.nbr_processes)
+                                    nbr_processes=args.nbr_processes,
+                                    dtype=np.float32)
         nib.save(nib.Nifti1Image(wm_coeff.astype(np.float32),
                                  vol.affine), args.wm_out_fODF)
 
@@ -214,7 +209,8 @@ def main():
                                     output_basis=sh_basis,
                                     is_input_legacy=True,
                                     is_output_legacy=is_legacy,
-                                    nbr_processes=args.nbr_processes)
+                                    nbr_processes=args.nbr_processes,
+                                    dtype=np.float32)
         nib.save(nib.Nifti1Image(gm_coeff.astype(np.float32),
                                  vol.affine), args.gm_out_fODF)
 
@@ -226,7 +222,8 @@ def main():
                                      output_basis=sh_basis,
                                      is_input_legacy=True,
                                      is_output_legacy=is_legacy,
-                                     nbr_processes=args.nbr_processes)
+                                     nbr_processes=args.nbr_processes,
+                                     dtype=np.float32)
         nib.save(nib.Nifti1Image(csf_coeff.astype(np.float32),
                                  vol.affine), args.csf_out_fODF)
 
@@ -28,7 +28,7 @@ from scilpy.io.utils import (add_b0_thresh_arg, add_overwrite_arg,
                              add_skip_b0_check_arg, add_verbose_arg,
                              assert_inputs_exist, assert_outputs_exist,
                              parse_sh_basis_arg, assert_headers_compatible)
-from scilpy.reconst.fodf import fit_from_model
+from scilpy.reconst.fodf import fit_coeffs_from_model
 from scilpy.reconst.sh import convert_sh_basis
 from scilpy.version import version_string
 
@@ -124,18 +124,19 @@ def main():
                                                 reg_sphere=reg_sphere,
                                                 sh_order_max=sh_order)
 
-    # Computing CSD fit
-    csd_fit = fit_from_model(csd_model, data,
-                             mask=mask, nbr_processes=args.nbr_processes)
+    # Computing CSD fit. Only the SH coefficients are kept.
+    shm_coeff, = fit_coeffs_from_model(csd_model, data,
+                                       attributes=['shm_coeff'], mask=mask,
+                                       nbr_processes=args.nbr_processes)
 
     # Saving results
-    shm_coeff = csd_fit.shm_coeff
     shm_coeff = convert_sh_basis(shm_coeff, reg_sphere, mask=mask,
                                  input_basis='descoteaux07',
                                  output_basis=sh_basis,
                                  is_input_legacy=True,
                                  is_output_legacy=is_legacy,
-                                 nbr_processes=args.nbr_processes)
+                                 nbr_processes=args.nbr_processes,
+                                 dtype=np.float32)
     nib.save(nib.Nifti1Image(shm_coeff.astype(np.float32),
                              affine=vol.affine,
                              header=vol.header), args.out_fODF)
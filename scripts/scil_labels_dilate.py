@@ -61,6 +61,17 @@ def _build_arg_parser():
                    help='Label list not to dilate.')
     p.add_argument('--mask',
                    help='Only dilate values inside the mask.')
+    p.add_argument('--method', choices=['kdtree', 'edt'], default='kdtree',
+                   help='Method used to find the nearest label of each '
+                        'voxel [%(default)s].\n'
+                        '    kdtree: KDTree over all labelled voxels.\n'
+                        '    edt: Euclidean distance transform. Much faster '
+                        'and lighter\n'
+                        '    in memory on large volumes. Voxels at equal '
+                        'distance from\n'
+                        '    two labels may get a different label than with '
+                        'kdtree.\n'
+                        '    --processes is not used.')
 
     add_processes_arg(p)
     add_verbose_arg(p)
@@ -92,7 +103,7 @@ def main():
                          labels_to_dilate=args.labels_to_dilate,
                          labels_not_to_dilate=args.labels_not_to_dilate,
                          labels_to_fill=args.labels_to_fill,
-                         mask=mask_data)
+                         mask=mask_data, method=args.method)
 
     # Save image
     nib.save(nib.Nifti1Image(data.astype(np.uint16), volume_nib.affine,
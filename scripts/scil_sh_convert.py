@@ -64,7 +64,8 @@ def main():
                                 output_basis=out_sh_basis,
                                 is_input_legacy=is_in_legacy,
                                 is_output_legacy=is_out_legacy,
-                                nbr_processes=args.nbr_processes)
+                                nbr_processes=args.nbr_processes,
+                                dtype=data.dtype)
 
     nib.save(nib.Nifti1Image(new_data, img.affine, header=img.header),
              args.out_sh)
@@ -10,6 +10,10 @@ If converting from SH to a DWI-like SF volume, --in_bval and --in_b0 need
 to be provided to concatenate the b0 image to the SF, and to generate the new
 bvals file. Otherwise, no .bval file will be created.
 
+With --out_of_core, the SH are read and the SF are written slab by slab
+(see --block_size), without loading the volumes in memory. Useful for large
+spheres on high resolution volumes.
+
 Formerly: scil_compute_sf_from_sh.py
 """
 
@@ -28,7 +32,7 @@ from scilpy.io.utils import (add_overwrite_arg, add_processes_arg,
                              add_sh_basis_args, add_verbose_arg,
                              assert_inputs_exist, assert_outputs_exist,
                              parse_sh_basis_arg, validate_nbr_processes)
-from scilpy.reconst.sh import convert_sh_to_sf
+from scilpy.reconst.sh import convert_sh_to_sf, convert_sh_to_sf_out_of_core
 from scilpy.version import version_string
 
 
@@ -57,6 +61,14 @@ def _build_arg_parser():
                    choices=["float32", "float64"],
                    help="Datatype to use for SF computation and output array."
                         "'[%(default)s]'")
+    p.add_argument('--out_of_core', action='store_true',
+                   help="If set, process the volume slab by slab, writing "
+                        "the SF directly \nto disk. Memory usage is bounded "
+                        "by --block_size.")
+    p.add_argument('--block_size', type=int, default=2 ** 16,
+                   help="With --out_of_core: maximal number of voxels "
+                        "processed at once. \nSlabs contain at least one "
+                        "slice. [%(default)s]")
 
     # Optional args for a DWI-like volume
     p.add_argument('--in_bval',
@@ -132,6 +144,9 @@ def main():
     if args.b0_scaling and not args.in_b0:
         parser.error("--in_b0 is required when using --b0_scaling.")
 
+    if args.block_size < 1:
+        parser.error("--block_size must be at least 1.")
+
     nbr_processes = validate_nbr_processes(parser, args)
     sh_basis, is_legacy = parse_sh_basis_arg(args)
 
@@ -147,9 +162,7 @@ def main():
     elif args.in_bval:
         bvals, _ = read_bvals_bvecs(args.in_bval, None)
 
-    # Load SH
     vol_sh = nib.load(args.in_sh)
-    data_sh = vol_sh.get_fdata(dtype=np.float32)
 
     # Sample SF from SH
     if args.sphere:
@@ -161,12 +174,6 @@ def main():
         bvecs = bvecs[np.logical_not(gtab.b0s_mask)]
         sphere = Sphere(xyz=bvecs)
 
-    sf = convert_sh_to_sf(data_sh, sphere,
-                          input_basis=sh_basis,
-                          input_full_basis=args.full_basis,
-                          is_input_legacy=is_legacy,
-                          dtype=args.dtype,
-                          nbr_processes=nbr_processes)
     new_bvecs = sphere.vertices.astype(np.float32)
 
     # Assign bval to SF if --in_bval was provided
@@ -178,30 +185,53 @@ def main():
 
         new_bvals = ([avg_bval] * len(sphere.theta))
 
-    # Add b0 images to SF (and bvals if necessary) if --in_b0 was provided
+    # Add b0 images to bvals and bvecs if --in_b0 was provided
+    vol_b0 = None
     if args.in_b0:
-        # Load b0
         vol_b0 = nib.load(args.in_b0)
-        data_b0 = vol_b0.get_fdata(dtype=args.dtype)
-        if data_b0.ndim == 3:
-            data_b0 = data_b0[..., np.newaxis]
+        nb_b0 = 1 if len(vol_b0.shape) == 3 else vol_b0.shape[3]
 
         if args.in_bval:
-            new_bvals = ([0] * data_b0.shape[-1]) + new_bvals
+            new_bvals = ([0] * nb_b0) + new_bvals
 
         # Append zeros to bvecs
-        new_bvecs = np.concatenate(
-            (np.zeros((data_b0.shape[-1], 3)), new_bvecs), axis=0)
-
-        # Scale SF by b0
-        if args.b0_scaling:
-            # Clip SF signal between 0. and 1., then scale using mean b0
-            sf = np.clip(sf, 0., 1.)
-            scale_b0 = np.mean(data_b0, axis=-1, keepdims=True)
-            sf = sf * scale_b0
-
-        # Append b0 images to SF
-        sf = np.concatenate((data_b0, sf), axis=-1)
+        new_bvecs = np.concatenate((np.zeros((nb_b0, 3)), new_bvecs), axis=0)
+
+    # Sample SF from SH and save
+    if args.out_of_core:
+        convert_sh_to_sf_out_of_core(vol_sh, args.out_sf, sphere,
+                                     dtype=args.dtype,
+                                     input_basis=sh_basis,
+                                     input_full_basis=args.full_basis,
+                                     is_input_legacy=is_legacy,
+                                     b0_img=vol_b0,
+                                     b0_scaling=args.b0_scaling,
+                                     block_size=args.block_size)
+    else:
+        data_sh = vol_sh.get_fdata(dtype=np.float32)
+        sf = convert_sh_to_sf(data_sh, sphere,
+                              input_basis=sh_basis,
+                              input_full_basis=args.full_basis,
+                              is_input_legacy=is_legacy,
+                              dtype=args.dtype,
+                              nbr_processes=nbr_processes)
+
+        if args.in_b0:
+            data_b0 = vol_b0.get_fdata(dtype=args.dtype)
+            if data_b0.ndim == 3:
+                data_b0 = data_b0[..., np.newaxis]
+
+            # Scale SF by b0
+            if args.b0_scaling:
+                # Clip SF signal between 0. and 1., then scale using mean b0
+                sf = np.clip(sf, 0., 1.)
+                scale_b0 = np.mean(data_b0, axis=-1, keepdims=True)
+                sf = sf * scale_b0
+
+            # Append b0 images to SF
+            sf = np.concatenate((data_b0, sf), axis=-1)
+
+        nib.save(nib.Nifti1Image(sf, vol_sh.affine), args.out_sf)
 
     # Save new bvals
     if args.out_bval:
@@ -211,9 +241,6 @@ def main():
     if args.out_bvec:
         np.savetxt(args.out_bvec, new_bvecs.T, fmt='%.8f')
 
-    # Save SF
-    nib.save(nib.Nifti1Image(sf, vol_sh.affine), args.out_sf)
-
 
 if __name__ == "__main__":
     main()
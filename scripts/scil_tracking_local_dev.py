@@ -26,6 +26,8 @@ Contrary to scil_tracking_local:
     - The interpolation for the tracking mask and spherical function can be
       one of 'nearest' or 'trilinear'.
     - Runge-Kutta integration is supported for the step function.
+    - With --batch_propagation, streamlines are propagated together with
+      vectorized operations, which greatly reduces the python overhead.
 
 A few notes on Runge-Kutta integration.
     1. Runge-Kutta integration is used to approximate the next tracking
@@ -54,9 +56,8 @@ import dipy.core.geometry as gm
 import nibabel as nib
 import numpy as np
 
-from dipy.io.stateful_tractogram import StatefulTractogram, Space
+from dipy.io.stateful_tractogram import Space
 from dipy.io.stateful_tractogram import Origin
-from dipy.io.streamline import save_tractogram
 from nibabel.streamlines import detect_format, TrkFile
 
 from scilpy.io.image import assert_same_resolution
@@ -72,7 +73,7 @@ from scilpy.tracking.tracker import Tracker
 from scilpy.tracking.utils import (add_mandatory_options_tracking,
                                    add_out_options, add_seeding_options,
                                    add_tracking_options,
-                                   get_theta,
+                                   get_theta, save_tractogram,
                                    verify_streamline_length_options,
                                    verify_seed_options)
 from scilpy.version import version_string
@@ -121,6 +122,13 @@ def _build_arg_parser():
                          choices=['nearest', 'trilinear'],
                          help="Spherical harmonic interpolation: "
                               "nearest-neighbor \nor trilinear. [%(default)s]")
+    track_g.add_argument('--precompute_maxima', action='store_true',
+                         help="With --algo det: extract the maxima of the "
+                              "SF of every voxel \nonce, before tracking, "
+                              "instead of at each step. With \n"
+                              "--sh_interp nearest, the result is the same. "
+                              "With trilinear \ninterpolation, the maxima of "
+                              "the 8 neighbouring voxels are \nblended.")
     track_g.add_argument('--mask_interp', default='nearest',
                          choices=['nearest', 'trilinear'],
                          help="Mask interpolation: nearest-neighbor or "
@@ -152,6 +160,17 @@ def _build_arg_parser():
 
     m_g = p.add_argument_group('Memory options')
     add_processes_arg(m_g)
+    m_g.add_argument('--use_mmap', action='store_true',
+                     help="With multiprocessing, each process reloads the "
+                          "ODF data from a \nmemory-mapped temporary file "
+                          "instead of attaching to a single \ncopy in "
+                          "shared memory. Useful on memory-constrained "
+                          "nodes.")
+    m_g.add_argument('--batch_propagation', action='store_true',
+                     help="If set, the streamlines of each chunk of seeds "
+                          "are propagated \ntogether with vectorized "
+                          "operations instead of one by one. \nMuch faster, "
+                          "for the same results.")
 
     add_out_options(p)
     add_verbose_arg(p)
@@ -184,6 +203,10 @@ def main():
                         "Ignoring.")
         args.save_seeds = False
 
+    if args.precompute_maxima and args.algo != 'det':
+        parser.error("Option --precompute_maxima can only be used with "
+                     "--algo det.")
+
     theta = gm.math.radians(get_theta(args.theta, args.algo))
 
     max_nbr_pts = int(args.max_length / args.step_size)
@@ -258,7 +281,8 @@ def main():
         dataset, vox_step_size, args.rk_order, args.algo, sh_basis,
         args.sf_threshold, args.sf_threshold_init, theta, args.sphere,
         sub_sphere=args.sub_sphere,
-        space=our_space, origin=our_origin, is_legacy=is_legacy)
+        space=our_space, origin=our_origin, is_legacy=is_legacy,
+        precompute_maxima=args.precompute_maxima)
 
     logging.info("Instantiating tracker.")
     tracker = Tracker(propagator, mask, seed_generator, nbr_seeds, min_nbr_pts,
@@ -270,35 +294,24 @@ def main():
                       track_forward_only=args.forward_only,
                       skip=args.skip,
                       append_last_point=args.keep_last_out_point,
-                      verbose=args.verbose)
+                      verbose=args.verbose,
+                      use_shared_memory=not args.use_mmap,
+                      batch_propagation=args.batch_propagation)
 
     start = time.time()
-    logging.info("Tracking...")
-    streamlines, seeds = tracker.track()
+    logging.info("Tracking and saving...")
+    # Streamlines are written to the file on-the-fly, while tracking.
+    # We tracked in vox, center, which is what is expected by
+    # save_tractogram (and for seeds). Streamlines were already filtered
+    # by number of points and compressed by the tracker.
+    save_tractogram(tracker.track_generator(), tracts_format, mask_img,
+                    nbr_seeds, args.out_tractogram,
+                    min_length=0, max_length=np.inf, compress=None,
+                    save_seeds=args.save_seeds, verbose=False)
 
     str_time = "%.2f" % (time.time() - start)
-    logging.info("Tracked {} streamlines (out of {} seeds), in {} seconds.\n"
-                 "Now saving..."
-                 .format(len(streamlines), nbr_seeds, str_time))
-
-    # save seeds if args.save_seeds is given
-    # We seeded (and tracked) in vox, center, which is what is expected for
-    # seeds.
-    if args.save_seeds:
-        data_per_streamline = {'seeds': seeds}
-    else:
-        data_per_streamline = {}
-
-    # Compared with scil_tracking_local, using sft rather than
-    # LazyTractogram to deal with space.
-    # Contrary to scilpy or dipy, where space after tracking is vox, here
-    # space after tracking is voxmm.
-    # Smallest possible streamline coordinate is (0,0,0), equivalent of
-    # corner origin (TrackVis)
-    sft = StatefulTractogram(streamlines, mask_img,
-                             space=our_space, origin=our_origin,
-                             data_per_streamline=data_per_streamline)
-    save_tractogram(sft, args.out_tractogram)
+    logging.info("Tracked and saved streamlines (out of {} seeds) in {} "
+                 "seconds.".format(nbr_seeds, str_time))
 
 
 if __name__ == "__main__":
@@ -15,9 +15,10 @@ import numpy as np
 import nibabel as nib
 
 from scilpy.io.streamlines import load_tractogram_with_reference
-from scilpy.io.utils import (add_overwrite_arg, add_reference_arg,
-                             assert_inputs_exist, add_verbose_arg,
-                             assert_outputs_exist)
+from scilpy.io.utils import (add_overwrite_arg, add_processes_arg,
+                             add_reference_arg, assert_inputs_exist,
+                             add_verbose_arg, assert_outputs_exist,
+                             validate_nbr_processes)
 from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
 from scilpy.version import version_string
 
@@ -44,6 +45,7 @@ def _build_arg_parser():
                    help='If set, will only use the endpoints.\n'
                         'To get a head and a tail maps, see '
                         'scil_bundle_compute_endpoints_map.py.')
+    add_processes_arg(p)
     add_reference_arg(p)
     add_verbose_arg(p)
     add_overwrite_arg(p)
@@ -64,6 +66,7 @@ def main():
         parser.error('The value of --binary ({}) '
                      'must be greater than 0 and smaller or equal to {}'
                      .format(args.binary, max_))
+    nbr_cpu = validate_nbr_processes(parser, args)
 
     # Loading
     sft = load_tractogram_with_reference(parser, args, args.in_bundle)
@@ -80,7 +83,8 @@ def main():
                 streamline_count[tuple(endpoint_voxel)] += 1
     else:
         streamline_count = compute_tract_counts_map(sft.streamlines,
-                                                    dimensions)
+                                                    dimensions,
+                                                    nbr_threads=nbr_cpu)
 
     # Saving
     dtype_to_use = np.int32
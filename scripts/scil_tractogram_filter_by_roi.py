@@ -53,7 +53,9 @@ Supports multiple filtering conditions
 Multiple filtering conditions can be used, with varied ROI types if necessary.
 Combining two conditions is equivalent to a logical AND between the conditions.
 Order of application does not matter for the final result, but may change the
-intermediate files, if any.
+intermediate counts, if any.
+
+All ROIs and planes are evaluated in a single pass over the streamlines.
 
 Distance management
 -------------------
@@ -86,7 +88,6 @@ import glob
 import json
 import logging
 import os
-from copy import deepcopy
 
 import nibabel as nib
 import numpy as np
@@ -97,11 +98,13 @@ from scilpy.image.labels import (get_data_as_labels,
 from scilpy.io.streamlines import (load_tractogram_with_reference,
                                    save_tractogram)
 from scilpy.io.utils import (add_json_args, add_overwrite_arg,
-                             add_reference_arg, add_verbose_arg,
-                             assert_inputs_exist, assert_outputs_exist,
-                             read_info_from_mb_bdo, assert_headers_compatible)
+                             add_processes_arg, add_reference_arg,
+                             add_verbose_arg, assert_inputs_exist,
+                             assert_outputs_exist, read_info_from_mb_bdo,
+                             assert_headers_compatible,
+                             validate_nbr_processes)
 from scilpy.segment.streamlines import (filter_cuboid, filter_ellipsoid,
-                                        filter_grid_roi)
+                                        filter_grid_rois)
 from scilpy.version import version_string
 
 MODES = ['any', 'all', 'either_end', 'both_ends']
@@ -166,6 +169,7 @@ def _build_arg_parser():
                    help='Save rejected streamlines to output tractogram.')
 
     add_json_args(p)
+    add_processes_arg(p)
     add_reference_arg(p)
     add_verbose_arg(p)
     add_overwrite_arg(p)
@@ -373,15 +377,22 @@ def main():
         parser, args.drawn_roi, args.atlas_roi, args.bdo,
         args.x_plane, args.y_plane, args.z_plane, dim)
 
-    if args.save_rejected:
-        initial_sft = deepcopy(sft)
+    nbr_cpu = validate_nbr_processes(parser, args)
 
     # Processing
 
     o_dict = {'streamline_count_before_filtering': len(sft.streamlines)}
 
+    # For each criterion, the streamlines respecting it. ROIs and planes are
+    # all evaluated at once (see below), bounding boxes one by one.
+    selected = np.zeros((len(sft), len(roi_opt_list)), dtype=bool)
+    grid_ids = []
+    grid_masks = []
+    grid_modes = []
+    grid_is_excludes = []
+    grid_distances = []
+
     atlas_roi_item = 0
-    total_kept_ids = np.arange(len(sft.streamlines))
     for i, roi_opt in enumerate(roi_opt_list):
         logging.info("Preparing filtering from option: {}".format(roi_opt))
 
@@ -423,9 +434,6 @@ def main():
                     img = nib.Nifti1Image(mask, img.affine)
                     img.to_filename(filename)
 
-            kept_ids, filtered_sft = filter_grid_roi(
-                sft, mask, mode, is_exclude, distance, return_sft=True)
-
         elif filter_type in ['x_plane', 'y_plane', 'z_plane']:
             # FILTERING FROM PLANE
             plane_id = int(plane_id)
@@ -437,9 +445,6 @@ def main():
             elif filter_type == 'z_plane':
                 mask[:, :, plane_id] = 1
 
-            kept_ids, filtered_sft = filter_grid_roi(
-                sft, mask, mode, is_exclude, distance, return_sft=True)
-
         else:  # filter_type == 'bdo':
             # FILTERING FROM BOUNDING BOX
             geometry, radius, center = read_info_from_mb_bdo(roi_file)
@@ -448,37 +453,48 @@ def main():
                 radius += distance * sft.space_attributes[2]
 
             if geometry == 'Ellipsoid':
-                kept_ids, filtered_sft = filter_ellipsoid(
+                kept_ids, _ = filter_ellipsoid(
                     sft, radius, center, mode, is_exclude)
             else:  # geometry == 'Cuboid':
-                kept_ids, filtered_sft = filter_cuboid(
+                kept_ids, _ = filter_cuboid(
                     sft, radius, center, mode, is_exclude)
-
+            selected[kept_ids, i] = True
+            continue
+
+        grid_ids.append(i)
+        grid_masks.append(mask)
+        grid_modes.append(mode)
+        grid_is_excludes.append(is_exclude)
+        grid_distances.append(distance)
+
+    if len(grid_ids) > 0:
+        logging.info("Filtering from {} ROIs and planes..."
+                     .format(len(grid_ids)))
+        selected[:, grid_ids] = filter_grid_rois(
+            sft, grid_masks, grid_modes, grid_is_excludes, grid_distances,
+            nbr_processes=nbr_cpu)
+    del grid_masks
+
+    # Criteria are combined with a logical AND, in the given order.
+    is_kept = np.ones(len(sft), dtype=bool)
+    for i, roi_opt in enumerate(roi_opt_list):
+        is_kept &= selected[:, i]
+        nb_kept = int(np.count_nonzero(is_kept))
         logging.info('The filtering options {} resulted in {} included '
-                     'streamlines'.format(roi_opt, len(filtered_sft)))
-
-        sft = filtered_sft
-        if kept_ids.size == 0:
-            total_kept_ids = 0
-        else:
-            total_kept_ids = total_kept_ids[kept_ids]
-
-        o_dict['streamline_count_after_criteria{}'.format(i)] = \
-            len(sft.streamlines)
+                     'streamlines'.format(roi_opt, nb_kept))
+        o_dict['streamline_count_after_criteria{}'.format(i)] = nb_kept
 
     # Streamline count after filtering
-    o_dict['streamline_count_final_filtering'] = len(sft.streamlines)
+    total_kept_ids = np.where(is_kept)[0]
+    o_dict['streamline_count_final_filtering'] = len(total_kept_ids)
     if args.display_counts:
         print(json.dumps(o_dict, indent=args.indent))
 
-    save_tractogram(sft, args.out_tractogram, args.no_empty)
+    save_tractogram(sft[total_kept_ids], args.out_tractogram, args.no_empty)
 
     if args.save_rejected:
-        rejected_ids = np.setdiff1d(np.arange(len(initial_sft.streamlines)),
-                                    total_kept_ids)
-
-        sft = initial_sft[rejected_ids]
-        save_tractogram(sft, args.save_rejected, args.no_empty)
+        rejected_ids = np.where(~is_kept)[0]
+        save_tractogram(sft[rejected_ids], args.save_rejected, args.no_empty)
 
 
 if __name__ == "__main__":
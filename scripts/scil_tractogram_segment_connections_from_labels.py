@@ -82,8 +82,7 @@ from scilpy.io.utils import (add_bbox_arg, add_overwrite_arg,
                              validate_nbr_processes, assert_headers_compatible)
 from scilpy.tractanalysis.connectivity_segmentation import (
     compute_connectivity,
-    construct_hdf5_from_connectivity,
-    extract_longest_segments_from_profile)
+    construct_hdf5_from_connectivity)
 from scilpy.tractograms.uncompress import streamlines_to_voxel_coordinates
 from scilpy.version import version_string
 
@@ -297,8 +296,8 @@ def main():
     # Compute the connectivity mapping
     logging.info('*** Computing connectivity information ***')
     time1 = time.time()
-    con_info = compute_connectivity(indices, data_labels, real_labels,
-                                    extract_longest_segments_from_profile)
+    con_info = compute_connectivity(indices, data_labels,
+                                    nbr_processes=nbr_cpu)
     time2 = time.time()
     logging.info('    Connectivity computation took {} sec.'.format(
         round(time2 - time1, 2)))
@@ -313,7 +312,7 @@ def main():
         remove_outliers = not args.no_remove_outliers
         remove_curv_dev = not args.no_remove_curv_dev
         construct_hdf5_from_connectivity(
-            sft, indices, points_to_idx, real_labels, con_info,
+            sft, indices, points_to_idx, con_info,
             hdf5_file, _get_saving_options(args), out_paths,
             prune_length, args.min_length, args.max_length,
             remove_loops, args.loop_max_angle,
@@ -27,6 +27,10 @@ For CPU usage, it can be variable (advanced CPU vs. basic CPU):
     On a cluster: 8 CPU per subject and then it is better to parallelize across
     subjects.
 
+When segmenting many subjects with the same atlas, use --model_cache_dir
+with the same directory for all subjects: the model files will be parsed
+once, then read from the cache.
+
 For RAM usage, it is recommanded to use this heuristic:
     (size of inputs tractogram (GB) * number of processes) < RAM (GB)
 This is important because many instances of data structures are initialized
@@ -109,6 +113,15 @@ def _build_arg_parser():
                    help='Random number generator seed %(default)s.')
     p.add_argument('--inverse', action='store_true',
                    help='Use the inverse transformation.')
+    p.add_argument('--model_cache_dir',
+                   help='Directory where to cache the parsed models.\n'
+                        'Can be shared across subjects. Created if it does '
+                        'not exist.')
+    p.add_argument('--use_wb_index', action='store_true',
+                   help='Resample the whole-brain tractogram once and read '
+                        'the\nneighbors of every bundle from it for the '
+                        'final pruning.\nFaster for atlases with many '
+                        'bundles, uses more disk space.')
 
     add_reference_arg(p)
     add_processes_arg(p)
@@ -177,9 +190,14 @@ def main():
     # For code simplicity, it is still BundleSeg class and all, but
     # the last pruning step was modified to be in line with BundleSeg.
 
+    if args.model_cache_dir is not None:
+        os.makedirs(args.model_cache_dir, exist_ok=True)
+
     voting = VotingScheme(config, in_models_directories,
                           transfo, args.out_dir,
-                          minimal_vote_ratio=args.minimal_vote_ratio)
+                          minimal_vote_ratio=args.minimal_vote_ratio,
+                          model_cache_dir=args.model_cache_dir,
+                          use_wb_index=args.use_wb_index)
 
     voting(args.in_tractograms, nbr_processes=args.nbr_processes,
            seed=args.seed, reference=args.reference)
@@ -20,7 +20,8 @@ import os
 import nibabel as nib
 import numpy as np
 
-from scilpy.image.labels import get_data_as_labels, get_stats_in_label
+from scilpy.image.labels import (LabelIndex, get_data_as_labels,
+                                 get_stats_in_label)
 from scilpy.io.utils import (add_json_args, add_overwrite_arg, add_verbose_arg,
                              assert_inputs_exist, assert_headers_compatible)
 from scilpy.utils.filenames import split_name_with_nii
@@ -76,6 +77,7 @@ def main():
 
     # Loading
     label_data = get_data_as_labels(nib.load(args.in_labels))
+    label_index = LabelIndex(label_data)
     with open(args.in_labels_lut) as f:
         label_dict = json.load(f)
 
@@ -88,7 +90,8 @@ def main():
             parser.error('Input metrics should be 3D images.')
 
         # Process
-        out_dict = get_stats_in_label(metric_data, label_data, label_dict)
+        out_dict = get_stats_in_label(metric_data, label_data, label_dict,
+                                      label_index=label_index)
         json_stats[metric_name] = out_dict
 
     if len(args.metrics_file_list) == 1:
@@ -25,3 +25,15 @@ def test_execution_connectivity(script_runner, monkeypatch):
                             in_len, 'gtm.json', '--avg_node_wise',
                             '--small_world')
     assert ret.success
+
+
+def test_execution_small_world_cache(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_sc = os.path.join(SCILPY_HOME, 'connectivity', 'sc_norm.npy')
+    in_len = os.path.join(SCILPY_HOME, 'connectivity', 'len.npy')
+    for _ in range(2):
+        ret = script_runner.run('scil_connectivity_graph_measures.py', in_sc,
+                                in_len, 'gtm_cache.json', '--avg_node_wise',
+                                '--small_world', '--small_world_cache_dir',
+                                'small_world_cache', '-f')
+        assert ret.success
@@ -25,3 +25,13 @@ def test_execution_atlas(script_runner, monkeypatch):
                             'atlas_freesurfer_v2_single_brainstem_dil.nii.gz',
                             '--processes', '1', '--distance', '2')
     assert ret.success
+
+
+def test_execution_atlas_edt(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_atlas = os.path.join(SCILPY_HOME, 'atlas',
+                            'atlas_freesurfer_v2_single_brainstem.nii.gz')
+    ret = script_runner.run('scil_labels_dilate.py', in_atlas,
+                            'atlas_freesurfer_v2_single_brainstem_edt.nii.gz',
+                            '--distance', '2', '--method', 'edt')
+    assert ret.success
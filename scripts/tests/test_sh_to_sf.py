@@ -70,3 +70,16 @@ def test_execution_no_bval(script_runner, monkeypatch):
                             '--sphere', 'symmetric724', '--dtype', 'float32',
                             '-f', '--processes', '4')
     assert ret.success
+
+
+def test_execution_out_of_core(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_sh = os.path.join(SCILPY_HOME, 'processing', 'sh_1000.nii.gz')
+    in_b0 = os.path.join(SCILPY_HOME, 'processing', 'fa.nii.gz')
+
+    ret = script_runner.run('scil_sh_to_sf.py', in_sh,
+                            'sf_724_ooc.nii.gz', '--in_b0', in_b0,
+                            '--out_bvec', 'sf_724_ooc.bvec', '--b0_scaling',
+                            '--sphere', 'symmetric724', '--dtype', 'float32',
+                            '--out_of_core', '--block_size', '1000')
+    assert ret.success
@@ -55,3 +55,34 @@ def test_execution_tracking_fodf_custom_seeds(script_runner, monkeypatch):
                             '--sub_sphere', '2',
                             '--rk_order', '4')
     assert ret.success
+
+
+def test_execution_tracking_fodf_batch(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking',
+                           'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking',
+                           'seeding_mask.nii.gz')
+    ret = script_runner.run('scil_tracking_local_dev.py', in_fodf,
+                            in_mask, in_mask, 'local_prob3.trk', '--nt', '10',
+                            '--compress', '0.1', '--sh_basis', 'descoteaux07',
+                            '--min_length', '20', '--max_length', '200',
+                            '--save_seeds', '--rng_seed', '0',
+                            '--batch_propagation')
+    assert ret.success
+
+
+def test_execution_tracking_fodf_precompute_maxima(script_runner,
+                                                   monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(SCILPY_HOME, 'tracking',
+                           'fodf.nii.gz')
+    in_mask = os.path.join(SCILPY_HOME, 'tracking',
+                           'seeding_mask.nii.gz')
+    ret = script_runner.run('scil_tracking_local_dev.py', in_fodf,
+                            in_mask, in_mask, 'local_det.trk', '--nt', '10',
+                            '--compress', '0.1', '--sh_basis', 'descoteaux07',
+                            '--min_length', '20', '--max_length', '200',
+                            '--algo', 'det', '--precompute_maxima',
+                            '--sh_interp', 'nearest', '--rng_seed', '0')
+    assert ret.success
@@ -5,6 +5,9 @@ import json
 import os
 import tempfile
 
+import nibabel as nib
+import numpy as np
+
 from scilpy import SCILPY_HOME
 from scilpy.io.fetcher import fetch_data, get_testing_files_dict
 
@@ -40,3 +43,74 @@ def test_execution_bundles(script_runner, monkeypatch):
                             in_aff, '--inverse',
                             '--processes', '1', '-v', 'WARNING')
     assert ret.success
+
+
+def test_execution_bundles_model_cache(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_tractogram = os.path.join(SCILPY_HOME, 'bundles',
+                                 'bundle_all_1mm.trk')
+    in_models = os.path.join(SCILPY_HOME, 'bundles', 'fibercup_atlas')
+    in_aff = os.path.join(SCILPY_HOME, 'bundles',
+                          'affine.txt')
+
+    tmp_config = {}
+    for i in range(1, 6):
+        tmp_config['bundle_{}.trk'.format(i)] = 4
+
+    with open('config.json', 'w') as outfile:
+        json.dump(tmp_config, outfile)
+
+    ret = script_runner.run('scil_tractogram_segment_with_bundleseg.py',
+                            in_tractogram, 'config.json',
+                            in_models,
+                            in_aff, '--inverse',
+                            '--out_dir', 'voting_no_cache',
+                            '--processes', '1', '-v', 'WARNING')
+    assert ret.success
+
+    # Second run reads the models from the cache.
+    for out_dir in ['voting_cache_1', 'voting_cache_2']:
+        ret = script_runner.run('scil_tractogram_segment_with_bundleseg.py',
+                                in_tractogram, 'config.json',
+                                in_models,
+                                in_aff, '--inverse',
+                                '--model_cache_dir', 'model_cache',
+                                '--out_dir', out_dir,
+                                '--processes', '1', '-v', 'WARNING')
+        assert ret.success
+    assert len(os.listdir('model_cache')) > 0
+
+    # Same recognized streamlines with and without the cache.
+    for filename in sorted(os.listdir('voting_no_cache')):
+        if not filename.endswith('.trk'):
+            continue
+        expected = nib.streamlines.load(
+            os.path.join('voting_no_cache', filename)).streamlines
+        for out_dir in ['voting_cache_1', 'voting_cache_2']:
+            result = nib.streamlines.load(
+                os.path.join(out_dir, filename)).streamlines
+            assert np.array_equal(result.get_data(), expected.get_data())
+
+
+def test_execution_bundles_wb_index(script_runner, monkeypatch):
+    monkeypatch.chdir(os.path.expanduser(tmp_dir.name))
+    in_tractogram = os.path.join(SCILPY_HOME, 'bundles',
+                                 'bundle_all_1mm.trk')
+    in_models = os.path.join(SCILPY_HOME, 'bundles', 'fibercup_atlas')
+    in_aff = os.path.join(SCILPY_HOME, 'bundles',
+                          'affine.txt')
+
+    tmp_config = {}
+    for i in range(1, 6):
+        tmp_config['bundle_{}.trk'.format(i)] = 4
+
+    with open('config.json', 'w') as outfile:
+        json.dump(tmp_config, outfile)
+
+    ret = script_runner.run('scil_tractogram_segment_with_bundleseg.py',
+                            in_tractogram, 'config.json',
+                            in_models,
+                            in_aff, '--inverse', '--use_wb_index',
+                            '--out_dir', 'voting_wb_index',
+                            '--processes', '1', '-v', 'WARNING')
+    assert ret.success
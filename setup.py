@@ -1,4 +1,5 @@
 import os
+import sys
 
 from setuptools import setup, find_packages, Extension
 from setuptools.command.build_ext import build_ext
@@ -15,19 +16,36 @@ with open('requirements.txt') as f:
             external_dependencies.append(dependency)
 
 
+def get_openmp_flags():
+    """ Compile and link flags for OpenMP. Without OpenMP (ex: with Apple's
+    clang), the parallel loops of the extensions run on a single thread. """
+    if sys.platform == 'win32':
+        return ['/openmp'], []
+    elif sys.platform == 'darwin':
+        return [], []
+    return ['-fopenmp'], ['-fopenmp']
+
+
 def get_extensions():
     define_macros = [('NPY_NO_DEPRECATED_API', 'NPY_1_7_API_VERSION')]
+    compile_args, link_args = get_openmp_flags()
     uncompress = Extension('scilpy.tractograms.uncompress',
                            ['scilpy/tractograms/uncompress.pyx'],
-                           define_macros=define_macros)
+                           define_macros=define_macros,
+                           extra_compile_args=compile_args,
+                           extra_link_args=link_args)
     voxel_boundary_intersection =\
         Extension('scilpy.tractanalysis.voxel_boundary_intersection',
                   ['scilpy/tractanalysis/voxel_boundary_intersection.pyx'],
-                  define_macros=define_macros)
+                  define_macros=define_macros,
+                  extra_compile_args=compile_args,
+                  extra_link_args=link_args)
     streamlines_metrics =\
         Extension('scilpy.tractanalysis.streamlines_metrics',
                   ['scilpy/tractanalysis/streamlines_metrics.pyx'],
-                  define_macros=define_macros)
+                  define_macros=define_macros,
+                  extra_compile_args=compile_args,
+                  extra_link_args=link_args)
     return [uncompress, voxel_boundary_intersection, streamlines_metrics]
 
 